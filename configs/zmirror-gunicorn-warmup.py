@@ -0,0 +1,61 @@
+# zmirror-onekey: gunicorn config of mirror {{mirror_name}}, used with `--runtime pypy`
+# This file is generated by deploy.py, changes will be overwritten on next install
+#
+# PyPy only compiles the code paths which have been executed many times, so a fresh worker
+#     is slow for its first requests. Before the worker accepts connections, it serves some
+#     requests to itself (fetched from the upstream and rewritten exactly like real traffic),
+#     so that the JIT has compiled zmirror's URL and content rewriting.
+import io
+import sys
+import time
+
+DOMAIN = "{{domain}}"
+WARMUP_PATHS = ["/"]
+WARMUP_REQUESTS = {{warmup_requests}}
+WARMUP_SECONDS = {{warmup_seconds}}
+
+
+def warmup_request(app, path):
+    """Call the wsgi app directly with a GET request, and consume the response"""
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": DOMAIN,
+        "SERVER_PORT": "443",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": DOMAIN,
+        "HTTP_USER_AGENT": "Mozilla/5.0 (X11; Linux x86_64) zmirror-warmup",
+        "HTTP_ACCEPT": "text/html,application/xhtml+xml,*/*",
+        "HTTP_ACCEPT_ENCODING": "identity",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "https",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    body = app(environ, lambda status, headers, exc_info=None: None)
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+def post_worker_init(worker):
+    """Called by gunicorn after the app is loaded, before the worker accepts connections"""
+    started = time.time()
+    count = 0
+    while count < WARMUP_REQUESTS and time.time() - started < WARMUP_SECONDS:
+        try:
+            warmup_request(worker.wsgi, WARMUP_PATHS[count % len(WARMUP_PATHS)])
+        except Exception as e:
+            worker.log.warning("zmirror warm-up request failed: %s", e)
+            break
+        count += 1
+    worker.log.info("zmirror warmed up with %d request(s) in %.1fs", count, time.time() - started)
@@ -8,12 +8,25 @@ import shutil
 import subprocess
 import traceback
 import tempfile
+import selectors
+import fcntl
+import codecs
 import string
 import random
-from time import sleep
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
+from time import sleep as _sleep, time
+import atexit
 from datetime import datetime
 from urllib.parse import urljoin
 import json
+import hashlib
+import base64
+import struct
+import tarfile
+import ssl
 
 try:
     from external_pkgs.ColorfulPyPrint import *
@@ -52,6 +65,119 @@ DEBUG = '--debug' in sys.argv
 already_have_cert = '--i-have-cert' in sys.argv
 upgrade_only = "--upgrade-only" in sys.argv
 
+
+def get_argv_value(name, default=None):
+    """
+    读取形如 `--name VALUE` 或 `--name=VALUE` 的命令行参数
+    :type name: str
+    :rtype: str
+    """
+    for index, arg in enumerate(sys.argv):
+        if arg == name and index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+        if arg.startswith(name + "="):
+            return arg[len(name) + 1:]
+    return default
+
+
+def get_argv_values(name):
+    """
+    读取可以出现多次的命令行参数, 比如 `--force-step a --force-step b`
+    :type name: str
+    :rtype: list
+    """
+    values = []
+    for index, arg in enumerate(sys.argv):
+        if arg == name and index + 1 < len(sys.argv):
+            values.append(sys.argv[index + 1])
+        elif arg.startswith(name + "="):
+            values.append(arg[len(name) + 1:])
+    return values
+
+
+def get_mem_total_kb():
+    """
+    本机的内存总量(KB), 无法读取时返回 None
+    :rtype: int
+    """
+    try:
+        with open('/proc/meminfo') as fr:
+            matched = re.search(r'^MemTotal:\s+(\d+)', fr.read(), re.M)
+        return int(matched.group(1)) if matched else None
+    except (OSError, ValueError):
+        return None
+
+
+# 预先构建好的 wheel 文件夹, 所有主机可以共用, 避免每台主机都重新编译C扩展
+wheelhouse = get_argv_value("--wheelhouse")
+# 离线模式, 只从 wheelhouse 中安装python包
+offline = "--offline" in sys.argv
+# 本地的git裸仓库缓存, 安装时从这里克隆, 升级时只需要从上游fetch一次
+SOURCE_CACHE_DIR = get_argv_value("--source-cache", "/var/cache/zmirror-onekey")
+# 用一个包含裸仓库的tar包预先填充缓存, 配合 --offline 可以在没有网络的主机上部署
+source_seed = get_argv_value("--seed-sources")
+# 使用的服务器: apache (默认, mod_wsgi), 或者 nginx (每个镜像由独立的 gunicorn 服务运行, 由 systemd 管理)
+server_name = get_argv_value("--server", "apache")
+# 镜像应用服务的工作模型 (gevent 只能用于 --server nginx):
+#     thread: gunicorn 的 gthread worker, 每个进程有固定数量的线程 (默认, 与Apache的WSGI进程相同)
+#     gevent: 协程 worker, 等待上游网站时不占用线程, 每个进程可以同时处理数百个请求
+#     `--worker-model 镜像名=模型` 只指定一个镜像的工作模型, 可指定多次
+worker_model_args = get_argv_values("--worker-model")
+# 运行镜像的python (pypy 只能用于 --server nginx):
+#     cpython: 系统的 python3 (默认)
+#     pypy: 由 PyPy 的JIT运行zmirror的URL和内容改写等纯python的计算, 镜像的依赖安装在独立的 PyPy 虚拟环境中
+runtime = get_argv_value("--runtime", "cpython")
+# let's encrypt 证书的签发方式:
+#     san: 所有域名放在同一张证书中, 只运行一次certbot (默认)
+#     separate: 每个域名单独签发一张证书
+cert_mode = get_argv_value("--cert-mode", "san")
+# let's encrypt 的验证方式:
+#     webroot: 由正在运行的Apache提供验证文件, 获取/更新证书时不需要停止Apache (默认)
+#     standalone: certbot自己监听80端口, 需要先停止Apache
+acme_challenge = get_argv_value("--acme-challenge", "webroot")
+# 获取证书使用的ACME客户端: certbot (certbot-auto), 或者 native (本脚本内置的客户端, 不需要安装certbot)
+acme_client_name = get_argv_value("--acme-client", "certbot")
+# ACME服务器的 directory 地址, 可以指定为本地测试用的 Pebble 等
+ACME_DIRECTORY_URL = get_argv_value("--acme-directory", "https://acme-v02.api.letsencrypt.org/directory")
+# ACME服务器HTTPS证书的CA文件, 用于自签名的测试服务器
+ACME_CA_BUNDLE = get_argv_value("--acme-ca-bundle")
+# 为镜像域名的父域名获取通配符证书(*.example.com), 通过 --dns-hook 指定的脚本完成 DNS-01 验证,
+#     之后在同一个父域名下添加新的镜像时不需要再获取证书
+wildcard = "--wildcard" in sys.argv
+# DNS-01 验证使用的hook脚本, 参数与 dehydrated 的hook相同:
+#     HOOK deploy_challenge|clean_challenge <域名> <token> <TXT记录的值>
+#     deploy_challenge 应当在 _acme-challenge.<域名> 的TXT记录生效之后再返回
+dns_hook = get_argv_value("--dns-hook")
+# let's encrypt 证书的密钥类型:
+#     rsa: RSA 2048 (默认)
+#     ecdsa: ECDSA P-256, 握手时服务器的计算量和发送的数据都更少
+#     dual: 同时获取两种证书, 由Apache根据客户端的支持情况选择 (需要Apache 2.4.8+)
+cert_key_type = get_argv_value("--cert-key-type", "rsa")
+# 只更新即将过期的证书, 由每周的cron任务调用
+renew_certs = "--renew-certs" in sys.argv
+# 在多少天内过期的证书需要更新
+renew_window = int(get_argv_value("--renew-window", 30))
+# 每个证书更新之前随机等待的最长秒数, 避免所有主机在同一时刻访问ACME服务器
+renew_max_delay = int(get_argv_value("--renew-max-delay", 0))
+# 打印所有证书的过期时间
+cert_status = "--cert-status" in sys.argv
+# 对本机所有zmirror https站点进行TLS握手的性能测试, 然后退出
+tls_benchmark = "--tls-benchmark" in sys.argv
+# 每项测试持续的秒数和并发连接数
+TLS_BENCHMARK_SECONDS = float(get_argv_value("--tls-benchmark-seconds", 5))
+TLS_BENCHMARK_CONCURRENCY = int(get_argv_value("--tls-benchmark-concurrency", 4))
+# 对比各个工作模型在上游网站很慢时能同时处理的请求数, 然后退出
+worker_benchmark = "--worker-benchmark" in sys.argv
+# 测试持续的秒数, 并发的客户端数, 以及模拟的上游网站每个请求的延迟(秒)
+WORKER_BENCHMARK_SECONDS = float(get_argv_value("--worker-benchmark-seconds", 5))
+WORKER_BENCHMARK_CONCURRENCY = int(get_argv_value("--worker-benchmark-concurrency", 64))
+WORKER_BENCHMARK_UPSTREAM_DELAY = float(get_argv_value("--worker-benchmark-delay", 1))
+# 在结束时打印各步骤的耗时汇总, 并写出JSON文件
+profile_enabled = "--profile" in sys.argv
+PROFILE_FILE_PATH = get_argv_value(
+    "--profile-output",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "zmirror_onekey_profile.json"))
+
 if DEBUG:
     ColorfulPyPrint_set_verbose_level(3)
 else:
@@ -65,6 +191,9 @@ need_answer_question = False
 loaded_config = False  # 加载了上一次的配置
 
 DUMP_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "last_install_dump.json")
+JOURNAL_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "last_install_journal.json")
+# 即使已经完成, 也强制重新运行的步骤, 可以指定多次, `all` 表示全部
+force_steps = get_argv_values("--force-step")
 
 
 def onekey_report(report_type=REPORT_SUCCESS, traceback_str=None, msg=None):
@@ -88,7 +217,7 @@ def onekey_report(report_type=REPORT_SUCCESS, traceback_str=None, msg=None):
             dist = "Unable to read dist\n" + traceback.format_exc()
 
     try:
-        stdout_str = stdout_logger_last.get_value() + stdout_logger.get_value()
+        stdout_str = stdout_logger.get_value()
     except:
         stdout_str = "Unable to read stdout.\n" + traceback.format_exc()
     try:
@@ -139,14 +268,8 @@ def onekey_report(report_type=REPORT_SUCCESS, traceback_str=None, msg=None):
     except:
         data["email"] = "NotDefined@fake.com"
 
-    try:
-        meminfo = open('/proc/meminfo').read()
-        matched = re.search(r'^MemTotal:\s+(\d+)', meminfo)
-        if matched:
-            mem_total_KB = int(matched.groups()[0])
-            data['memory'] = mem_total_KB
-    except:
-        data['memory'] = 1
+    mem_total_KB = get_mem_total_kb()
+    data['memory'] = mem_total_KB if mem_total_KB is not None else 1
 
     dbgprint(__REPORT_URLS__[report_type], data)
 
@@ -170,64 +293,362 @@ def onekey_report(report_type=REPORT_SUCCESS, traceback_str=None, msg=None):
         dbgprint(r.text, r.headers, r.request.body)
 
 
+class DeployProfiler:
+    """
+    记录部署过程中每个阶段, 步骤, 命令和sleep的耗时
+        命令还会记录子进程消耗的CPU时间和输出的字节数
+        使用 --profile 时, 在结束时打印按耗时排序的汇总, 并写出JSON文件(可以在 chrome://tracing 中打开)
+    """
+
+    def __init__(self):
+        self.records = []
+        self.origin = time()
+        self._lock = threading.Lock()
+        self._phase = None  # (阶段名, 开始时间)
+
+    def add(self, name, category, start, end, child_cpu=0.0, output_bytes=0, ok=True):
+        with self._lock:
+            self.records.append({
+                "name": name,
+                "category": category,
+                "start": start - self.origin,
+                "duration": end - start,
+                "child_cpu": child_cpu,
+                "output_bytes": output_bytes,
+                "ok": ok,
+                "thread": threading.current_thread().name,
+            })
+
+    def phase(self, name=None):
+        """结束上一个顶层阶段, 并开始一个新的阶段; name 为 None 时只结束上一个阶段"""
+        now = time()
+        if self._phase is not None:
+            self.add(self._phase[0], "phase", self._phase[1], now)
+        self._phase = (name, now) if name is not None else None
+
+    def summary(self, top=25):
+        """打印按耗时排序的汇总"""
+        self.phase()
+        with self._lock:
+            records = list(self.records)
+
+        infoprint("------------ deploy profile ------------")
+        totals = OrderedDict()
+        for record in records:
+            total = totals.setdefault(record["category"], [0, 0.0, 0.0, 0])
+            total[0] += 1
+            total[1] += record["duration"]
+            total[2] += record["child_cpu"]
+            total[3] += record["output_bytes"]
+        print("    {:<10} {:>6} {:>10} {:>10} {:>12}".format("category", "count", "wall(s)", "cpu(s)", "output(B)"))
+        for category, (count, wall, cpu, output) in totals.items():
+            print("    {:<10} {:>6} {:>10.1f} {:>10.1f} {:>12}".format(category, count, wall, cpu, output))
+        print()
+        print("    {:<8} {:>10} {:>10} {:>12}  {}".format("category", "wall(s)", "cpu(s)", "output(B)", "name"))
+        for record in sorted(records, key=lambda r: r["duration"], reverse=True)[:top]:
+            print("    {:<8} {:>10.2f} {:>10.2f} {:>12}  {}".format(
+                record["category"], record["duration"], record["child_cpu"],
+                record["output_bytes"], record["name"][:100]))
+        infoprint("------------ deploy profile ------------")
+
+    def dump(self, path):
+        """写出JSON文件, 其中的 traceEvents 是 Chrome trace 格式"""
+        self.phase()
+        with self._lock:
+            records = list(self.records)
+        thread_ids = {}
+        events = []
+        for record in records:
+            events.append({
+                "name": record["name"],
+                "cat": record["category"],
+                "ph": "X",
+                "ts": int(record["start"] * 1e6),
+                "dur": int(record["duration"] * 1e6),
+                "pid": 1,
+                "tid": 0 if record["category"] == "phase" else
+                thread_ids.setdefault(record["thread"], len(thread_ids) + 1),
+                "args": {"child_cpu": record["child_cpu"], "output_bytes": record["output_bytes"],
+                         "ok": record["ok"]},
+            })
+        with open(path, "w", encoding="utf-8") as fw:
+            json.dump({"traceEvents": events, "records": records}, fw, indent=1)
+        infoprint("Deploy profile written to", path)
+
+    def report(self, path):
+        try:
+            self.summary()
+            self.dump(path)
+        except Exception:
+            traceback.print_exc()
+
+
+profiler = DeployProfiler()
+if profile_enabled:
+    # 安装失败或者提前退出时也输出
+    atexit.register(profiler.report, PROFILE_FILE_PATH)
+
+
+def sleep(seconds):
+    """与 time.sleep 相同, 但是会把等待的时间记录到 profiler 中"""
+    start_time = time()
+    _sleep(seconds)
+    profiler.add("sleep({})".format(seconds), "sleep", start_time, time())
+
+
 class StdLogger:
-    def __init__(self, mode="stdout"):
-        self._file = tempfile.NamedTemporaryFile(
-            mode='w+', encoding='utf-8', prefix="zmirror_onekey_{mode}_".format(mode=mode))
+    """
+    有容量上限的命令输出日志
+        所有命令的输出都写入同一个临时文件, 文件超过 max_bytes 的两倍时, 只保留最后 max_bytes 字节,
+        所以无论运行了多少命令, 占用的内存和文件描述符都是固定的
+        每段输出可以标记它所属的步骤(命令), 用 get_step() 取回某个步骤的输出
+    """
 
-    def get_value(self):
-        self._file.seek(0)
-        return self._file.read()
+    def __init__(self, mode="stdout", max_bytes=256 * 1024, max_steps=200):
+        self._file = tempfile.TemporaryFile(mode='w+b', prefix="zmirror_onekey_{mode}_".format(mode=mode))
+        self._lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self._size = 0  # 当前文件大小
+        self._dropped = 0  # 已经从文件头部丢弃的字节数, 即文件中第0个字节的逻辑偏移
+        self._steps = OrderedDict()  # 步骤名 -> [(逻辑起始偏移, 逻辑结束偏移), ...]
 
-    def write(self, msg):
+    def write(self, msg, step=None):
         """
         :type msg: str
+        :param step: 这段输出所属的步骤名
+        :type step: str
         """
-        self._file.write(msg)
+        data = msg.encode("utf-8", "replace")
+        if not data:
+            return
+        with self._lock:
+            start = self._dropped + self._size
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._size += len(data)
+
+            if step is not None:
+                segments = self._steps.setdefault(step, [])
+                self._steps.move_to_end(step)
+                if segments and segments[-1][1] == start:
+                    segments[-1] = (segments[-1][0], start + len(data))  # 与上一段相连, 合并
+                else:
+                    segments.append((start, start + len(data)))
+                while len(self._steps) > self.max_steps:
+                    self._steps.popitem(last=False)
 
-    @property
-    def file_path(self):
-        return self._file.name
+            if self._size > self.max_bytes * 2:
+                self._compact()
+
+    def _compact(self):
+        """只保留文件最后的 max_bytes 字节"""
+        self._file.seek(self._size - self.max_bytes)
+        kept = self._file.read()
+        self._file.seek(0)
+        self._file.write(kept)
+        self._file.truncate()
+        self._dropped += self._size - len(kept)
+        self._size = len(kept)
+
+    def _read(self, start, end):
+        """读取逻辑偏移 [start, end) 之间仍然保留着的内容"""
+        start = max(start, self._dropped)
+        if end <= start:
+            return b""
+        self._file.seek(start - self._dropped)
+        return self._file.read(end - start)
+
+    def tail(self, max_bytes=None, max_lines=None):
+        """
+        从文件末尾读取最后的输出
+        :rtype: str
+        """
+        with self._lock:
+            end = self._dropped + self._size
+            data = self._read(end - min(max_bytes or self.max_bytes, self._size), end)
+        text = data.decode("utf-8", "replace")
+        if max_lines is not None:
+            text = "".join(text.splitlines(True)[-max_lines:])
+        return text
+
+    def get_value(self):
+        return self.tail()
+
+    def get_step(self, step):
+        """
+        取回某个步骤的输出(仅包含仍然保留着的部分)
+        :rtype: str
+        """
+        with self._lock:
+            data = b"".join(self._read(start, end) for start, end in self._steps.get(step, []))
+        return data.decode("utf-8", "replace")
+
+
+class _StepSink:
+    """把写入的内容标记为属于某个步骤, 再转交给 StdLogger"""
+
+    def __init__(self, logger, step):
+        self.logger = logger
+        self.step = step
+
+    def write(self, msg):
+        self.logger.write(msg, step=self.step)
 
 
 try:
-    stdout_logger_last = StdLogger()
     stdout_logger = StdLogger()
     stderr_logger = StdLogger(mode="stderr")
 except:
     onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
     raise
 
+_cmd_counter = [0]
+_cmd_state = threading.local()  # 记录每个线程最后一次运行的命令对应的步骤名
+
+
+def last_cmd_output(max_bytes=None):
+    """
+    当前线程中最后一次 cmd() 的 stdout 和 stderr 输出
+    :rtype: str
+    """
+    step = getattr(_cmd_state, "step", None)
+    if step is None:
+        return ""
+    output = stdout_logger.get_step(step) + stderr_logger.get_step(step)
+    if max_bytes is not None:
+        output = output[-max_bytes:]
+    return output
+
+
+_console_lock = threading.Lock()
+# 多个步骤并行执行时, 同一时间只有一个线程向用户提问, 其他失败的步骤排队等待回答
+_prompt_lock = threading.Lock()
+
+
+def run_streaming(command, cwd, stdout_sink, stderr_sink, stats=None, **kwargs):
+    """
+    运行shell命令, 在本进程中通过非阻塞管道同时读取它的stdout和stderr,
+        一边读取一边输出到控制台并写入日志, 不需要额外的 tee 进程
+    命令启动的后台服务(比如 `service apache2 start` 启动的apache)可能会继承管道而一直不关闭它,
+        所以命令本身退出并且管道中已没有数据时, 就不再继续等待管道关闭
+    :type command: str
+    :param stats: 若提供, 会在其中填入 child_cpu(子进程消耗的CPU秒数) 和 output_bytes
+    :type stats: dict
+    :return: 命令真实的退出码
+    :rtype: int
+    """
+    if stats is None:
+        stats = {}
+    stats["output_bytes"] = 0
+    proc = subprocess.Popen(command, shell=True, cwd=cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    selector = selectors.DefaultSelector()
+    for pipe, console, sink in ((proc.stdout, sys.stdout, stdout_sink),
+                                (proc.stderr, sys.stderr, stderr_sink)):
+        fd = pipe.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        selector.register(pipe, selectors.EVENT_READ, (console, sink, decoder))
+
+    def _read(key):
+        """读取一次管道中已有的数据, 没有读到数据(暂时没有数据或者EOF)时返回False"""
+        try:
+            data = os.read(key.fd, 65536)
+        except BlockingIOError:
+            return False
+        console, sink, decoder = key.data
+        stats["output_bytes"] += len(data)
+        if not data:
+            selector.unregister(key.fileobj)
+            text = decoder.decode(b"", final=True)
+        else:
+            text = decoder.decode(data)
+        if text:
+            with _console_lock:
+                console.write(text)
+                console.flush()
+                sink.write(text)
+        return bool(data)
+
+    exit_status = None
+    try:
+        while selector.get_map():
+            events = selector.select(timeout=0.2)
+            for key, _ in events:
+                _read(key)
+            if not events:
+                exit_status = _wait_child(proc, block=False)
+                if exit_status is not None:
+                    # 命令已经退出, 把管道中剩余的数据读完就结束
+                    for key in list(selector.get_map().values()):
+                        while _read(key):
+                            pass
+                    break
+    finally:
+        selector.close()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if exit_status is None:
+        exit_status = _wait_child(proc)
+    stats["child_cpu"] = exit_status[1]
+    return exit_status[0]
+
+
+def _wait_child(proc, block=True):
+    """
+    用 os.wait4 回收子进程, 同时得到它(及其已回收的子进程)消耗的CPU时间
+    :type proc: subprocess.Popen
+    :return: (退出码, CPU秒数), 非阻塞模式下子进程仍在运行时返回 None
+    :rtype: tuple
+    """
+    pid, status, rusage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+    if not pid:
+        return None
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    proc.returncode = returncode  # 告诉 Popen 子进程已被回收
+    return returncode, rusage.ru_utime + rusage.ru_stime
+
 
 def cmd(command, cwd=None, no_tee=False, allow_failure=None, **kwargs):
     """运行shell命令
     :type command: str
     :type cwd: str
+    :param no_tee: 不捕获命令的输出, 直接输出到控制台
     :type no_tee: bool
     :type allow_failure: bool
     :rtype: bool
     """
-    global stdout_logger, stdout_logger_last
-
     infoprint("executing:", command)
 
-    stdout_logger_last = stdout_logger
-    stdout_logger = StdLogger()
-
-    stdout_logger.write("\n--------\nexecuting: " + command + "\n")
+    # 每个命令是日志中的一个步骤, 步骤可能在多个线程中并行执行
+    with _console_lock:
+        _cmd_counter[0] += 1
+        step = "#{} {}".format(_cmd_counter[0], command)
+    _cmd_state.step = step
+    stdout_sink = _StepSink(stdout_logger, step)
+    stderr_sink = _StepSink(stderr_logger, step)
 
-    if not no_tee:
-        command = "({cmd} | tee -a {stdout_file}) 3>&1 1>&2 2>&3 | tee -a {stderr_file}".format(
-            cmd=command, stdout_file=stdout_logger.file_path, stderr_file=stderr_logger.file_path,
-        )
+    stdout_sink.write("\n--------\nexecuting: " + command + "\n")
 
+    start_time = time()
+    stats = {"child_cpu": 0.0, "output_bytes": 0}
+    returncode = None
     try:
-        result = subprocess.check_call(
-            command,
-            shell=True,
-            cwd=cwd or os.getcwd(),
-            **kwargs)
-    except:
+        if no_tee:
+            proc = subprocess.Popen(command, shell=True, cwd=cwd or os.getcwd(), **kwargs)
+            returncode, stats["child_cpu"] = _wait_child(proc)
+        else:
+            returncode = run_streaming(command, cwd or os.getcwd(), stdout_sink, stderr_sink, stats, **kwargs)
+        stdout_sink.write("exit code: {}\n".format(returncode))
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+    except Exception:
+        profiler.add(command, "cmd", start_time, time(), ok=False, **stats)
         traceback.print_exc()
 
         if allow_failure is True:
@@ -236,27 +657,32 @@ def cmd(command, cwd=None, no_tee=False, allow_failure=None, **kwargs):
                               traceback_str=traceback.format_exc(),
                               msg="AllowedFailure"
                               )
-            except:
+            except Exception:
                 pass
             return False
 
         if allow_failure is None:
-            print()
-            errprint("command: \n    ", command, "\nerror, installation should be abort.")
-            choice = input("Do you want to continue installation anyway?(y/N) ")
+            if unattended:
+                errprint("command: \n    ", command, "\nerror, installation should be abort.")
+                raise
+            with _prompt_lock:
+                print()
+                errprint("command: \n    ", command, "\nerror, installation should be abort.")
+                choice = input("Do you want to continue installation anyway?(y/N) ")
             if choice in ("y", "Y", "yes", "Yes"):
                 infoprint("Installation continue...")
                 try:
                     onekey_report(report_type=REPORT_ERROR,
                                   traceback_str=traceback.format_exc(),
                                   msg="Continued")
-                except:
+                except Exception:
                     pass
                 return False
             else:
                 raise
         raise
     else:
+        profiler.add(command, "cmd", start_time, time(), **stats)
         return True
 
 
@@ -277,191 +703,3587 @@ def dump_settings(dump_file_path=DUMP_FILE_PATH):
         json.dump(settings, fw)
 
 
-try:
-    cmd('export LC_ALL=C.UTF-8')  # 设置bash环境为utf-8
+class AptPlanner:
+    """
+    汇总所有需要用 apt-get 安装的包, 合并成尽量少的 apt 事务
+        每次 commit() 最多只刷新一次索引(仅当索引过期时), 必须的包在一个事务中安装,
+        非必须的包在另一个允许失败的事务中安装
+    """
 
-    cmd('apt-get -y -q update && apt-get -y -q install python3 python3-pip')
+    def __init__(self):
+        self.required = []
+        self.optional = []
+        self.ppas = []
+        self.timings = []  # [(事务名, 耗时秒数, 是否成功), ...]
+        self._index_fresh = False  # apt索引是否是最新的
+
+    def require(self, *packages):
+        """添加必须安装的包"""
+        for package in packages:
+            if package not in self.required:
+                self.required.append(package)
+
+    def suggest(self, *packages):
+        """添加非必须的包, 安装失败不影响后续流程"""
+        for package in packages:
+            if package not in self.optional and package not in self.required:
+                self.optional.append(package)
+
+    def add_ppa(self, ppa):
+        """添加一个PPA源, 在下一次 commit() 时加入, 并使索引过期"""
+        if ppa not in self.ppas:
+            self.ppas.append(ppa)
+
+    def _timed_cmd(self, name, command, **kwargs):
+        start_time = time()
+        result = False
+        try:
+            result = cmd(command, **kwargs)
+        finally:
+            self.timings.append((name, time() - start_time, result))
+            infoprint("apt transaction [{}] took {:.1f}s".format(name, time() - start_time))
+        return result
+
+    @staticmethod
+    def installable(packages):
+        """
+        用一次 apt-cache policy 查询, 过滤掉在当前源中没有候选版本的包
+        :type packages: list
+        :rtype: list
+        """
+        try:
+            output = subprocess.check_output(
+                ["apt-cache", "policy"] + list(packages),
+                stderr=subprocess.DEVNULL, universal_newlines=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return list(packages)
+
+        available = set()
+        current = None
+        for line in output.splitlines():
+            if line and not line[0].isspace() and line.endswith(":"):
+                current = line[:-1]
+            elif current and line.strip().startswith("Candidate:") and "(none)" not in line:
+                available.add(current)
+        return [package for package in packages if package in available]
+
+    def commit(self, name="apt"):
+        """
+        执行已计划的 apt 事务
+        :return: 非必须的包是否全部安装成功
+        :rtype: bool
+        """
+        os.environ['DEBIAN_FRONTEND'] = "noninteractive"
 
-    # for some old version Linux, pip has bugs, causing:
-    # ImportError: cannot import name 'IncompleteRead'
-    # so we need to upgrade pip first
-    cmd('easy_install3 -U pip')
+        for ppa in self.ppas:
+            self._timed_cmd(
+                "{}:add-ppa".format(name),
+                "LC_ALL=C.UTF-8 add-apt-repository -y {ppa} && apt-key update".format(ppa=ppa)
+            )
+            self._index_fresh = False
+        self.ppas = []
+
+        if not self._index_fresh and (self.required or self.optional):
+            self._timed_cmd("{}:update".format(name), "apt-get -y -q update")
+            self._index_fresh = True
+
+        if self.required:
+            self._timed_cmd("{}:install".format(name),
+                            "apt-get -y -q install " + " ".join(self.required))
+            self.required = []
+
+        all_optional_installed = True
+        if self.optional:
+            optional = self.installable(self.optional)
+            if len(optional) != len(self.optional):
+                all_optional_installed = False
+                warnprint("apt packages not available, skipping:",
+                          " ".join(p for p in self.optional if p not in optional))
+            if optional and not self._timed_cmd("{}:install-optional".format(name),
+                                                "apt-get -y -q install " + " ".join(optional),
+                                                allow_failure=True):
+                # 整个事务失败了, 再逐个安装, 尽可能多装上一些
+                for package in optional:
+                    if not cmd("apt-get -y -q install " + package, allow_failure=True):
+                        all_optional_installed = False
+            self.optional = []
+
+        return all_optional_installed
+
+
+class InstallJournal:
+    """
+    安装步骤日志, 记录每个已完成的步骤及其输入的指纹
+        安装中断后重新运行时, 已完成并且输入没有变化的步骤会被跳过, 从第一个未完成的步骤继续
+        --force-step NAME 可以强制重新运行某个步骤
+    """
 
-    # 安装本脚本必须的python包
-    cmd('python3 -m pip install -U setuptools')
-    cmd('python3 -m pip install requests==2.11.0')
-    cmd('python3 -m pip install -U distro')
-except KeyboardInterrupt:
-    infoprint("Aborting...")
-    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
-    raise
-except:
-    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
-    raise
-try:
-    import distro
-except:
-    errprint("Could not import python package distro, abort installation")
-    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
-    raise
+    def __init__(self, path=JOURNAL_FILE_PATH, forced=()):
+        self.path = path
+        self.forced = set(forced)
+        self._lock = threading.Lock()
+        self.steps = {}  # 步骤名 -> {"fingerprint":, "time":}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as fr:
+                    self.steps = json.load(fr)["steps"]
+            except (OSError, ValueError, KeyError):
+                warnprint("Unable to load install journal {}, ignore".format(path))
+
+    @staticmethod
+    def fingerprint(inputs):
+        """
+        :param inputs: 步骤的输入, 可以是一个返回输入的函数, 在检查/记录的时刻才求值
+        :rtype: str
+        """
+        if callable(inputs):
+            inputs = inputs()
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def is_done(self, name, inputs):
+        if name in self.forced or "all" in self.forced:
+            return False
+        entry = self.steps.get(name)
+        return entry is not None and entry["fingerprint"] == self.fingerprint(inputs)
+
+    def record(self, name, inputs):
+        with self._lock:
+            self.steps[name] = {"fingerprint": self.fingerprint(inputs), "time": str(datetime.now())}
+            # 先写入临时文件再替换, 避免中断时留下损坏的日志
+            with open(self.path + ".tmp", "w", encoding="utf-8") as fw:
+                json.dump({"steps": self.steps}, fw, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+
+    def run(self, name, func, inputs):
+        """
+        若步骤已经完成则跳过, 否则运行它并记录
+            记录的是步骤完成之后的输入指纹, 所以输入中可以包含步骤本身产生的结果(比如某个文件夹是否存在)
+        :rtype: bool
+        :return: 是否真的运行了
+        """
+        if self.is_done(name, inputs):
+            infoprint("step [{}] was completed in {}, skipping".format(name, self.steps[name]["time"]))
+            return False
+        func()
+        self.record(name, inputs)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.steps = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+install_journal = InstallJournal(forced=force_steps)
+
+
+class StepScheduler:
+    """
+    把安装过程表示为一个由命名步骤组成的依赖图, 用线程池并行执行所有依赖已经满足的步骤
+        exclusive=True 的步骤(例如停止/启动Apache)会等其他正在运行的步骤全部结束后单独运行,
+        并且隐式地依赖于之前添加的所有排他步骤, 所以它们之间的先后顺序总是和添加顺序一致
+        提供了 inputs 的步骤会记录在 install_journal 中, 重新运行时已完成的步骤会被跳过
+    """
+
+    def __init__(self, max_workers=None):
+        self.steps = OrderedDict()  # name -> {"func":, "deps":, "exclusive":}
+        self.max_workers = max_workers or min(8, (os.cpu_count() or 1) + 4)
+        self._last_exclusive = None
+
+    def add(self, name, func, deps=(), exclusive=False, inputs=None):
+        """
+        添加一个步骤, 依赖的步骤必须已经被添加过
+        :type name: str
+        :type deps: list|tuple
+        :type exclusive: bool
+        :param inputs: 步骤的输入(或返回输入的函数), 为 None 时不记录到 install_journal, 每次都运行
+        :type inputs: dict
+        :return: 步骤名, 方便作为其他步骤的依赖
+        :rtype: str
+        """
+        if name in self.steps:
+            raise ValueError("Duplicated step: " + name)
+        deps = list(deps)
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError("Step {} depends on unknown step {}".format(name, dep))
+        if exclusive and self._last_exclusive and self._last_exclusive not in deps:
+            deps.append(self._last_exclusive)
+        if exclusive:
+            self._last_exclusive = name
+
+        self.steps[name] = {"func": func, "deps": deps, "exclusive": exclusive, "inputs": inputs}
+        return name
+
+    def _run_step(self, name):
+        start_time = time()
+        dbgprint("step started:", name)
+        step = self.steps[name]
+        try:
+            if step["inputs"] is None:
+                step["func"]()
+            elif not install_journal.run(name, step["func"], step["inputs"]):
+                return
+        except Exception:
+            profiler.add(name, "step", start_time, time(), ok=False)
+            raise
+        profiler.add(name, "step", start_time, time())
+        infoprint("step [{}] finished in {:.1f}s".format(name, time() - start_time))
+
+    def run(self):
+        """执行所有步骤, 任何一个步骤出错时, 等正在运行的步骤结束后抛出第一个异常"""
+        pending = list(self.steps)
+        finished = set()
+        running = {}  # future -> name
+        exclusive_running = False
+        first_error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if first_error is None and not exclusive_running:
+                    for name in list(pending):
+                        step = self.steps[name]
+                        if not all(dep in finished for dep in step["deps"]):
+                            continue
+                        if step["exclusive"]:
+                            # 排他步骤是一道屏障: 等所有正在运行的步骤结束后单独运行, 之后的步骤也不再提交
+                            if not running:
+                                pending.remove(name)
+                                running[executor.submit(self._run_step, name)] = name
+                                exclusive_running = True
+                            break
+                        pending.remove(name)
+                        running[executor.submit(self._run_step, name)] = name
+
+                if not running:
+                    if first_error is None and pending:
+                        raise RuntimeError("Unable to schedule steps: " + ", ".join(pending))
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if self.steps[name]["exclusive"]:
+                        exclusive_running = False
+                    exc = future.exception()
+                    if exc is not None:
+                        errprint("step [{}] failed: {}".format(name, exc))
+                        if first_error is None:
+                            first_error = future
+                    else:
+                        finished.add(name)
+
+        if first_error is not None:
+            first_error.result()  # 重新抛出异常
+
+
+apt_planner = AptPlanner()
+
+# 本脚本和zmirror必须的python包, 在一次pip运行中统一解析安装
+PIP_REQUIREMENTS = [
+    "setuptools",
+    "requests==2.11.0",
+    "distro",
+    "flask",
+]
+# 非必须, 但是有好处的python包, 其中 cchardet fastcache lru-dict 是C加速模块
+PIP_OPTIONAL_REQUIREMENTS = [
+    "chardet",
+    "cchardet",
+    "fastcache",
+    "lru-dict",
+]
+
+
+def pip_install(requirements, name="requirements", allow_failure=None, python="python3"):
+    """
+    把 requirements 写入一个清单文件, 用一次 pip 运行统一解析并安装
+        指定了 --wheelhouse 时, 先把所有包构建成wheel放入该文件夹(已有的wheel不会重新构建),
+        再从该文件夹安装; 离线模式下只从 wheelhouse 安装
+    :type requirements: list
+    :type name: str
+    :type allow_failure: bool
+    :rtype: bool
+    """
+    manifest = tempfile.NamedTemporaryFile(
+        mode='w', encoding='utf-8', suffix=".txt", prefix="zmirror_onekey_{}_".format(name), delete=False)
+    with manifest:
+        manifest.write("\n".join(requirements) + "\n")
+
+    if wheelhouse:
+        find_links = " --find-links {}".format(wheelhouse)
+        if offline:
+            find_links += " --no-index"
+    else:
+        find_links = ""
+
+    try:
+        if wheelhouse and not offline:
+            os.makedirs(wheelhouse, exist_ok=True)
+            # 构建失败不影响安装, 安装时会自动回退到从源码安装
+            cmd("{python} -m pip wheel -w {wheelhouse}{find_links} -r {manifest}".format(
+                python=python, wheelhouse=wheelhouse, find_links=find_links, manifest=manifest.name),
+                allow_failure=True)
+
+        install_cmd = "{python} -m pip install -U{find_links} ".format(python=python, find_links=find_links)
+        if cmd(install_cmd + "-r " + manifest.name, allow_failure=allow_failure):
+            return True
+
+        # 整体安装失败(只有 allow_failure=True 时会走到这里), 逐个安装, 尽可能多装上一些
+        result = True
+        for requirement in requirements:
+            if not cmd(install_cmd + '"{}"'.format(requirement), allow_failure=True):
+                result = False
+        return result
+    finally:
+        os.remove(manifest.name)
+
+
+server_configs = {
+    "apache": {
+        "config_root": "/etc/apache2/",
+        "htdoc": "/var/www/",
+        # let's encrypt webroot 验证文件所在的文件夹, 由 http 配置中的 Alias 提供
+        "acme_webroot": "/var/www/letsencrypt",
+        "service_name": "apache2",
+        "reload_command": "service apache2 reload",
+        "start_command": "service apache2 start",
+        "stop_command": "service apache2 stop",
+        "restart_command": "service apache2 restart",
+        "configtest_command": "apache2ctl configtest",
+        # 输出中包含当前配置的MPM
+        "version_command": "apache2ctl -V",
+
+        # 该服务器需要的 apt 包, 由 apt_planner 合并到同一个事务中安装
+        "apt_packages": ["apache2", "libapache2-mod-wsgi-py3"],
+        # ubuntu 下使用的PPA, 以获得支持http2的高版本Apache2
+        "ubuntu_ppa": "ppa:ondrej/apache2",
+
+        "common_configs": ["http_generic", "apache_boilerplate", "tls_profile", "mpm_event"],
+        "site_unique_configs": ["https"],
+
+        "pre_delete_files": [
+            "{config_root}/sites-enabled/000-default.conf",
+            "{config_root}/conf-enabled/apache2-doc.conf",
+            "{config_root}/conf-enabled/security.conf",
+        ],
+
+        "configs": {
+            "apache_boilerplate": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-boilerplate.conf"),
+                "file_path": "conf-enabled/zmirror-apache-boilerplate.conf",
+            },
+
+            "http_generic": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-http.conf"),
+                "file_path": "sites-enabled/zmirror-http-redirection.conf",
+                # 完全由本脚本生成, 每次安装时更新 (旧版本的配置中没有 webroot 验证需要的 Alias)
+                "overwrite": True,
+            },
+
+            "tls_profile": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-tls.conf"),
+                "file_path": "conf-enabled/zmirror-tls.conf",
+                # 缓存大小由本机内存和镜像数量计算, 每次安装时重新生成
+                "overwrite": True,
+            },
+
+            "mpm_event": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-mpm-event.conf"),
+                "file_path": "conf-enabled/zmirror-mpm-event.conf",
+                # 由本机资源和WSGI线程数计算, 每次安装时重新生成
+                "overwrite": True,
+            },
+
+            "https": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-https.conf"),
+                "file_path": "sites-enabled/zmirror-{mirror_name}-https.conf",
+            },
+        }
+
+    },
+
+    "nginx": {
+        "config_root": "/etc/nginx/",
+        "htdoc": "/var/www/",
+        "acme_webroot": "/var/www/letsencrypt",
+        "service_name": "nginx",
+        "reload_command": "service nginx reload",
+        "start_command": "service nginx start",
+        "stop_command": "service nginx stop",
+        "restart_command": "service nginx restart",
+        "configtest_command": "nginx -t",
+
+        "apt_packages": ["nginx"],
+        # 每个镜像由独立的 gunicorn 服务运行, nginx 通过Unix socket转发请求
+        "pip_packages": ["gunicorn"],
+        # 镜像的 systemd unit 文件所在的文件夹, 应用配置时同步这些服务
+        "app_units_dir": "/etc/systemd/system",
+
+        "common_configs": ["http_generic", "tls_profile"],
+        "site_unique_configs": ["https", "app_service"],
+
+        "pre_delete_files": [
+            "{config_root}/sites-enabled/default",
+        ],
+
+        "configs": {
+            "http_generic": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/nginx-http.conf"),
+                "file_path": "sites-enabled/zmirror-http-redirection.conf",
+                "overwrite": True,
+            },
+
+            # nginx.conf 的 http 中已经有 ssl_protocols 等指令, 重复会报错, 所以由每个https站点 include
+            "tls_profile": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/nginx-tls.conf"),
+                "file_path": "snippets/zmirror-tls.conf",
+                "overwrite": True,
+            },
+
+            "https": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/nginx-https.conf"),
+                "file_path": "sites-enabled/zmirror-{mirror_name}-https.conf",
+            },
+
+            # 绝对路径, 不在 config_root 中
+            "app_service": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/zmirror-gunicorn.service"),
+                "file_path": "/etc/systemd/system/zmirror-{mirror_name}.service",
+            },
+
+            # --runtime pypy 时, gunicorn 的配置文件, 在worker接受请求之前预热JIT
+            "app_warmup": {
+                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/zmirror-gunicorn-warmup.py"),
+                "file_path": "/var/www/{mirror_name}/gunicorn_warmup.py",
+            },
+        }
+    },
+}
+
+if server_name not in server_configs:
+    errprint("--server must be one of {}, got: {}".format(", ".join(server_configs), server_name))
+    exit(3)
+this_server = server_configs[server_name]
+if runtime == "pypy":
+    this_server["site_unique_configs"].append("app_warmup")
+
+# weight: 镜像的相对负载, 用于分配WSGI进程和线程, 以及请求超时时间 (视频镜像的请求更多, 响应时间更长)
+mirrors_settings = {
+    'google': {
+        'domain': None,
+        "weight": 2,
+        'cfg': [('more_configs/config_google_and_zhwikipedia.py', 'config.py'), ],
+        "certs": {
+            "private_key": None,
+            "cert": None,
+            "intermediate": None,
+        },
+        "installed_path": "",
+    },
+
+    'youtubePC': {
+        'domain': None,
+        "weight": 3,
+        'cfg': [('more_configs/config_youtube.py', 'config.py'),
+                ('more_configs/custom_func_youtube.py', 'custom_func.py')],
+        "certs": {},
+        "installed_path": "",
+    },
+
+    'youtubeMobile': {
+        'domain': None,
+        "weight": 3,
+        'cfg': [('more_configs/config_youtube_mobile.py', 'config.py'),
+                ('more_configs/custom_func_youtube.py', 'custom_func.py')],
+        "certs": {},
+        "installed_path": "",
+    },
+
+    'twitterPC': {
+        'domain': None,
+        "weight": 1,
+        'cfg': [('more_configs/config_twitter_pc.py', 'config.py'),
+                ('more_configs/custom_func_twitter.py', 'custom_func.py'), ],
+        "certs": {},
+        "installed_path": "",
+    },
+
+    'twitterMobile': {
+        'domain': None,
+        "weight": 1,
+        'cfg': [('more_configs/config_twitter_mobile.py', 'config.py'),
+                ('more_configs/custom_func_twitter.py', 'custom_func.py'), ],
+        "certs": {},
+        "installed_path": "",
+    },
+
+    'instagram': {
+        'domain': None,
+        "weight": 1,
+        'cfg': [('more_configs/config_instagram.py', 'config.py'), ],
+        "certs": {},
+        "installed_path": "",
+    },
+}
+
+# ################# 无人值守安装 ####################
+# 使用 --answers answers.json|yaml 提供所有设置, 安装过程中不会再有任何交互
+answers_file = get_argv_value("--answers")
+# 只在已经安装过的主机上运行的任务(比如自动更新证书), 不安装任何包, 同样不能有任何交互
+maintenance_only = renew_certs or cert_status or tls_benchmark or worker_benchmark
+unattended = answers_file is not None or maintenance_only
+# 只有完整的安装才使用安装日志: 日志只在完整安装结束时才会被清除,
+#     其他运行(比如 --upgrade-only)记录的步骤会一直留在日志中, 让之后的安装错误地跳过它们
+full_install = not (upgrade_only or maintenance_only)
+
+
+def clean_domain(domain):
+    """修剪用户输入的域名"""
+    return domain.strip(' /.\t').replace('https://', '').replace('http://', '')
+
+
+def incomplete_install_mirrors():
+    """
+    上一次中断了的安装中的镜像: 安装日志中已经部署了的, 以及保存的设置中将要安装的
+        这些镜像的文件夹已经存在是正常的, 重新运行时会从中断的地方继续
+    :rtype: set
+    """
+    mirrors = set(name[len("mirror:deploy:"):] for name in install_journal.steps if name.startswith("mirror:deploy:"))
+    try:
+        with open(DUMP_FILE_PATH, "r", encoding="utf-8") as fr:
+            mirrors.update(json.load(fr)["mirrors_to_deploy"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return mirrors
+
+
+def load_answers(path):
+    """
+    读取应答文件, 并在安装开始前检查其中所有的设置, 有错误时列出全部错误并退出
+    应答文件的格式:
+        {
+            "mirrors": {"google": {"domain": "g.example.com",
+                                   "certs": {"private_key": "", "cert": "", "intermediate": ""}}},
+            "email": "you@example.com",
+            "question": {"name": "", "answer": "", "hint": ""},  # 可选
+            "allow_non_third_level_domain": false  # 可选
+        }
+        其中 certs 仅在 --i-have-cert 时需要
+    :type path: str
+    :rtype: dict
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as fr:
+            text = fr.read()
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            answers = yaml.safe_load(text)
+        else:
+            answers = json.loads(text)
+    except ImportError:
+        errprint("Reading a YAML answers file requires PyYAML (apt-get install python3-yaml), "
+                 "or please use a JSON answers file")
+        exit(4)
+    except Exception as e:
+        errprint("Unable to read answers file {}: {}".format(path, e))
+        exit(4)
+
+    errors = []
+    if not isinstance(answers, dict):
+        errprint("Answers file {} should contain a mapping".format(path))
+        exit(4)
+
+    mirrors = answers.get("mirrors")
+    if not isinstance(mirrors, dict) or not mirrors:
+        errors.append("`mirrors` should be a non-empty mapping of mirror name to its settings")
+        mirrors = {}
+
+    domains = {}
+    resumable = incomplete_install_mirrors()
+    for mirror, settings in mirrors.items():
+        if mirror not in mirrors_settings:
+            errors.append("unknown mirror `{}`, available: {}".format(mirror, ", ".join(mirrors_settings)))
+            continue
+        if os.path.exists(os.path.join(this_server["htdoc"], mirror)) and mirror not in resumable:
+            errors.append("mirror `{}` was already installed, please use --upgrade-only".format(mirror))
+        if not isinstance(settings, dict) or not settings.get("domain"):
+            errors.append("mirror `{}` requires a `domain`".format(mirror))
+            continue
+
+        domain = clean_domain(settings["domain"])
+        settings["domain"] = domain
+        if domain.count('.') != 2 and not answers.get("allow_non_third_level_domain"):
+            errors.append("domain [{}] of mirror `{}` is not an third-level domain, "
+                          "set `allow_non_third_level_domain` to use it anyway".format(domain, mirror))
+        if wildcard and wildcard_of(domain) is None:
+            errors.append("domain [{}] of mirror `{}` has no parent domain for a --wildcard cert, "
+                          "use a subdomain like g.example.com".format(domain, mirror))
+        if domain in domains:
+            errors.append("Duplicated domain [{}]! conflict between mirror `{}` and `{}`".format(
+                domain, mirror, domains[domain]))
+        domains[domain] = mirror
+
+        if already_have_cert:
+            certs = settings.get("certs") or {}
+            for key in ("private_key", "cert", "intermediate"):
+                if not certs.get(key) or not os.path.exists(certs[key]):
+                    errors.append("mirror `{}` certs.{}: file {} does not exist".format(
+                        mirror, key, certs.get(key)))
+
+    if not already_have_cert and "@" not in (answers.get("email") or ""):
+        errors.append("a valid `email` is required, because letsencrypt requires an email for certification")
+
+    _question = answers.get("question")
+    if _question is not None:
+        if not isinstance(_question, dict) or not _question.get("name") or not _question.get("answer"):
+            errors.append("`question` should contain non-blank `name` and `answer`")
+
+    if errors:
+        errprint("Invalid answers file:", path)
+        for error in errors:
+            errprint("    " + error)
+        exit(4)
+
+    return answers
+
+
+if answers_file is not None:
+    answers = load_answers(answers_file)
+    for mirror, settings in answers["mirrors"].items():
+        mirrors_to_deploy.append(mirror)
+        if os.path.exists(os.path.join(this_server["htdoc"], mirror)):
+            # 继续上一次中断了的安装, 与交互模式下选择继续时相同, 未完成的镜像会被重新安装
+            infoprint("Resuming the incomplete install of mirror:", mirror)
+            loaded_config = True
+        mirrors_settings[mirror]["domain"] = settings["domain"]
+        if already_have_cert:
+            mirrors_settings[mirror]["certs"] = {
+                "private_key": settings["certs"]["private_key"],
+                "cert": settings["certs"]["cert"],
+                "intermediate": settings["certs"]["intermediate"],
+            }
+    email = answers.get("email") or ""
+    if answers.get("question"):
+        question = {
+            "name": answers["question"]["name"],
+            "answer": answers["question"]["answer"],
+            "hint": answers["question"].get("hint") or "",
+        }
+        need_answer_question = True
+    infoprint("Unattended install, mirrors:", ",".join(mirrors_to_deploy))
+
+if offline and not wheelhouse:
+    errprint("--offline requires --wheelhouse DIR, which contains the prebuilt wheels")
+    exit(3)
+if cert_mode not in ("san", "separate"):
+    errprint("--cert-mode must be `san` or `separate`, got:", cert_mode)
+    exit(3)
+if acme_challenge not in ("webroot", "standalone"):
+    errprint("--acme-challenge must be `webroot` or `standalone`, got:", acme_challenge)
+    exit(3)
+if cert_key_type not in ("rsa", "ecdsa", "dual"):
+    errprint("--cert-key-type must be `rsa`, `ecdsa` or `dual`, got:", cert_key_type)
+    exit(3)
+if acme_client_name not in ("certbot", "native"):
+    errprint("--acme-client must be `certbot` or `native`, got:", acme_client_name)
+    exit(3)
+if wildcard and not (dns_hook and os.access(dns_hook, os.X_OK)):
+    errprint("--wildcard requires --dns-hook SCRIPT, an executable DNS-01 hook, got:", dns_hook)
+    exit(3)
+if acme_client_name == "native" and acme_challenge != "webroot":
+    errprint("--acme-client native only supports --acme-challenge webroot")
+    exit(3)
+
+WORKER_MODELS = ("thread", "gevent")
+# 镜像名 -> 工作模型, "" 为所有镜像的默认值
+worker_models = {"": "thread"}
+for value in worker_model_args:
+    mirror, _, model = value.rpartition("=")
+    if model not in WORKER_MODELS or (mirror and mirror not in mirrors_settings):
+        errprint("--worker-model must be `thread`, `gevent` or `MIRROR=MODEL`, got:", value)
+        exit(3)
+    worker_models[mirror] = model
+if "gevent" in worker_models.values() and server_name != "nginx":
+    errprint("--worker-model gevent requires --server nginx, mod_wsgi only supports threads")
+    exit(3)
+if runtime not in ("cpython", "pypy"):
+    errprint("--runtime must be `cpython` or `pypy`, got:", runtime)
+    exit(3)
+if runtime == "pypy" and server_name != "nginx":
+    errprint("--runtime pypy requires --server nginx, mod_wsgi is built for the system CPython")
+    exit(3)
+
+
+def mirror_worker_model(mirror):
+    """
+    镜像的工作模型
+    :rtype: str
+    """
+    return worker_models.get(mirror, worker_models[""])
+
+
+def server_pip_packages():
+    """
+    服务器需要的 python 包, 有镜像使用 gevent 时加上 gevent
+    :rtype: list
+    """
+    packages = list(this_server.get("pip_packages", []))
+    if "gevent" in worker_models.values():
+        packages.append("gevent")
+    return packages
+
+
+BOOTSTRAP_APT_PACKAGES = ['python3', 'python3-pip', 'git', 'wget', 'curl']
+# software-properties-common 提供 add-apt-repository, 安装了才能使用PPA
+BOOTSTRAP_APT_OPTIONAL_PACKAGES = ['openssl', 'software-properties-common', 'python-software-properties']
+
+
+def bootstrap_system_packages():
+    """一次性安装本脚本和后续步骤必须的系统包"""
+    apt_planner.require(*BOOTSTRAP_APT_PACKAGES)
+    apt_planner.suggest(*BOOTSTRAP_APT_OPTIONAL_PACKAGES)
+    apt_planner.commit("bootstrap")
+
+
+def bootstrap_python_packages():
+    # for some old version Linux, pip has bugs, causing:
+    # ImportError: cannot import name 'IncompleteRead'
+    # so we need to upgrade pip first
+    if not offline:
+        cmd('easy_install3 -U pip')
+
+    # 一次性安装本脚本和zmirror需要的所有python包
+    pip_install(PIP_REQUIREMENTS, name="requirements")
+    # 非必须, 但是有好处的python包(主要是C加速模块), 允许失败
+    pip_install(PIP_OPTIONAL_REQUIREMENTS, name="optional", allow_failure=True)
+
+
+if full_install and install_journal.steps:
+    infoprint("Found install journal with {} completed step(s), "
+              "completed steps will be skipped (use --force-step NAME to re-run one)".format(len(install_journal.steps)))
+
+profiler.phase("bootstrap")
+try:
+    cmd('export LC_ALL=C.UTF-8')  # 设置bash环境为utf-8
+
+    # 更新证书和查看证书状态只会在已经安装过的主机上运行, 不需要(也不应该在cron任务中)安装或升级任何包
+    if full_install:
+        install_journal.run("bootstrap:apt", bootstrap_system_packages,
+                            inputs={"required": BOOTSTRAP_APT_PACKAGES, "optional": BOOTSTRAP_APT_OPTIONAL_PACKAGES})
+        install_journal.run("bootstrap:pip", bootstrap_python_packages,
+                            inputs={"required": PIP_REQUIREMENTS, "optional": PIP_OPTIONAL_REQUIREMENTS,
+                                    "wheelhouse": wheelhouse, "offline": offline})
+    elif not maintenance_only:
+        bootstrap_system_packages()
+        bootstrap_python_packages()
+except KeyboardInterrupt:
+    infoprint("Aborting...")
+    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+    raise
+except:
+    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+    raise
+try:
+    import distro
+except:
+    errprint("Could not import python package distro, abort installation")
+    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+    raise
+
+try:
+    import requests
+except:
+    errprint('Could not install requests, program exit')
+    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+    raise
+
+infoprint('OneKey deploy script for zmirror. version', __VERSION__)
+infoprint('This script will automatically deploy mirror(s) using zmirror in your ubuntu')
+infoprint('You could cancel this script in the config stage by precessing Ctrl-C')
+infoprint('Installation will start after 1 second')
+print()
+sleep(1)
+# ################# 源码缓存 ################
+# zmirror 和 certbot 的代码都从 SOURCE_CACHE_DIR 中的git裸仓库获取:
+#     第一次使用时从上游克隆裸仓库, 之后每次运行最多从上游fetch一次,
+#     各个工作副本(共享代码, 旧版本的完整拷贝, /etc/certbot)都从本地的裸仓库更新, 不再重复下载
+SOURCE_REPOS = OrderedDict([
+    # depth 为 None 表示完整历史, 这样旧版本的完整拷贝总是可以快进合并
+    ("zmirror", {"url": __ZMIRROR_GIT_URL__, "branch": "master", "depth": None}),
+    # certbot 的完整历史很大, 并且 /etc/certbot 只由本脚本管理, 所以只保留最新一个提交
+    ("certbot", {"url": "https://github.com/certbot/certbot.git", "branch": "master", "depth": 1}),
+])
+
+
+class SourceCache:
+    """
+    本地git裸仓库缓存
+        同一次运行中每个仓库只会从上游fetch一次, 并发的步骤会等待同一次fetch
+        离线模式下不访问上游, 只使用缓存中已有的内容
+    """
+
+    def __init__(self, root=SOURCE_CACHE_DIR, repos=SOURCE_REPOS):
+        self.root = root
+        self.repos = repos
+        self._fetched = set()
+        self._locks = {name: threading.Lock() for name in repos}
+
+    def bare_path(self, name):
+        return os.path.join(self.root, name + ".git")
+
+    def _depth_arg(self, name):
+        depth = self.repos[name]["depth"]
+        return "--depth={} ".format(depth) if depth else ""
+
+    def seed(self, tarball):
+        """
+        从tar包填充缓存, tar包中的顶层文件夹应为 <仓库名>.git, 可以用下面的命令从已有的缓存生成:
+            tar -C /var/cache/zmirror-onekey -czf zmirror-onekey-sources.tar.gz zmirror.git certbot.git
+        缓存中已经存在的仓库会从tar包中的仓库fetch更新, 而不是被覆盖
+        """
+        os.makedirs(self.root, exist_ok=True)
+        extract_dir = tempfile.mkdtemp(prefix="seed-", dir=self.root)
+        try:
+            with tarfile.open(tarball) as tar:
+                members = [m for m in tar.getmembers()
+                           if not os.path.isabs(m.name) and ".." not in m.name.split("/")]
+                tar.extractall(extract_dir, members=members)
+            for name in self.repos:
+                seeded = os.path.join(extract_dir, name + ".git")
+                if not os.path.isdir(seeded):
+                    continue
+                if os.path.isdir(self.bare_path(name)):
+                    branch = self.repos[name]["branch"]
+                    cmd('git fetch "{}" +refs/heads/{b}:refs/heads/{b}'.format(seeded, b=branch),
+                        cwd=self.bare_path(name))
+                else:
+                    os.replace(seeded, self.bare_path(name))
+                infoprint("Source cache seeded:", name)
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+    def ensure(self, name):
+        """
+        保证裸仓库存在, 并且在本次运行中已经从上游fetch过
+        :return: 裸仓库的路径
+        :rtype: str
+        """
+        repo = self.repos[name]
+        bare = self.bare_path(name)
+        with self._locks[name]:
+            if name in self._fetched:
+                return bare
+            if not os.path.isdir(bare):
+                if offline:
+                    raise RuntimeError("Source {} is not in the cache {}, "
+                                       "please seed it with --seed-sources".format(name, self.root))
+                os.makedirs(self.root, exist_ok=True)
+                # 先克隆到临时文件夹, 中断时不会留下不完整的缓存
+                tmp = bare + ".tmp"
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+                cmd('git clone --bare {}--branch {} {} "{}"'.format(
+                    self._depth_arg(name), repo["branch"], repo["url"], tmp), cwd=self.root)
+                os.replace(tmp, bare)
+            elif not offline:
+                cmd('git fetch {}origin +refs/heads/{b}:refs/heads/{b}'.format(
+                    self._depth_arg(name), b=repo["branch"]), cwd=bare)
+            self._fetched.add(name)
+        return bare
+
+    def checkout(self, name, dest, discard_local=False, allow_failure=None):
+        """
+        从缓存中创建或更新一个工作副本
+            新的副本的 origin 仍然指向上游, 所以在其中手动执行 git pull 也可以正常工作
+        :param discard_local: 是否丢弃副本中对已跟踪文件的修改 (只用于完全由本脚本管理的副本)
+        :type dest: str
+        :param allow_failure: 传递给更新副本的 cmd()
+        """
+        repo = self.repos[name]
+        bare = self.ensure(name)
+        if os.path.isdir(os.path.join(dest, ".git")):
+            cmd('git fetch {}"{}" {}'.format(self._depth_arg(name), bare, repo["branch"]),
+                cwd=dest, allow_failure=allow_failure)
+            if discard_local:
+                cmd("git reset -q --hard FETCH_HEAD", cwd=dest, allow_failure=allow_failure)
+            else:
+                cmd("git merge --ff-only FETCH_HEAD", cwd=dest, allow_failure=allow_failure)
+            return
+        if os.path.exists(dest):  # 不完整的副本(可能是上一次安装未完成的残留), 移除掉
+            shutil.rmtree(dest)
+        parent, folder = os.path.split(os.path.normpath(dest))
+        os.makedirs(parent, exist_ok=True)
+        cmd('git clone --branch {} "{}" "{}"'.format(repo["branch"], bare, folder), cwd=parent)
+        cmd("git remote set-url origin {}".format(repo["url"]), cwd=dest)
+
+
+source_cache = SourceCache()
+if source_seed:
+    try:
+        source_cache.seed(source_seed)
+    except Exception:
+        errprint("Unable to seed the source cache from", source_seed)
+        onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+        raise
+
+# ################# 共享的zmirror代码 ################
+# 所有镜像共用同一份zmirror代码 (/var/www/zmirror), 每个镜像的文件夹只是它的一个"薄覆盖层":
+#     代码文件是指向共享代码的硬链接(同一个inode, 操作系统只需缓存一份),
+#     只有 config.py custom_func.py wsgi.py 等是每个镜像自己的真实文件
+#     子文件夹也是每个镜像自己的, 所以zmirror运行时产生的缓存/数据文件不会互相影响
+OVERLAY_MARKER = ".zmirror-onekey-overlay"
+# 每个镜像自己的文件, 只在不存在时创建, 升级时不会覆盖
+OVERLAY_PRESERVED_FILES = ["config.py", "custom_func.py"]
+# 每个镜像自己的真实拷贝, 升级时从共享代码刷新
+OVERLAY_COPIED_FILES = ["wsgi.py"]
+# 不链接到覆盖层中的文件夹
+OVERLAY_SKIP_DIRS = [".git"]
+
+
+def _link_or_copy(src, dst):
+    """用硬链接原子地替换 dst, 跨文件系统等无法硬链接时退回为复制"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return  # 已经是同一个文件 (注意: rename 两个指向同一inode的链接时什么都不会做)
+    tmp = dst + ".zmirror-onekey-tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def link_overlay(shared_folder, mirror_folder, preserved=(), owner="www-data"):
+    """
+    创建或刷新一个镜像的覆盖层
+        preserved 中的文件(以及 OVERLAY_PRESERVED_FILES)属于镜像自己, 已存在时不会被改动
+        上一次链接过, 但共享代码中已经不存在的文件会被删除
+    :type shared_folder: str
+    :type mirror_folder: str
+    :param preserved: 相对于镜像文件夹的路径
+    :type preserved: list
+    """
+    preserved = set(OVERLAY_PRESERVED_FILES) | set(preserved)
+    marker_path = os.path.join(mirror_folder, OVERLAY_MARKER)
+    old_linked = set()
+    if os.path.exists(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as fr:
+            old_linked = set(json.load(fr)["linked"])
+
+    try:
+        import pwd
+        uid, gid = pwd.getpwnam(owner).pw_uid, pwd.getpwnam(owner).pw_gid
+    except KeyError:
+        uid = gid = None
+
+    linked = []
+    for root, dirs, files in os.walk(shared_folder):
+        dirs[:] = [d for d in dirs if d not in OVERLAY_SKIP_DIRS]
+        rel_root = os.path.relpath(root, shared_folder)
+        target_root = os.path.normpath(os.path.join(mirror_folder, rel_root))
+        if not os.path.isdir(target_root):
+            os.makedirs(target_root)
+        if uid is not None:
+            # 文件夹属于 www-data, zmirror可以在其中写入缓存等文件; 链接的代码文件仍然属于root, 只读
+            os.chown(target_root, uid, gid)
+
+        for name in files:
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            src, dst = os.path.join(root, name), os.path.join(target_root, name)
+            if rel_path in preserved:
+                if not os.path.exists(dst):
+                    shutil.copy2(src, dst)
+                    if uid is not None:
+                        os.chown(dst, uid, gid)
+            elif rel_path in OVERLAY_COPIED_FILES:
+                shutil.copy2(src, dst + ".zmirror-onekey-tmp")
+                os.replace(dst + ".zmirror-onekey-tmp", dst)
+            elif os.path.islink(src):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.readlink(src), dst)
+                linked.append(rel_path)
+            else:
+                _link_or_copy(src, dst)
+                linked.append(rel_path)
+
+    for rel_path in old_linked - set(linked):
+        try:
+            os.remove(os.path.join(mirror_folder, rel_path))
+        except OSError:
+            pass
+
+    with open(marker_path, "w", encoding="utf-8") as fw:
+        json.dump({"shared_folder": shared_folder, "linked": linked}, fw)
+
+
+def is_overlay(mirror_folder):
+    return os.path.exists(os.path.join(mirror_folder, OVERLAY_MARKER))
+
+
+# ################# 配置事务 ################
+# 配置文件的修改先暂存, 最后作为一个整体应用: configtest 通过后平滑重载, 健康检查失败则回滚
+#     不需要重启服务器, 正在处理的请求不会被中断 (更换MPM等只能由完全重启应用的修改除外, 见 ApacheConfigTransaction)
+CONFIG_STAGE_DIR = "/var/lib/zmirror-onekey/staged"
+CONFIG_BACKUP_DIR = "/var/backups/zmirror-onekey/" + server_name
+
+
+def zmirror_https_sites():
+    """
+    本机已启用的zmirror https站点的域名
+    :rtype: list
+    """
+    sites_folder = os.path.join(this_server['config_root'], "sites-enabled")
+    domains = []
+    if os.path.isdir(sites_folder):
+        for filename in sorted(os.listdir(sites_folder)):
+            if filename.startswith("zmirror-") and filename.endswith("-https.conf"):
+                with open(os.path.join(sites_folder, filename), "r", encoding="utf-8") as fr:
+                    domains += re.findall(r"^\s*(?:ServerName|server_name)\s+([^\s;]+)", fr.read(), re.M)
+    return domains
+
+
+def server_health_check(domains, host="127.0.0.1", timeout=15):
+    """
+    检查重载之后的服务器: 80端口能返回HTTP响应, 每个https站点都能以其域名(SNI)完成TLS握手
+        重载是异步完成的, 所以在 timeout 秒内反复检查
+    :return: 最后一次检查发现的问题, 为空表示健康
+    :rtype: list
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    def check():
+        problems = []
+        try:
+            with socket.create_connection((host, 80), timeout=5) as sock:
+                sock.sendall("HEAD / HTTP/1.0\r\nHost: {}\r\n\r\n".format(
+                    domains[0] if domains else "localhost").encode("ascii"))
+                if not sock.recv(16).startswith(b"HTTP/"):
+                    problems.append("port 80: invalid response")
+        except Exception as e:
+            problems.append("port 80: {}".format(e))
+        for domain in domains:
+            try:
+                with socket.create_connection((host, 443), timeout=5) as sock:
+                    context.wrap_socket(sock, server_hostname=domain).close()
+            except Exception as e:
+                problems.append("{}:443: {}".format(domain, e))
+        return problems
+
+    deadline = time() + timeout
+    while True:
+        problems = check()
+        if not problems or time() > deadline:
+            return problems
+        sleep(0.5)
+
+
+def sync_app_units(units_dir, changed=()):
+    """
+    让 systemd 中运行的镜像应用服务(zmirror-*.service)与 units_dir 中的unit文件一致
+        unit文件有变化的服务重启, 其余正在运行的服务平滑重载(gunicorn 收到HUP后逐个替换worker), 没有运行的启动
+        unit文件已经被删除(比如回滚)的服务停止
+    :param changed: 本次修改了的文件
+    """
+    cmd("systemctl daemon-reload")
+    units = sorted(filename for filename in os.listdir(units_dir) if re.match(r"zmirror-.+\.service$", filename))
+    for unit in units:
+        action = "restart" if os.path.join(units_dir, unit) in changed else "reload-or-restart"
+        cmd("systemctl enable -q {unit} && systemctl {action} {unit}".format(unit=unit, action=action))
+    try:
+        loaded = subprocess.check_output(["systemctl", "list-units", "--all", "--plain", "--no-legend",
+                                          "zmirror-*.service"],
+                                         stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+    except (OSError, subprocess.CalledProcessError):
+        return
+    for line in loaded.splitlines():
+        if line.split() and line.split()[0] not in units:
+            cmd("systemctl stop " + line.split()[0], allow_failure=True)
+
+
+class ConfigTransaction:
+    """
+    事务式地修改服务器的配置文件
+        write() remove() 只把修改暂存在 stage_dir 中 (nginx 会加载 sites-enabled 中的所有文件, 所以不能放在目标文件旁边),
+            暂存在磁盘上, 所以安装中断后重新运行也不会丢失
+        link() 暂存一个符号链接 (比如 mods-enabled 中启用的模块)
+        commit() 备份旧文件, 逐个原子地替换, 然后 configtest, 平滑重载, 健康检查,
+            任何一步失败都恢复备份的文件并再次平滑重载; 暂存的修改保留下来,
+            因为生成它们的步骤已经记录在 install_journal 中, 重新运行时由 server:apply 再次提交
+        正在运行的服务器只在重载时才读取配置文件, 所以替换之后再 configtest 不会影响正在处理的请求
+        平滑重载无法应用的修改(由子类的 _needs_restart() 判断), 用完全重启代替重载, 同样由健康检查和回滚保护
+    """
+    REMOVE_SUFFIX = ".zmirror-remove"
+    TEMP_SUFFIX = ".zmirror-new"
+
+    def __init__(self, server, stage_dir=CONFIG_STAGE_DIR, backup_dir=CONFIG_BACKUP_DIR):
+        self.server = server
+        self.stage_dir = stage_dir
+        self.backup_dir = backup_dir
+        self._lock = threading.Lock()
+
+    def staged_path(self, path):
+        """目标文件暂存的位置"""
+        return os.path.join(self.stage_dir, os.path.abspath(path).lstrip("/"))
+
+    def _unstage(self, staged_path):
+        """删除 staged_path 上已经暂存的修改"""
+        for stale in (staged_path, staged_path + self.REMOVE_SUFFIX):
+            if os.path.lexists(stale):
+                os.remove(stale)
+
+    def write(self, path, content):
+        """暂存一个配置文件的新内容"""
+        staged_path = self.staged_path(path)
+        with self._lock:
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            self._unstage(staged_path)
+            with open(staged_path, "w", encoding="utf-8") as fw:
+                fw.write(content)
+
+    def link(self, path, target):
+        """
+        暂存一个指向 target 的符号链接
+        :param target: 链接的内容, 相对路径相对于 path 所在的文件夹
+        """
+        staged_path = self.staged_path(path)
+        with self._lock:
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            self._unstage(staged_path)
+            os.symlink(target, staged_path)
+
+    def remove(self, path):
+        """暂存一个配置文件的删除"""
+        staged_path = self.staged_path(path)
+        with self._lock:
+            self._unstage(staged_path)
+            if os.path.lexists(path):
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                open(staged_path + self.REMOVE_SUFFIX, "w").close()
+
+    def staged(self):
+        """
+        :return: 目标文件 -> 暂存的新文件, 删除时为 None
+        :rtype: dict
+        """
+        staged = {}
+        for folder, dirs, files in os.walk(self.stage_dir):
+            # 暂存的符号链接可能恰好指向一个文件夹
+            for filename in files + [name for name in dirs if os.path.islink(os.path.join(folder, name))]:
+                staged_path = os.path.join(folder, filename)
+                path = "/" + os.path.relpath(staged_path, self.stage_dir)
+                if filename.endswith(self.REMOVE_SUFFIX):
+                    staged[path[:-len(self.REMOVE_SUFFIX)]] = None
+                else:
+                    staged[path] = staged_path
+        return staged
+
+    @classmethod
+    def _replace(cls, source, path):
+        """用 source 的内容原子地替换 path (source 与 path 可能不在同一个文件系统中), source 是符号链接时复制链接本身"""
+        tmp = path + cls.TEMP_SUFFIX
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), tmp)
+        else:
+            shutil.copy2(source, tmp)
+        os.replace(tmp, path)
+
+    def _switch(self, staged, backups):
+        """
+        备份并替换所有暂存的文件, 暂存的文件保留到提交成功之后
+        :param backups: 逐个填入 目标文件 -> 备份文件(原来不存在时为 None), 中途出错时也包含已经替换了的文件
+        :type backups: dict
+        """
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+        for path, staged_path in sorted(staged.items()):
+            backup = None
+            if os.path.lexists(path):
+                backup = os.path.join(self.backup_dir, path.lstrip("/"))
+                os.makedirs(os.path.dirname(backup), exist_ok=True)
+                shutil.copy2(path, backup, follow_symlinks=False)
+            backups[path] = backup
+            if staged_path is None:
+                if os.path.lexists(path):
+                    os.remove(path)
+                dbgprint("deleted:", path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._replace(staged_path, path)
+                dbgprint("switched:", path)
+
+    def _discard(self, staged):
+        """提交成功后删除已经应用了的暂存文件"""
+        for path, staged_path in staged.items():
+            os.remove(staged_path if staged_path is not None else self.staged_path(path) + self.REMOVE_SUFFIX)
+
+    def _restore(self, backups):
+        for path, backup in backups.items():
+            if backup is None:
+                if os.path.lexists(path):
+                    os.remove(path)
+            else:
+                self._replace(backup, path)
+            dbgprint("restored:", path)
+
+    def _configtest(self):
+        try:
+            cmd(self.server['configtest_command'], allow_failure=False)
+        except subprocess.CalledProcessError:
+            raise RuntimeError("configtest failed:\n" + last_cmd_output(max_bytes=4096))
+
+    def _needs_restart(self, staged):
+        """
+        这些暂存的修改是否需要完全重启服务器才能生效
+        :param staged: staged() 的结果
+        :rtype: bool
+        """
+        return False
+
+    def _restarted(self):
+        """完全重启成功之后调用, 子类可以记录重启后加载的配置"""
+
+    def _reload(self, changed=(), restart=False):
+        """先同步镜像的应用服务, 再平滑重载(或完全重启)服务器, 服务器没有在运行时则启动它"""
+        if self.server.get("app_units_dir"):
+            sync_app_units(self.server["app_units_dir"], changed)
+        if not cmd(self.server['restart_command' if restart else 'reload_command'], allow_failure=True):
+            cmd(self.server['start_command'], allow_failure=False)
+        if restart:
+            self._restarted()
+
+    def commit(self):
+        """应用所有暂存的修改, 失败时回滚并抛出异常"""
+        with self._lock:
+            staged = self.staged()
+            restart = self._needs_restart(staged)
+            infoprint("Applying {} {} config change(s){}".format(
+                len(staged), self.server['service_name'], ", with a full restart" if restart else ""))
+            backups = OrderedDict()
+            try:
+                self._switch(staged, backups)
+                self._configtest()
+                self._reload(changed=backups, restart=restart)
+                problems = server_health_check(zmirror_https_sites())
+                if problems:
+                    raise RuntimeError("Health check failed:\n    " + "\n    ".join(problems))
+            except Exception:
+                errprint("Unable to apply {} config, rolling back {} file(s)".format(
+                    self.server['service_name'], len(backups)))
+                self._restore(backups)
+                try:
+                    self._reload(changed=backups, restart=restart)
+                except Exception:
+                    errprint("Unable to reload {} after rollback, please execute `{}` manually".format(
+                        self.server['service_name'], self.server['restart_command']))
+                raise
+            self._discard(staged)
+            infoprint("{} config applied".format(self.server['service_name']))
+
+
+def mpm_limits(path):
+    """
+    配置文件中的 ServerLimit 和 ThreadLimit, 文件不存在时返回 None
+    :rtype: list|None
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as fr:
+        return re.findall(r"^\s*(?:ServerLimit|ThreadLimit)\s+(\d+)", fr.read(), re.M)
+
+
+# 上一次完全重启Apache时, MPM配置中的 ServerLimit 和 ThreadLimit, 也就是正在运行的Apache使用的值
+#     配置文件可能已经被更早的提交(比如 webroot 验证之前的提交, 或者中断了的安装)替换,
+#     所以只能与这里记录的值比较, 不能与替换之前的文件比较
+MPM_LIMITS_STATE_PATH = "/var/lib/zmirror-onekey/mpm-limits.json"
+
+
+class ApacheConfigTransaction(ConfigTransaction):
+    """
+    Apache 的配置事务
+        更换MPM (mods-enabled 中的 mpm_*), 或者 ServerLimit/ThreadLimit 与正在运行的值不同时,
+        平滑重载不会生效, 这次提交用一次完全重启代替重载
+    """
+
+    def __init__(self, server, state_path=MPM_LIMITS_STATE_PATH, **kwargs):
+        super().__init__(server, **kwargs)
+        self.state_path = state_path
+        self.mpm_conf = os.path.normpath(os.path.join(server['config_root'],
+                                                      server['configs']['mpm_event']['file_path']))
+
+    def loaded_mpm_limits(self):
+        """
+        正在运行的Apache加载的 ServerLimit 和 ThreadLimit, 没有记录时(第一次安装)返回 None
+        :rtype: list|None
+        """
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as fr:
+                return json.load(fr)
+        except (OSError, ValueError):
+            return None
+
+    def _needs_restart(self, staged):
+        mods_enabled = os.path.normpath(os.path.join(self.server['config_root'], "mods-enabled"))
+        if any(os.path.dirname(path) == mods_enabled and os.path.basename(path).startswith("mpm_") for path in staged):
+            return True
+        limits = mpm_limits(staged.get(self.mpm_conf) or self.mpm_conf)
+        return limits is not None and limits != self.loaded_mpm_limits()
+
+    def _restarted(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, "w", encoding="utf-8") as fw:
+            json.dump(mpm_limits(self.mpm_conf), fw)
+
+
+if "mpm_event" in this_server['configs']:
+    config_txn = ApacheConfigTransaction(this_server)
+else:  # nginx
+    config_txn = ConfigTransaction(this_server)
+
+
+# ################# PyPy ################
+# --runtime pypy 时, 镜像的 gunicorn 服务由 PyPy 虚拟环境中的 python 运行
+PYPY_VENV_DIR = "/opt/zmirror-pypy"
+# C加速模块在 PyPy 中无法编译, 或者通过 cpyext 调用反而比纯python更慢
+#     zmirror 在它们不存在时会使用 chardet 和纯python的缓存
+PYPY_SKIPPED_REQUIREMENTS = ["cchardet", "fastcache", "lru-dict"]
+
+
+def pypy_python():
+    """
+    PyPy 虚拟环境中的 python
+    :rtype: str
+    """
+    return os.path.join(PYPY_VENV_DIR, "bin", "python")
+
+
+def install_pypy_runtime():
+    """创建 PyPy 虚拟环境(已存在时只升级), 在其中安装zmirror和应用服务需要的python包"""
+    if not os.path.exists(pypy_python()):
+        infoprint("Creating PyPy virtualenv:", PYPY_VENV_DIR)
+        cmd("pypy3 -m venv " + PYPY_VENV_DIR, allow_failure=False)
+    pip_install(PIP_REQUIREMENTS + server_pip_packages(), name="pypy", allow_failure=False, python=pypy_python())
+    pip_install([requirement for requirement in PIP_OPTIONAL_REQUIREMENTS
+                 if requirement not in PYPY_SKIPPED_REQUIREMENTS],
+                name="pypy_optional", allow_failure=True, python=pypy_python())
+
+
+# ################# 检测镜像是否已安装 ################
+htdoc = this_server['htdoc']  # type: str
+for mirror, values in list(mirrors_settings.items()):
+    this_mirror_folder = os.path.join(htdoc, mirror)
+    # 如果文件夹不存在, 则跳过
+    if os.path.exists(this_mirror_folder):
+        infoprint("Mirror:", mirror, "was already installed in", this_mirror_folder)
+        mirrors_settings[mirror]["installed_path"] = this_mirror_folder
+
+# ################# 仅升级 ##########################
+if upgrade_only:
+    profiler.phase("upgrade")
+    infoprint("Upgrade Only")
+    htdoc = this_server['htdoc']  # type: str
+
+    infoprint("Upgrading dependencies")
+    if not offline:
+        cmd("python3 -m pip install -U pip", allow_failure=True)
+    pip_install(PIP_REQUIREMENTS, name="requirements", allow_failure=True)
+    pip_install(PIP_OPTIONAL_REQUIREMENTS, name="optional", allow_failure=True)
+    if runtime == "pypy":
+        install_pypy_runtime()
+
+    # 所有镜像的代码都来自同一个缓存, 只从上游fetch一次; 覆盖层形式的镜像只需要升级一次共享代码
+    shared_folder = os.path.join(htdoc, 'zmirror')
+    upgraded = []
+    upgrade = StepScheduler()
+    upgrade.add("zmirror:fetch", lambda: source_cache.ensure("zmirror"))
+    if any(values["installed_path"] and is_overlay(values["installed_path"])
+           for values in mirrors_settings.values()):
+        infoprint("Upgrading shared zmirror code:", shared_folder)
+        upgrade.add("zmirror:shared", lambda: source_cache.checkout("zmirror", shared_folder, discard_local=True),
+                    deps=["zmirror:fetch"])
+
+    def upgrade_mirror(mirror, values):
+        """升级一个镜像, 出错时只报告, 不影响其他镜像的升级"""
+        this_mirror_folder = values["installed_path"]
+        infoprint("Upgrading:", mirror)
+        try:
+            if is_overlay(this_mirror_folder):
+                link_overlay(shared_folder, this_mirror_folder,
+                             preserved=[file_to for _, file_to in values['cfg']])
+            else:
+                # 旧版本的完整拷贝, 从缓存快进合并
+                source_cache.checkout("zmirror", this_mirror_folder, allow_failure=False)
+        except:
+            errprint("Unable to upgrade:", mirror)
+            onekey_report(
+                report_type=REPORT_ERROR,
+                traceback_str=traceback.format_exc(),
+                msg="Unable to upgrade:" + mirror
+            )
+        else:
+            upgraded.append(mirror)
+
+    for mirror, values in mirrors_settings.items():
+        # 如果文件夹不存在, 则跳过
+        if not values["installed_path"] or not os.path.exists(values["installed_path"]):
+            infoprint("Mirror:", mirror, "not found, skipping")
+            continue
+        # 各个镜像互不依赖, 并行升级
+        upgrade.add("mirror:upgrade:" + mirror, functools.partial(upgrade_mirror, mirror, values),
+                    deps=[d for d in ("zmirror:fetch", "zmirror:shared") if d in upgrade.steps])
+    try:
+        upgrade.run()
+    except Exception:
+        errprint("Unable to upgrade zmirror source")
+        onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+    success_count = len(upgraded)
+
+    if success_count:
+        # 平滑重载, mod_wsgi 或 gunicorn 的进程会加载新的代码, 正在处理的请求不会被中断
+        infoprint("zmirror upgrade complete, reloading", this_server['service_name'])
+        try:
+            config_txn.commit()
+        except Exception:
+            errprint("Unable to reload {}, please check `{}` and the error log".format(
+                this_server['service_name'], this_server['configtest_command']))
+            onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
+        else:
+            onekey_report(report_type=REPORT_SUCCESS, msg="Success Count:{}".format(success_count))
+
+    exit()
+
+# ################# 内置的ACME客户端 ################
+# --acme-client native 时不再安装 certbot, 由下面这个ACME v2客户端直接获取证书:
+#     签名等操作通过 openssl 命令完成, 不需要额外的python包
+#     同一个账户密钥和HTTP连接池在所有订单之间共用
+#     证书写入与certbot相同的 /etc/letsencrypt/live/{证书名}/ 中, Apache配置不需要任何改动
+#     用 --acme-directory 指定其他的ACME服务器(比如本地测试用的 Pebble), --acme-ca-bundle 指定其HTTPS证书
+LETSENCRYPT_LIVE = "/etc/letsencrypt/live"
+NATIVE_ACME_ROOT = "/etc/letsencrypt/zmirror-onekey"
+NATIVE_ACME_RENEWAL_DIR = os.path.join(NATIVE_ACME_ROOT, "renewal")
+
+
+def _b64(data):
+    """ACME使用的 base64url 编码, 没有填充"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _openssl(args, input_data=None):
+    """运行一个openssl命令并返回它的输出, 可能包含私钥等内容, 所以不经过 cmd() 的日志"""
+    proc = subprocess.Popen(["openssl"] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(input_data)
+    if proc.returncode != 0:
+        raise RuntimeError("openssl {} error: {}".format(args[0], err.decode("utf-8", "replace")))
+    return out
+
+
+def _write_private(path, data):
+    """原子地写入一个只有root可以读取的文件"""
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as fw:
+        fw.write(data)
+    os.replace(tmp, path)
+
+
+class AcmeError(Exception):
+    """ACME服务器返回的错误, type 为 urn:ietf:params:acme:error:* 中的错误类型"""
+
+    def __init__(self, url, response):
+        try:
+            problem = response.json()
+        except ValueError:
+            problem = {"detail": response.text}
+        self.type = problem.get("type", "")
+        self.status_code = response.status_code
+        super().__init__("{} {}: {} {}".format(url, response.status_code, self.type, problem.get("detail", "")))
+
+
+class WebrootChallenge:
+    """http-01 验证: 把验证文件直接放到 webroot 中, 由正在运行的Apache提供"""
+    type = "http-01"
+
+    def __init__(self, webroot):
+        self.folder = os.path.join(webroot, ".well-known", "acme-challenge")
+        self.settings = {"webroot": webroot}
+
+    def deploy(self, domain, token, key_authorization):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, token), "w", encoding="ascii") as fw:
+            fw.write(key_authorization)
+        os.chmod(os.path.join(self.folder, token), 0o644)
+
+    def cleanup(self, domain, token, key_authorization):
+        try:
+            os.remove(os.path.join(self.folder, token))
+        except OSError:
+            pass
+
+
+class DnsHookChallenge:
+    """dns-01 验证: 由hook脚本添加/删除 _acme-challenge 的TXT记录, 通配符证书只能使用这种验证"""
+    type = "dns-01"
+
+    def __init__(self, hook):
+        self.hook = os.path.abspath(hook)
+        self.settings = {"hook": self.hook}
+
+    @staticmethod
+    def txt_value(key_authorization):
+        return _b64(hashlib.sha256(key_authorization.encode("ascii")).digest())
+
+    def deploy(self, domain, token, key_authorization):
+        cmd('"{}" deploy_challenge "{}" "{}" "{}"'.format(
+            self.hook, domain, token, self.txt_value(key_authorization)), allow_failure=False)
+
+    def cleanup(self, domain, token, key_authorization):
+        cmd('"{}" clean_challenge "{}" "{}" "{}"'.format(
+            self.hook, domain, token, self.txt_value(key_authorization)), allow_failure=True)
+
+
+class AcmeClient:
+    """
+    一个最小的 ACME v2 (RFC 8555) 客户端
+        账户在第一次签发证书时注册(已注册过的账户会直接返回), 之后所有订单共用同一个账户和连接池
+    """
+
+    def __init__(self, directory_url, account_key_path, verify=True):
+        """
+        :param verify: HTTPS证书校验, 可以是一个CA证书文件的路径(比如Pebble的根证书)
+        """
+        self.directory_url = directory_url
+        self.account_key_path = account_key_path
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "zmirror-onekey/" + __VERSION__
+        self._directory = None
+        self._nonce = None
+        self._jwk = None
+        self.kid = None
+        self._lock = threading.Lock()
+
+    # ---------- 账户密钥 ----------
+    def _load_account_key(self):
+        if not os.path.exists(self.account_key_path):
+            infoprint("Generating ACME account key:", self.account_key_path)
+            os.makedirs(os.path.dirname(self.account_key_path), exist_ok=True)
+            _write_private(self.account_key_path, _openssl(["genrsa", "2048"]))
+        text = _openssl(["rsa", "-in", self.account_key_path, "-noout", "-text"]).decode("utf-8")
+        modulus, exponent = re.search(
+            r"modulus:\s+00:([a-f0-9:\s]+?)\npublicExponent: ([0-9]+)", text, re.I | re.S).groups()
+        exponent = "{:x}".format(int(exponent))
+        exponent = "0" + exponent if len(exponent) % 2 else exponent
+        self._jwk = {
+            "e": _b64(bytes.fromhex(exponent)),
+            "kty": "RSA",
+            "n": _b64(bytes.fromhex(re.sub(r"[\s:]", "", modulus))),
+        }
+
+    @property
+    def thumbprint(self):
+        """账户公钥的 JWK thumbprint, 用于生成 key authorization"""
+        if self._jwk is None:
+            self._load_account_key()
+        return _b64(hashlib.sha256(
+            json.dumps(self._jwk, sort_keys=True, separators=(",", ":")).encode("utf-8")).digest())
+
+    # ---------- 请求 ----------
+    @property
+    def directory(self):
+        if self._directory is None:
+            response = self.session.get(self.directory_url, timeout=30)
+            if response.status_code != 200:
+                raise AcmeError(self.directory_url, response)
+            self._directory = response.json()
+        return self._directory
+
+    def _get_nonce(self):
+        if self._nonce is None:
+            response = self.session.head(self.directory["newNonce"], timeout=30)
+            self._nonce = response.headers["Replay-Nonce"]
+        nonce, self._nonce = self._nonce, None
+        return nonce
+
+    def _post(self, url, payload, use_jwk=False):
+        """
+        发送一个签名的请求, payload 为 None 时是 POST-as-GET
+            服务器认为nonce无效(badNonce)时会用服务器返回的新nonce重试
+        :rtype: requests.Response
+        """
+        if self._jwk is None:
+            self._load_account_key()
+        payload64 = "" if payload is None else _b64(json.dumps(payload))
+        for _ in range(5):
+            protected = {"alg": "RS256", "nonce": self._get_nonce(), "url": url}
+            if use_jwk:
+                protected["jwk"] = self._jwk
+            else:
+                protected["kid"] = self.kid
+            protected64 = _b64(json.dumps(protected))
+            signature = _openssl(["dgst", "-sha256", "-sign", self.account_key_path],
+                                 "{}.{}".format(protected64, payload64).encode("ascii"))
+            response = self.session.post(
+                url, timeout=60, headers={"Content-Type": "application/jose+json"},
+                data=json.dumps({"protected": protected64, "payload": payload64, "signature": _b64(signature)}))
+            self._nonce = response.headers.get("Replay-Nonce")
+            if response.status_code < 400:
+                return response
+            error = AcmeError(url, response)
+            if error.type != "urn:ietf:params:acme:error:badNonce":
+                raise error
+        raise error
+
+    def register(self, email=None):
+        """注册账户, 账户已存在时服务器直接返回它的地址"""
+        payload = {"termsOfServiceAgreed": True}
+        if email:
+            payload["contact"] = ["mailto:" + email]
+        response = self._post(self.directory["newAccount"], payload, use_jwk=True)
+        self.kid = response.headers["Location"]
+        dbgprint("ACME account:", self.kid)
+
+    def _poll(self, url, pending=("pending", "processing"), timeout=300):
+        """轮询一个authorization/order, 直到它不再处于 pending 状态"""
+        deadline = time() + timeout
+        while True:
+            result = self._post(url, None).json()
+            if result["status"] not in pending:
+                return result
+            if time() > deadline:
+                raise RuntimeError("Timeout waiting for {}, status: {}".format(url, result["status"]))
+            sleep(2)
+
+    # ---------- 签发证书 ----------
+    def _authorize(self, authz_url, challenges):
+        """完成一个authorization, challenges 为 {验证类型: 验证对象}"""
+        authz = self._post(authz_url, None).json()
+        domain = authz["identifier"]["value"]
+        if authz["status"] == "valid":  # 之前已经验证过了
+            return
+        for challenge in authz["challenges"]:
+            if challenge["type"] in challenges:
+                handler = challenges[challenge["type"]]
+                break
+        else:
+            raise RuntimeError("No supported challenge for {}, offered: {}".format(
+                domain, ", ".join(c["type"] for c in authz["challenges"])))
+
+        key_authorization = "{}.{}".format(challenge["token"], self.thumbprint)
+        handler.deploy(domain, challenge["token"], key_authorization)
+        try:
+            self._post(challenge["url"], {})
+            authz = self._poll(authz_url)
+        finally:
+            handler.cleanup(domain, challenge["token"], key_authorization)
+        if authz["status"] != "valid":
+            errors = ["{} {}".format(c["error"].get("type", ""), c["error"].get("detail", ""))
+                      for c in authz["challenges"] if c.get("error")]
+            raise RuntimeError("Challenge for {} failed: {}".format(domain, "; ".join(errors) or authz["status"]))
+        infoprint("Verified:", domain)
+
+    @staticmethod
+    def make_key(key_type="rsa"):
+        """生成证书的私钥, RSA 2048 或者 ECDSA P-256"""
+        if key_type == "ecdsa":
+            return _openssl(["ecparam", "-name", "prime256v1", "-genkey", "-noout"])
+        return _openssl(["genrsa", "2048"])
+
+    @staticmethod
+    def make_csr(key_path, domains):
+        """
+        生成包含所有域名(SAN)的CSR, 使用配置文件而不是 -addext, 以兼容旧版本的openssl
+        :rtype: bytes
+        :return: DER格式的CSR
+        """
+        with tempfile.NamedTemporaryFile("w", suffix=".cnf") as conf:
+            conf.write("[req]\ndistinguished_name = dn\nreq_extensions = san\nprompt = no\n"
+                       "[dn]\nCN = {}\n[san]\nsubjectAltName = {}\n".format(
+                           domains[0], ",".join("DNS:" + domain for domain in domains)))
+            conf.flush()
+            return _openssl(["req", "-new", "-sha256", "-key", key_path, "-config", conf.name, "-outform", "DER"])
+
+    def issue(self, domains, cert_name, challenges, email=None, live_root=LETSENCRYPT_LIVE, key_type="rsa"):
+        """
+        签发一张包含 domains 中所有域名的证书, 写入 live_root/cert_name/ 中
+            cert.pem privkey.pem chain.pem fullchain.pem, 与certbot的文件相同
+        :type domains: list
+        :param challenges: {验证类型: 验证对象}, 验证对象有 deploy() cleanup() 两个方法
+        :type challenges: dict
+        :param key_type: 证书私钥的类型, rsa 或 ecdsa
+        :return: live 文件夹
+        :rtype: str
+        """
+        with self._lock:
+            if self.kid is None:
+                self.register(email)
+
+        response = self._post(self.directory["newOrder"],
+                              {"identifiers": [{"type": "dns", "value": domain} for domain in domains]})
+        order_url = response.headers["Location"]
+        order = response.json()
+        for authz_url in order["authorizations"]:
+            self._authorize(authz_url, challenges)
+
+        live_dir = os.path.join(live_root, cert_name)
+        os.makedirs(live_dir, exist_ok=True)
+        key_path = os.path.join(live_dir, "privkey.pem.new")
+        _write_private(key_path, self.make_key(key_type))
+        try:
+            self._post(order["finalize"], {"csr": _b64(self.make_csr(key_path, domains))})
+            order = self._poll(order_url)
+            if order["status"] != "valid":
+                raise RuntimeError("Order for {} failed: {}".format(", ".join(domains), order.get("error")))
+            fullchain = self._post(order["certificate"], None).text
+        except Exception:
+            os.remove(key_path)
+            raise
+
+        # 第一张证书是域名证书, 其余的是中间证书
+        pems = re.findall(r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----\n?", fullchain, re.S)
+        for name, content in [("cert.pem", pems[0]), ("chain.pem", "".join(pems[1:])),
+                              ("fullchain.pem", "".join(pems))]:
+            with open(os.path.join(live_dir, name + ".new"), "w", encoding="ascii") as fw:
+                fw.write(content)
+        # 私钥最后替换, 这样即使中断, 也不会出现私钥与证书不匹配的情况
+        for name in ("cert.pem", "chain.pem", "fullchain.pem", "privkey.pem"):
+            os.replace(os.path.join(live_dir, name + ".new"), os.path.join(live_dir, name))
+        self.save_renewal(cert_name, domains, challenges, key_type)
+        return live_dir
+
+    def save_renewal(self, cert_name, domains, challenges, key_type="rsa"):
+        """记录证书的签发参数, 供 --renew-certs 使用"""
+        os.makedirs(NATIVE_ACME_RENEWAL_DIR, exist_ok=True)
+        with open(os.path.join(NATIVE_ACME_RENEWAL_DIR, cert_name + ".json"), "w", encoding="utf-8") as fw:
+            json.dump({"domains": domains, "directory": self.directory_url, "time": str(datetime.now()),
+                       "key_type": key_type,
+                       "challenges": {type_: challenge.settings for type_, challenge in challenges.items()}}, fw)
+
+
+# 验证类型 -> 验证类, 用于从 save_renewal() 记录的参数重新创建验证对象
+CHALLENGE_TYPES = {
+    WebrootChallenge.type: WebrootChallenge,
+    DnsHookChallenge.type: DnsHookChallenge,
+}
+
+
+native_acme = AcmeClient(ACME_DIRECTORY_URL, os.path.join(NATIVE_ACME_ROOT, "account.key"),
+                         verify=ACME_CA_BUNDLE or True)
+
+# ################# 安装步骤 ####################
+# 每个安装步骤是一个函数, 由 StepScheduler 按照声明的依赖关系调度, 互不依赖的步骤会并行执行
+htdoc = this_server['htdoc']  # type: str
+config_root = this_server['config_root']  # type: str
+zmirror_source_folder = os.path.join(htdoc, 'zmirror')
+
+
+def install_server_packages():
+    """安装服务器(Apache 或 nginx)需要的系统包, 以及 python 包(比如 gunicorn)"""
+    # git python3 wget curl openssl 等已经在 bootstrap 事务中安装
+    # 如果安装了 software-properties-common, 则可以使用PPA安装高版本的Apache2(支持http2), 仅限ubuntu
+    # debian 只有低版本的可以用
+    if distro.id() == 'ubuntu' and this_server.get("ubuntu_ppa") and shutil.which("add-apt-repository"):
+        apt_planner.add_ppa(this_server["ubuntu_ppa"])
+    apt_planner.require(*this_server["apt_packages"])
+    if runtime == "pypy":
+        apt_planner.require("pypy3")
+        # 较新的 debian/ubuntu 中, venv 模块是单独的包
+        apt_planner.suggest("pypy3-venv")
+    apt_planner.commit("server")
+    if server_pip_packages():
+        pip_install(server_pip_packages(), name="server", allow_failure=False)
+
+
+def enable_apache_modules():
+    cmd("""a2enmod rewrite mime include headers filter expires deflate autoindex setenvif ssl socache_shmcb wsgi""")
+
+    if not cmd("a2enmod http2", allow_failure=True):
+        warnprint("[Warning!] your server does not support http2")
+
+
+def apache_mpm():
+    """
+    当前配置的MPM (event, worker, prefork), 无法获取时返回 None
+    :rtype: str|None
+    """
+    try:
+        output = subprocess.check_output(this_server['version_command'].split(),
+                                         stderr=subprocess.STDOUT).decode("utf-8", "replace")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    matched = re.search(r"Server MPM:\s+(\w+)", output)
+    return matched.group(1).lower() if matched else None
+
+
+def apache_version():
+    """
+    本机Apache的版本, 比如 (2, 4, 29), 无法获取时返回 (0,)
+    :rtype: tuple
+    """
+    try:
+        output = subprocess.check_output(this_server['version_command'].split(),
+                                         stderr=subprocess.STDOUT).decode("utf-8", "replace")
+        return tuple(int(x) for x in re.search(r"Apache/(\d+)\.(\d+)\.(\d+)", output).groups())
+    except (OSError, subprocess.CalledProcessError, AttributeError, ValueError):
+        return (0,)
+
+
+def ensure_event_mpm():
+    """
+    确保使用 event MPM, mod_http2 在 prefork 下只能单线程地处理每个连接
+        mod_php 等非线程安全的模块需要 prefork, 这时保持不变
+        与 a2dismod/a2enmod 相同地修改 mods-enabled 中的链接, 但只是暂存在 config_txn 中,
+        提交时与其他配置一起 configtest, 完全重启一次, 健康检查, 失败时回滚
+    """
+    mpm = apache_mpm()
+    if mpm == "event":
+        infoprint("Apache is using the event MPM")
+        return
+    mods_enabled = os.path.join(config_root, "mods-enabled")
+    mods_available = os.path.join(config_root, "mods-available")
+    blockers = [filename for filename in os.listdir(mods_enabled) if re.match(r"php.*\.load$", filename)]
+    if blockers:
+        warnprint("Keeping the {} MPM, because {} requires it".format(mpm, ", ".join(blockers)))
+        return
+    if not os.path.exists(os.path.join(mods_available, "mpm_event.load")):
+        warnprint("Keeping the {} MPM, because mpm_event is not available".format(mpm))
+        return
+
+    for filename in os.listdir(mods_enabled):
+        if re.match(r"mpm_(?!event\.).*\.(load|conf)$", filename):
+            config_txn.remove(os.path.join(mods_enabled, filename))
+    for filename in ("mpm_event.load", "mpm_event.conf"):
+        if os.path.exists(os.path.join(mods_available, filename)):
+            config_txn.link(os.path.join(mods_enabled, filename), os.path.join("..", "mods-available", filename))
+    infoprint("The MPM will be switched from {} to event when the config is applied".format(mpm))
+
+
+def upgrade_system_packages():
+    """(可选) 更新一下各种包"""
+    if not (distro.id() == 'ubuntu' and distro.version() == '14.04'):  # 系统不是ubuntu 14.04
+        # Ubuntu 14.04 执行本命令的时候会弹一个postfix的交互, 所以不执行
+        cmd('apt-get -y -q upgrade', allow_failure=True)
+
+
+def install_certbot():
+    infoprint('Installing letsencrypt...')
+    # 不存在则从缓存克隆, 否则升级一下 (/etc/certbot 只由本脚本管理)
+    source_cache.checkout("certbot", '/etc/certbot', discard_local=True)
+    cmd('chmod a+x /etc/certbot/certbot-auto', cwd='/etc/certbot/')
+    infoprint("let's encrypt Installation Completed")
+
+
+def bootstrap_certbot():
+    """certbot-auto 第一次运行时会创建自己的python环境, 这里预先运行一次"""
+    if os.path.exists('/opt/eff.org/certbot/venv'):
+        return
+    # 只需要创建python环境, 不进行任何验证, 所以不必停止Apache
+    cmd('/etc/certbot/certbot-auto -n --version', cwd='/etc/certbot/')
+
+
+def clone_zmirror():
+    """从缓存准备所有镜像共用的zmirror代码"""
+    source_cache.checkout("zmirror", zmirror_source_folder, discard_local=True)
+
+
+def read_cert_text(cert_file):
+    """
+    证书的文本形式(openssl x509 -text), 读取失败时返回空字符串
+    :rtype: str
+    """
+    try:
+        return subprocess.check_output(["openssl", "x509", "-noout", "-text", "-in", cert_file],
+                                       stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def read_cert_domains(cert_file):
+    """
+    读取证书中的所有域名(SAN), 读取失败时返回空列表
+    :rtype: list
+    """
+    return re.findall(r"DNS:([^\s,]+)", read_cert_text(cert_file))
+
+
+def cert_key_types():
+    """
+    需要获取的证书的密钥类型, 第一个是镜像的主证书
+    :rtype: list
+    """
+    return {"rsa": ["rsa"], "ecdsa": ["ecdsa"], "dual": ["rsa", "ecdsa"]}[cert_key_type]
+
+
+def letsencrypt_live_certs(key_type="rsa"):
+    """
+    所有已经获取到的 let's encrypt 证书
+    :param key_type: 只包括该密钥类型的证书, rsa 或 ecdsa
+    :return: 域名 -> 包含该域名的证书所在的 live 文件夹
+    :rtype: dict
+    """
+    covered = {}
+    if not os.path.isdir(LETSENCRYPT_LIVE):
+        return covered
+    for name in sorted(os.listdir(LETSENCRYPT_LIVE)):
+        live_dir = os.path.join(LETSENCRYPT_LIVE, name)
+        if not os.path.exists(os.path.join(live_dir, "cert.pem")):
+            continue
+        text = read_cert_text(os.path.join(live_dir, "cert.pem"))
+        if text:
+            this_key_type = "ecdsa" if "id-ecPublicKey" in text else "rsa"
+        else:
+            # 无法读取证书时, 由文件夹名判断, 参见 cert_name_for()
+            this_key_type = "ecdsa" if name.endswith("-ecdsa") else "rsa"
+        if this_key_type != key_type:
+            continue
+        # 文件夹名是证书的第一个域名, 即使无法读取证书也可以匹配到它
+        for domain in [re.sub(r"-ecdsa$", "", name)] + re.findall(r"DNS:([^\s,]+)", text):
+            covered.setdefault(domain, live_dir)
+    return covered
+
+
+def wildcard_of(domain):
+    """
+    包含 domain 的通配符域名, 比如 g.example.com -> *.example.com
+        少于三级的域名(example.com, localhost)的父域名是顶级域名或者不存在, 返回 None
+    :rtype: str|None
+    """
+    labels = domain.split(".")
+    if len(labels) < 3:
+        return None
+    return "*." + ".".join(labels[1:])
+
+
+def cert_covering(domain, covered=None, key_type="rsa"):
+    """
+    包含 domain 的证书所在的 live 文件夹, 通配符证书 *.example.com 包含 example.com 的所有子域名
+    :param covered: letsencrypt_live_certs() 的结果, 为 None 时重新读取
+    :rtype: str|None
+    """
+    if covered is None:
+        covered = letsencrypt_live_certs(key_type)
+    if domain in covered:
+        return covered[domain]
+    wildcard_domain = wildcard_of(domain)
+    return covered.get(wildcard_domain) if wildcard_domain else None
+
+
+def cert_name_for(domains, key_type="rsa"):
+    """
+    证书名(live 中的文件夹名), 为第一个域名
+        通配符证书命名为 wildcard.example.com, 避免与 example.com 本身的证书冲突
+        ECDSA证书加上 -ecdsa 后缀, 与同一组域名的RSA证书共存
+    :type domains: list
+    """
+    if domains[0].startswith("*."):
+        name = "wildcard." + domains[0][2:]
+    else:
+        name = domains[0]
+    return name + "-ecdsa" if key_type == "ecdsa" else name
+
+
+def mirror_cert_paths(mirror):
+    """
+    镜像使用的证书文件, 自己提供的证书, 或者包含该镜像域名的 let's encrypt 证书
+        多个镜像可能共用同一张SAN证书
+        dual 模式下, 另一种密钥类型的证书在 "ecdsa" 中
+    :return: 格式同 mirrors_settings 中的 certs
+    :rtype: dict
+    """
+    if already_have_cert:
+        return mirrors_settings[mirror]['certs']
+    domain = mirrors_settings[mirror]['domain']
+
+    paths = {}
+    for index, key_type in enumerate(cert_key_types()):
+        live_dir = cert_covering(domain, key_type=key_type) or os.path.join(
+            LETSENCRYPT_LIVE, cert_name_for([domain], key_type))
+        this_paths = {
+            "cert": os.path.join(live_dir, "cert.pem"),
+            "private_key": os.path.join(live_dir, "privkey.pem"),
+            "intermediate": os.path.join(live_dir, "chain.pem"),
+            "fullchain": os.path.join(live_dir, "fullchain.pem"),
+        }
+        if index == 0:
+            paths.update(this_paths)
+        else:
+            paths[key_type] = this_paths
+    return paths
+
+
+def ssl_certificate_directives(certs_dict, mirror=None):
+    """
+    https 配置中的证书指令
+        只有一张证书时与原来的配置相同, 兼容 2.4.8 之前的Apache
+        有两张证书(dual)时, 每张证书使用各自的 fullchain, 因为RSA和ECDSA证书的中间证书不同
+        nginx 总是使用 fullchain, 自己提供的证书会把证书和中间证书合并为一个文件
+    :rtype: str
+    """
+    if server_name == "nginx":
+        if "fullchain" not in certs_dict:
+            fullchain = os.path.join(config_root, "zmirror-certs", "{}-fullchain.pem".format(mirror))
+            os.makedirs(os.path.dirname(fullchain), exist_ok=True)
+            with open(fullchain, "w", encoding="ascii") as fw:
+                for path in (certs_dict['cert'], certs_dict['intermediate']):
+                    with open(path, "r", encoding="ascii") as fr:
+                        fw.write(fr.read().strip() + "\n")
+            certs_dict = dict(certs_dict, fullchain=fullchain)
+        pairs = [certs_dict] + ([certs_dict['ecdsa']] if "ecdsa" in certs_dict else [])
+        return "\n    ".join("ssl_certificate {};\n    ssl_certificate_key {};".format(
+            pair['fullchain'], pair['private_key']) for pair in pairs)
+
+    if "ecdsa" not in certs_dict:
+        return ("SSLCertificateFile    {}\n"
+                "    SSLCertificateKeyFile {}\n"
+                "    SSLCertificateChainFile {}").format(
+            certs_dict['cert'], certs_dict['private_key'], certs_dict['intermediate'])
+    return ("# Apache chooses the certificate for each client: ECDSA if the client supports it, RSA otherwise\n"
+            "    SSLCertificateFile    {}\n"
+            "    SSLCertificateKeyFile {}\n"
+            "    SSLCertificateFile    {}\n"
+            "    SSLCertificateKeyFile {}").format(
+        certs_dict['fullchain'], certs_dict['private_key'],
+        certs_dict['ecdsa']['fullchain'], certs_dict['ecdsa']['private_key'])
+
+
+def certbot_challenge_args(dns=False):
+    """
+    certbot 使用的验证方式对应的参数
+    :param dns: 使用 --dns-hook 完成 DNS-01 验证 (通配符证书)
+    """
+    if dns:
+        # 由 certbot 的 manual 插件调用 dns_hook, 参数与内置ACME客户端调用时相同
+        hook_args = '"{hook}" {{action}} "$CERTBOT_DOMAIN" "$CERTBOT_TOKEN" "$CERTBOT_VALIDATION"'.format(
+            hook=os.path.abspath(dns_hook))
+        return ("--manual --preferred-challenges dns --manual-public-ip-logging-ok "
+                "--manual-auth-hook '{}' --manual-cleanup-hook '{}'").format(
+            hook_args.format(action="deploy_challenge"), hook_args.format(action="clean_challenge"))
+    if acme_challenge == "webroot":
+        return '--webroot -w "{}"'.format(this_server['acme_webroot'])
+    return "--standalone"
+
+
+def prepare_acme_webroot():
+    """创建 webroot 验证文件夹, 并应用已暂存的通用配置, 让服务器加载其中的 Alias 配置"""
+    os.makedirs(os.path.join(this_server['acme_webroot'], ".well-known", "acme-challenge"), exist_ok=True)
+    config_txn.commit()
+
+
+def certbot_attempt(domains, key_type="rsa"):
+    """
+    :return: 用certbot获取一次包含 domains 中所有域名的证书的函数, 以及失败时提示用户手动获取的方法
+        证书名(live 中的文件夹名)为第一个域名
+    :type domains: list
+    """
+    # certbot-auto 已经在 certbot:bootstrap 中初始化过, 不需要每次运行都检查升级
+    #     certbot-auto 安装的 certbot 1.x 默认使用RSA, 所以只有ECDSA需要指定
+    certbot_cmd = (
+        '/etc/certbot/certbot-auto certonly -n --agree-tos -t -m "{email}" {challenge_args} --no-self-upgrade '
+        '--cert-name "{cert_name}" {key_args}{domain_args}'
+    ).format(email=email, challenge_args=certbot_challenge_args(dns=domains[0].startswith("*.")),
+             cert_name=cert_name_for(domains, key_type),
+             key_args="--key-type ecdsa --elliptic-curve secp256r1 " if key_type == "ecdsa" else "",
+             domain_args=" ".join('-d "{}"'.format(domain) for domain in domains))
+
+    def attempt():
+        try:
+            cmd(certbot_cmd, cwd='/etc/certbot/', allow_failure=False)
+        except subprocess.CalledProcessError:
+            # certbot 的输出中包含了ACME服务器返回的错误类型和详情, 用于判断失败的原因
+            raise RuntimeError(last_cmd_output(max_bytes=16384))
+
+    return attempt, "Meanwhile, you can obtain cert manually using:" + certbot_cmd
+
+
+def native_attempt(domains, key_type="rsa"):
+    """同 certbot_attempt(), 使用内置的ACME客户端"""
+    if domains[0].startswith("*."):
+        challenges = {"dns-01": DnsHookChallenge(dns_hook)}
+    else:
+        challenges = {"http-01": WebrootChallenge(this_server['acme_webroot'])}
+
+    def attempt():
+        native_acme.issue(domains, cert_name_for(domains, key_type), challenges, email=email, key_type=key_type)
+
+    return attempt, "Meanwhile, you can retry later by running this script again."
+
+
+# 获取证书失败的分类, 按顺序用正则匹配certbot的输出或者ACME的错误信息:
+#     类别 -> (正则, 基础等待秒数, 最长等待秒数, 最多尝试次数)
+#     最多尝试次数为1的是永久错误, 重试也不会成功, 所以不再重试
+CERT_FAILURE_CLASSES = OrderedDict([
+    ("caa", (r"acme:error:caa|Type:\s+caa|CAA record for", 0, 0, 1)),
+    ("rejected", (r"rejectedIdentifier|malformed|invalidContact|unsupportedContact|"
+                  r"Policy forbids|[Ii]nvalid email", 0, 0, 1)),
+    # 每周的证书数量等限制, 需要等待几天
+    ("rate_limited_long", (r"too many certificates|too many registrations|too many new orders|"
+                           r"[Dd]uplicate [Cc]ertificate", 0, 0, 1)),
+    # 每小时的失败验证次数等限制
+    ("rate_limited", (r"rateLimited|too many failed authorizations|rate limit", 300, 3600, 4)),
+    # DNS记录还没有生效, 或者 DNS-01 的TXT记录还没有被ACME服务器看到
+    ("dns", (r"acme:error:dns|Type:\s+dns|NXDOMAIN|DNS problem|No valid IP addresses|TXT record", 30, 600, 8)),
+    ("connection", (r"acme:error:connection|Type:\s+connection|[Cc]onnection refused|[Tt]imeout|timed out|"
+                    r"[Cc]onnection reset|Fetching http", 15, 300, 5)),
+    ("unauthorized", (r"acme:error:unauthorized|Type:\s+unauthorized|Invalid response from", 15, 120, 3)),
+    ("server", (r"serverInternal|badNonce|[Ss]ervice busy|\b50[0234]\b", 10, 300, 8)),
+    ("unknown", (r"", 10, 300, 5)),
+])
+
+
+class CertRetryScheduler:
+    """
+    获取一组证书(每个是一次ACME订单), 失败时按照失败的类别决定是否重试以及等待多久
+        等待时间为带上限和随机抖动的指数退避, 一个订单在等待时会先尝试其他的订单
+        所有订单都结束后, 若有订单最终失败, 则抛出异常
+    """
+
+    def __init__(self, classes=CERT_FAILURE_CLASSES):
+        self.classes = classes
+        self.orders = []
+
+    def add(self, domains, attempt, manual_hint, key_type="rsa"):
+        """
+        :type domains: list
+        :param key_type: 证书的密钥类型, 用于检查是否成功获取了证书
+        :param attempt: 获取一次证书, 失败时抛出异常, 异常信息用于判断失败的类别
+        :param manual_hint: 最终失败时提示用户如何手动获取
+        """
+        self.orders.append({"domains": domains, "attempt": attempt, "hint": manual_hint, "key_type": key_type,
+                            "tries": 0, "next_time": 0.0, "category": None})
+
+    def classify(self, text):
+        """:rtype: str"""
+        for category, (pattern, _, _, _) in self.classes.items():
+            if re.search(pattern, text):
+                return category
+        return "unknown"
+
+    def backoff(self, category, tries, text=""):
+        """
+        第 tries 次失败之后需要等待的秒数, 为 None 时表示不应再重试
+        :rtype: float|None
+        """
+        _, base, cap, max_tries = self.classes[category]
+        if tries >= max_tries:
+            return None
+        # ACME服务器给出了可以重试的时间, 并且在上限之内, 则等到那个时间
+        match = re.search(r"retry after (\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d)", text)
+        if match:
+            retry_after = (datetime.strptime(match.group(1).replace("T", " "), "%Y-%m-%d %H:%M:%S")
+                           - datetime.utcnow()).total_seconds()
+            return max(retry_after, base) + random.uniform(0, base) if retry_after <= cap else None
+        delay = min(cap, base * 2 ** (tries - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _attempt(self, order):
+        """:return: 失败时为 (类别, 错误信息), 成功时为 None"""
+        domains_str = ", ".join(order["domains"])
+        if order["key_type"] != "rsa":
+            domains_str += " ({})".format(order["key_type"].upper())
+        infoprint("Obtaining: {domains}".format(domains=domains_str))
+        order["tries"] += 1
+        try:
+            order["attempt"]()
+            # 检查是否成功获取证书(证书是否包含了所有域名)
+            covered = letsencrypt_live_certs(order["key_type"])
+            if not all(cert_covering(domain, covered) for domain in order["domains"]):
+                raise RuntimeError("cert file for {domains} does not exist!".format(domains=domains_str))
+        except Exception as e:
+            order["traceback"] = traceback.format_exc()
+            return self.classify(str(e)), str(e)
+        infoprint("Succeed: {domains}".format(domains=domains_str))
+        return None
+
+    def run(self):
+        pending = list(self.orders)
+        failed = []
+        while pending:
+            order = min(pending, key=lambda o: o["next_time"])
+            seconds_to_wait = order["next_time"] - time()
+            if seconds_to_wait > 0:
+                infoprint("wait {:.0f} seconds and retry: {}".format(seconds_to_wait, ", ".join(order["domains"])))
+                sleep(seconds_to_wait)
+
+            result = self._attempt(order)
+            if result is None:
+                pending.remove(order)
+                continue
+
+            category, text = result
+            order["category"] = category
+            delay = self.backoff(category, order["tries"], text)
+            if delay is None and self.classes[category][3] > 1 and not unattended:
+                # 临时性的错误超过了重试次数, 由用户决定是否继续
+                warnprint("unable to obtaining cert for {}: {}".format(", ".join(order["domains"]), category))
+                if input("max retries exceed, do you want to continue retry?(Y/n) ") not in (
+                        "N", "n", "No", "no", "NO", "none", "None"):
+                    order["tries"] = 0
+                    delay = self.backoff(category, 1, text)
+            if delay is None:
+                errprint("Giving up obtaining cert for {} ({} after {} tries)".format(
+                    ", ".join(order["domains"]), category, order["tries"]))
+                pending.remove(order)
+                failed.append(order)
+            else:
+                warnprint("unable to obtaining cert for {} ({}, {}/{}), retry in {:.0f} seconds".format(
+                    ", ".join(order["domains"]), category, order["tries"], self.classes[category][3], delay))
+                order["next_time"] = time() + delay
+
+        if not failed:
+            return
+        for order in failed:
+            onekey_report(report_type=REPORT_ERROR, traceback_str=order["traceback"],
+                          msg="{} ({} tries)".format(order["category"], order["tries"]))
+        errprint(
+            "\n"
+            "I'm really sorry that we are not able to obtain an cert now, \n"
+            "    This problem is NOT caused by zmirror-onekey itself, but caused by your DNS setting or "
+            "the let's encrypt server. \n"
+            "    If you had already set your A record correctly, "
+            "please retry and wait, because sometimes the "
+            "let's encrypt server may takes minutes or even hours to recognize your DNS settings.\n"
+            "    If you doesn't sure whether your DNS A record are correct, please check it using "
+            "https://www.whatsmydns.net/\n"
+            + "".join("    {}\n".format(order["hint"]) for order in failed)
+        )
+        importantprint("For more information, please see http://tinyurl.com/zmcert")
+        importantprint("For more information, please see http://tinyurl.com/zmcert")
+        importantprint("For more information, please see http://tinyurl.com/zmcert")
+        importantprint("For more information, please see http://tinyurl.com/zmcert")
+        errprint("Aborting...")
+        raise RuntimeError("Unable to obtain cert for: " + "; ".join(
+            "{} ({})".format(", ".join(order["domains"]), order["category"]) for order in failed))
+
+
+def fetch_certs():
+    """通过 letsencrypt 获取HTTPS证书"""
+    infoprint("Fetching HTTPS certifications")
+    # 密钥类型 -> 需要获取证书的域名
+    pending = OrderedDict()
+    for key_type in cert_key_types():
+        covered = letsencrypt_live_certs(key_type)
+        pending[key_type] = []
+        for mirror in mirrors_to_deploy:
+            domain = mirrors_settings[mirror]['domain']
+            if wildcard:
+                # 通配符证书包含父域名的所有子域名, 少于三级的域名(已被 load_answers 拒绝)只获取它本身的证书
+                domain = wildcard_of(domain) or domain
+            live_dir = cert_covering(domain, covered)
+            if live_dir:
+                # 如果已经有包含该域名的证书, 则跳过
+                warnprint("Certification for {domain} already exists in {live_dir}, skipping".format(
+                    domain=domain, live_dir=live_dir))
+            elif domain not in pending[key_type]:
+                pending[key_type].append(domain)
+
+    if not any(pending.values()):
+        infoprint("All certifications already exist")
+    elif wildcard:
+        # DNS-01 验证由hook完成, 不需要Apache参与
+        _obtain_certs(pending)
+        cmd(this_server['reload_command'], allow_failure=True)
+    elif acme_challenge == "webroot":
+        # 验证文件由正在运行的Apache提供, 不需要停止Apache
+        prepare_acme_webroot()
+        _obtain_certs(pending)
+        # 平滑重载, 让已有的站点使用新的证书, 不会中断正在处理的请求
+        cmd(this_server['reload_command'], allow_failure=True)
+    else:
+        # standalone 模式需要占用80端口, 所以只在运行certbot的期间关掉服务器
+        cmd(this_server['stop_command'])
+        try:
+            _obtain_certs(pending)
+        finally:
+            cmd(this_server['start_command'], allow_failure=True)  # 重新启动服务器
+
+    # 记录每个镜像实际使用的证书 (可能是共用的SAN证书或者通配符证书)
+    for mirror in mirrors_to_deploy:
+        mirrors_settings[mirror]['certs'] = mirror_cert_paths(mirror)
+
+
+def _obtain_certs(pending):
+    """
+    :param pending: 密钥类型 -> 需要获取证书的域名
+    :type pending: dict
+    """
+    make_attempt = native_attempt if acme_client_name == "native" else certbot_attempt
+    scheduler = CertRetryScheduler()
+    for key_type, domains in pending.items():
+        if not domains:
+            continue
+        if cert_mode == "san":
+            # 一次ACME订单获取一张包含所有域名的证书
+            scheduler.add(domains, *make_attempt(domains, key_type), key_type=key_type)
+        else:
+            for domain in domains:
+                scheduler.add([domain], *make_attempt([domain], key_type), key_type=key_type)
+    scheduler.run()
+
+
+def pre_delete_server_files():
+    """预删除文件"""
+    for pre_delete_file in this_server['pre_delete_files']:
+        abs_path = pre_delete_file.format(
+            config_root=config_root, htdoc=htdoc
+        )
+        infoprint("deleting: " + abs_path)
+        config_txn.remove(os.path.normpath(abs_path))
+
+
+def deploy_mirror(mirror):
+    """拷贝并设置一个镜像"""
+    domain = mirrors_settings[mirror]['domain']
+    this_mirror_folder = os.path.join(htdoc, mirror)
+
+    # 如果文件夹已存在, 则报错. 但是如果是加载上次的配置, 则不报错, 而是删除掉上一次安装的文件夹, 重新安装
+    if os.path.exists(this_mirror_folder):
+        if loaded_config:
+            warnprint("Folder {} already exists, will be removed".format(this_mirror_folder))
+            shutil.rmtree(this_mirror_folder)
+        else:
+            errprint(
+                ("Folder {folder} already exists."
+                 "If you want to override, please delete that folder manually and run this script again"
+                 ).format(folder=this_mirror_folder)
+            )
+            raise RuntimeError("Folder {folder} for mirror [{mirror_name}] already exists.".format(
+                folder=this_mirror_folder, mirror_name=mirror))
+
+    this_mirror = mirrors_settings[mirror]
+
+    # 以硬链接的形式创建共享代码的覆盖层, 文件夹和镜像自己的文件属于 www-data (apache的用户)
+    link_overlay(zmirror_source_folder, this_mirror_folder,
+                 preserved=[file_to for _, file_to in this_mirror['cfg']])
+
+    for file_from, file_to in this_mirror['cfg']:
+        # file_to 是镜像自己的文件, 不是硬链接, 可以放心覆盖
+        shutil.copy(os.path.join(this_mirror_folder, file_from),
+                    os.path.join(this_mirror_folder, file_to))
+        shutil.chown(os.path.join(this_mirror_folder, file_to), "www-data", "www-data")
+
+    with open(os.path.join(this_mirror_folder, 'config.py'), 'r+', encoding='utf-8') as fp:
+        # noinspection PyRedeclaration
+        content = fp.read()
+
+        # 将 my_host_name 修改为对应的域名
+        content = re.sub(r"""my_host_name *= *(['"])[-.\w]+\1""",
+                         "my_host_name = '{domain}' # Modified by zmirror-onekey".format(domain=domain),
+                         content, count=1)
+        # 将 my_host_scheme 修改为 https://
+        content = re.sub(r"""my_host_scheme *= *(['"])https?://\1""",
+                         "my_host_scheme = 'https://' # Modified by zmirror-onekey",
+                         content, count=1)
+        # 在文件末尾添加 verbose_level = 2
+        content += '\n\nverbose_level = 2 # Added by zmirror-onekey\n'
+
+        # 如果需要添加验证问题
+        if need_answer_question:
+            content += '\n\n########## Verification (added by zmirror-onekey) ########\n' \
+                       '# 这里只有最基础的单一问题-答案验证, 如果需要更加丰富的验证方式, \n' \
+                       '#    请看 `config_default.py` 文件中的 `Human/IP verification` 设置区段\n' \
+                       '#    PS: 下面的设置都支持中文, 可以自行修改成中文\n'
+            content += 'human_ip_verification_enabled = True\n'
+            content += 'human_ip_verification_answers_hash_str = \'{salt}\'  # Secret key, please keep it secret\n'.format(
+                salt="".join(random.choice(string.ascii_letters + string.digits) for _ in range(32))
+            )
+            content += 'human_ip_verification_questions = [\n' + \
+                       '    ["{question}", "{answer}", "{hint}"],\n'.format(
+                           question=question["name"], answer=question["answer"], hint=question["hint"],
+                       ) + ']\n'
+            content += 'human_ip_verification_identity_record = []\n'
+
+        fp.seek(0)  # 指针返回文件头
+        fp.write(content)  # 回写
+
+    infoprint("Mirror {} deployed to {}".format(mirror, this_mirror_folder))
+
+
+def mirror_step_inputs(mirror):
+    """
+    镜像相关步骤的输入: 镜像的设置, 以及镜像文件夹是否存在
+        不包含证书: 部署镜像不依赖证书, 与获取证书并行运行, 证书只是站点配置的输入
+    """
+    return {
+        "domain": mirrors_settings[mirror]['domain'],
+        "cfg": mirrors_settings[mirror]['cfg'],
+        "question": question if need_answer_question else None,
+        "exists": os.path.isdir(os.path.join(htdoc, mirror)),
+    }
+
+
+def site_step_inputs(mirror):
+    """站点配置步骤的输入: 镜像相关的输入, 证书, 以及WSGI进程的参数"""
+    inputs = mirror_step_inputs(mirror)
+    inputs["certs"] = mirror_cert_paths(mirror)
+    inputs["wsgi"] = wsgi_sizing["mirrors"][mirror]
+    return inputs
+
+
+def get_config_template(url):
+    """
+    获取配置文件模板, 优先使用本脚本旁边 configs/ 中的模板(与脚本的版本一致), 不存在时从github下载
+    :rtype: str
+    """
+    local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs", os.path.basename(url))
+    if os.path.exists(local_path):
+        with open(local_path, "r", encoding="utf-8") as fr:
+            return fr.read()
+    infoprint("downloading: ", url)
+    return requests.get(url).text
+
+
+def install_common_config(conf_name):
+    """安装一个通用配置文件"""
+    url = this_server['configs'][conf_name]['url']
+    file_path = os.path.join(config_root, this_server['configs'][conf_name]['file_path'])
+
+    if os.path.exists(file_path) and not this_server['configs'][conf_name].get("overwrite"):
+        # 若配置文件已存在则跳过
+        warnprint("Config {path} already exists, skipping".format(path=file_path))
+        return
+
+    infoprint("installing: ", conf_name)
+    content = get_config_template(url)
+    values = {"acme_webroot": this_server['acme_webroot']}
+    if conf_name == "tls_profile":
+        values.update(tls_profile_values())
+    elif conf_name == "mpm_event":
+        values.update(mpm_event_values(wsgi_sizing))
+    for key, value in values.items():
+        content = content.replace("{{%s}}" % key, str(value))
+    # 暂存, 由 config_txn.commit() 统一应用
+    config_txn.write(file_path, content)
+
+
+def install_site_configs(mirror):
+    """下载并设置一个镜像的服务器配置文件 (nginx 还包括镜像的 gunicorn 服务)"""
+    domain = mirrors_settings[mirror]['domain']
+    this_mirror_folder = os.path.join(htdoc, mirror)
+
+    for conf_name in this_server['site_unique_configs']:
+        url = this_server['configs'][conf_name]['url']
+        file_path = os.path.join(config_root, this_server['configs'][conf_name]['file_path'])
+        file_path = file_path.format(mirror_name=mirror, conf_name=conf_name)
+
+        if os.path.exists(file_path):
+            if loaded_config:
+                # 若是加载上一次的配置, 则替换掉已存在的配置文件
+                warnprint("Config {path} already exists, will be replaced".format(path=file_path))
+            else:
+                # 若配置文件已存在则跳过
+                warnprint("Config {path} already exists, skipping".format(path=file_path))
+                continue
+
+        infoprint("installing: ", mirror, conf_name)
+
+        conf = get_config_template(url)
+
+        # 因为Apache conf里面有 {Ascii字符} 这种结构, 与python的string format冲突
+        # 这边只能手动format
+        wsgi_options = wsgi_sizing["mirrors"][mirror]
+        for key, value in [
+            ('domain', domain),
+            ('mirror_name', mirror),
+            ('wsgi_daemon_options', wsgi_daemon_options(wsgi_options)),
+            ('path_to_wsgi_py', os.path.join(this_mirror_folder, 'wsgi.py')),
+            ('this_mirror_folder', this_mirror_folder),
+            # nginx + gunicorn
+            ('app_server_command', app_server_command(mirror)),
+            ('gunicorn_options', gunicorn_options(wsgi_options)),
+            ('app_environment', app_environment(wsgi_options)),
+            ('warmup_requests', str(PYPY_WARMUP_REQUESTS)),
+            ('warmup_seconds', str(PYPY_WARMUP_SECONDS)),
+            ('request_timeout', str(wsgi_options["request-timeout"])),
+            ('graceful_timeout', str(wsgi_options["graceful-timeout"])),
+        ]:
+            conf = conf.replace("{{%s}}" % key, value)
+
+        # 填写 conf 中的证书路径: 自己提供的证书, 或者 let's encrypt 获取到的证书
+        certs_dict = mirror_cert_paths(mirror)
+        conf = conf.replace("{{ssl_certificate_directives}}", ssl_certificate_directives(certs_dict, mirror))
+
+        config_txn.write(file_path, conf)
+
+
+def install_renew_cron():
+    """Add linux cron script for letsencrypt auto renewal"""
+    if already_have_cert:  # 选择自己提供证书, 则跳过
+        return
+    # 添加(或更新) let's encrypt 证书自动更新脚本
+    #     由本脚本的 --renew-certs 只更新即将过期的证书, 并且只有证书真的变化了才平滑重载Apache
+    infoprint("Adding cert auto renew script to `/etc/cron.weekly/zmirror-letsencrypt-renew.sh`")
+    renew_argv = ["--renew-certs", "--renew-window", str(renew_window), "--renew-max-delay", "1800",
+                  "--server", server_name]
+    if acme_client_name == "native":
+        renew_argv += ["--acme-client", "native", "--acme-directory", ACME_DIRECTORY_URL]
+        if ACME_CA_BUNDLE:
+            renew_argv += ["--acme-ca-bundle", os.path.abspath(ACME_CA_BUNDLE)]
+    cron_script = """#!/bin/bash
+{python} "{script}" {argv}
+exit 0
+""".format(python=sys.executable, script=os.path.abspath(__file__), argv=" ".join(renew_argv))
+    with open("/etc/cron.weekly/zmirror-letsencrypt-renew.sh", "w", encoding='utf-8') as fp:
+        fp.write(cron_script)
+    cmd('chmod +x /etc/cron.weekly/zmirror-letsencrypt-renew.sh')
+
+
+def apply_server_configs():
+    """
+    应用所有暂存的配置: configtest, 平滑重载, 健康检查, 失败时回滚
+        更换MPM, 或者 ServerLimit/ThreadLimit 有变化时, config_txn 用一次完全重启代替平滑重载
+    """
+    config_txn.commit()
+    if "mpm_event" not in this_server['configs']:  # nginx
+        return
+
+    mpm = apache_mpm()
+    if mpm == "event":
+        infoprint("Apache MPM: event")
+    else:
+        warnprint("Apache is not using the event MPM (`{}` reports: {}), "
+                  "HTTP/2 will be slow".format(this_server['version_command'], mpm))
+
+
+# ################# DNS预检 ####################
+# 在获取证书之前, 并行地向多个DNS服务器查询所有镜像域名的A/AAAA记录, 并与本机的所有IP比较
+#     DNS设置错误时 let's encrypt 的验证一定会失败, 在这里提前发现可以避免一次次无用的重试
+DNS_TYPE_A = 1
+DNS_TYPE_AAAA = 28
+DNS_TYPE_NAMES = {DNS_TYPE_A: "A", DNS_TYPE_AAAA: "AAAA"}
+# 除了 /etc/resolv.conf 中的DNS服务器以外, 还会查询的公共DNS服务器
+PUBLIC_DNS_RESOLVERS = ["8.8.8.8", "1.1.1.1"]
+# 用于获取本机公网IP的网址, 分别只能通过IPv4/IPv6访问
+PUBLIC_IP_URLS = ["https://api.ipify.org", "https://api6.ipify.org"]
+
+
+def _dns_skip_name(data, offset):
+    """跳过报文中的一个域名(可能是压缩指针), 返回之后的位置"""
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+
+def dns_query(domain, qtype, server, timeout=3.0, tries=2, port=53):
+    """
+    一个最小的UDP DNS客户端, 向 server 查询 domain 的 A 或 AAAA 记录
+        只解析回答中与 qtype 相同类型的记录, 递归DNS服务器返回的CNAME链的最终结果也在其中
+    :type qtype: int
+    :type port: int
+    :return: 查询到的IP列表, 域名不存在或者没有该类型的记录时为空列表
+    :rtype: list
+    """
+    query_id = random.randint(0, 0xFFFF)
+    question = b"".join(struct.pack("B", len(label)) + label
+                        for label in domain.rstrip(".").encode("idna").split(b".")) + b"\x00"
+    # 标志位 0x0100: 标准查询, 期望递归
+    packet = struct.pack(">HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + question + struct.pack(">HH", qtype, 1)
+
+    family = socket.AF_INET6 if ":" in server else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        for attempt in range(tries):
+            sock.sendto(packet, (server, port))
+            try:
+                while True:
+                    data, _ = sock.recvfrom(4096)
+                    if len(data) >= 12 and struct.unpack(">H", data[:2])[0] == query_id:
+                        break
+                break
+            except socket.timeout:
+                if attempt == tries - 1:
+                    raise
+
+    flags, qdcount, ancount = struct.unpack(">HHH", data[2:8])
+    rcode = flags & 0x000F
+    if rcode == 3:  # NXDOMAIN
+        return []
+    if rcode != 0:
+        raise RuntimeError("DNS server {} returns rcode {} for {}".format(server, rcode, domain))
+
+    offset = 12
+    for _ in range(qdcount):
+        offset = _dns_skip_name(data, offset) + 4
+    addresses = []
+    for _ in range(ancount):
+        offset = _dns_skip_name(data, offset)
+        rtype, _rclass, _ttl, rdlength = struct.unpack(">HHIH", data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+        if rtype == qtype == DNS_TYPE_A:
+            addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+        elif rtype == qtype == DNS_TYPE_AAAA:
+            addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+    return addresses
+
+
+def system_dns_resolvers():
+    """/etc/resolv.conf 中的DNS服务器"""
+    resolvers = []
+    try:
+        with open("/etc/resolv.conf", "r", encoding="utf-8") as fr:
+            for line in fr:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == "nameserver":
+                    resolvers.append(parts[1].split("%")[0])
+    except OSError:
+        pass
+    return resolvers
+
+
+def local_addresses():
+    """
+    本机所有网络接口上的可以从外部访问的IP地址 (来自 `ip -o addr`)
+    :rtype: set
+    """
+    addresses = set()
+    try:
+        output = subprocess.check_output(["ip", "-o", "addr"], stderr=subprocess.DEVNULL).decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        output = ""
+    for match in re.finditer(r"\binet6?\s+([0-9a-fA-F:.]+)", output):
+        addresses.add(match.group(1))
+    # 回环地址和链路本地地址不可能被 let's encrypt 访问到
+    addresses = {address for address in addresses
+                 if not (address.startswith("127.") or address == "::1" or address.lower().startswith("fe80:"))}
+    if not addresses:  # 没有 ip 命令时, 退回为主机名对应的地址
+        try:
+            addresses.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None))
+        except socket.gaierror:
+            pass
+    return addresses
+
+
+def public_address(url, timeout=5):
+    """通过 url 获取本机的公网IP, 失败时返回 None (比如本机没有IPv6)"""
+    try:
+        return requests.get(url, timeout=timeout).text.strip() or None
+    except Exception:
+        return None
+
+
+def dns_preflight(domains, resolvers=None):
+    """
+    并行地检查所有域名的DNS设置, 打印报告
+        每个域名的 A/AAAA 记录都必须指向本机的某个IP (本地网络接口的IP, 或者公网IP),
+        所有DNS服务器的结果都应该一致, 否则说明DNS设置还没有完全生效
+    :type domains: list
+    :return: 发现的问题
+    :rtype: list
+    """
+    resolvers = resolvers or list(OrderedDict.fromkeys(system_dns_resolvers() + PUBLIC_DNS_RESOLVERS))
+    infoprint("Checking DNS of {} domain(s) with resolvers: {}".format(len(domains), ", ".join(resolvers)))
+
+    with ThreadPoolExecutor(max_workers=min(32, len(domains) * len(resolvers) * 2 + len(PUBLIC_IP_URLS))) as executor:
+        public_futures = [executor.submit(public_address, url) for url in PUBLIC_IP_URLS]
+        query_futures = OrderedDict(
+            ((domain, qtype, resolver), executor.submit(dns_query, domain, qtype, resolver))
+            for domain in domains for qtype in (DNS_TYPE_A, DNS_TYPE_AAAA) for resolver in resolvers
+        )
+        this_host = local_addresses()
+        this_host.update(future.result() for future in public_futures if future.result())
+
+    infoprint("This machine's IPs:", ", ".join(sorted(this_host)))
+    problems = []
+    for domain in domains:
+        answered = {}  # (qtype, resolver) -> 地址集合
+        for resolver in resolvers:
+            for qtype in (DNS_TYPE_A, DNS_TYPE_AAAA):
+                try:
+                    answered[(qtype, resolver)] = set(query_futures[(domain, qtype, resolver)].result())
+                except Exception as e:
+                    warnprint("    {} {} @{}: query failed: {}".format(domain, DNS_TYPE_NAMES[qtype], resolver, e))
+        for qtype in (DNS_TYPE_A, DNS_TYPE_AAAA):
+            results = [answered[(qtype, resolver)] for resolver in resolvers if (qtype, resolver) in answered]
+            addresses = set().union(*results) if results else set()
+            name = DNS_TYPE_NAMES[qtype]
+            infoprint("    {} {}: {}".format(domain, name, ", ".join(sorted(addresses)) or "(none)"))
+            if not addresses:
+                continue
+            foreign = addresses - this_host
+            if foreign:
+                # let's encrypt 会优先使用IPv6, 所以错误的AAAA记录同样会导致验证失败
+                problems.append("{} {} record points to {}, which is not this machine".format(
+                    domain, name, ", ".join(sorted(foreign))))
+            if any(result != results[0] for result in results):
+                problems.append("{} {} record differs between resolvers, DNS may not be fully propagated".format(
+                    domain, name))
+        if not any(answered.get((DNS_TYPE_A, resolver)) or answered.get((DNS_TYPE_AAAA, resolver))
+                   for resolver in resolvers):
+            problems.append("{} has no A or AAAA record".format(domain))
+
+    for problem in problems:
+        warnprint(problem)
+    if not problems:
+        infoprint("DNS pre-flight check passed")
+    return problems
+
+
+# ################# TLS ####################
+# 每个镜像的会话缓存预算, 以及缓存最多占用的内存比例
+SSL_SESSION_CACHE_PER_MIRROR = 512 * 1024
+SSL_SESSION_CACHE_MEM_RATIO = 0.01
+SSL_STAPLING_CACHE_PER_MIRROR = 64 * 1024
+
+
+def openssl_version():
+    """
+    本机openssl的版本, 比如 (1, 1, 1), 无法获取时返回 (0,)
+    :rtype: tuple
+    """
+    try:
+        output = subprocess.check_output(["openssl", "version"]).decode("utf-8", "replace")
+        return tuple(int(x) for x in re.search(r"(\d+)\.(\d+)\.(\d+)", output).groups())
+    except (OSError, subprocess.CalledProcessError, AttributeError, ValueError):
+        return (0,)
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def tls_profile_values(mem_total_kb=None, mirror_count=None):
+    """
+    由本机内存和镜像数量计算TLS配置中的缓存大小
+        会话缓存: 每个镜像 512KB, 但不超过内存的 1% (最少 512KB, 最多 32MB)
+        OCSP stapling 缓存: 每个证书的OCSP响应只有几KB, 每个镜像 64KB (最少 128KB, 最多 2MB)
+    :rtype: dict
+    """
+    if mem_total_kb is None:
+        mem_total_kb = get_mem_total_kb() or 512 * 1024
+    if mirror_count is None:
+        installed = [m for m in mirrors_settings if os.path.isdir(os.path.join(htdoc, m))]
+        mirror_count = len(set(installed) | set(mirrors_to_deploy))
+    mirror_count = max(mirror_count, 1)
+
+    session_cache = _clamp(mirror_count * SSL_SESSION_CACHE_PER_MIRROR,
+                           512 * 1024, max(int(mem_total_kb * 1024 * SSL_SESSION_CACHE_MEM_RATIO), 512 * 1024))
+    session_cache = min(session_cache, 32 * 1024 * 1024)
+    stapling_cache = _clamp(mirror_count * SSL_STAPLING_CACHE_PER_MIRROR, 128 * 1024, 2 * 1024 * 1024)
+
+    # 曲线顺序: X25519 需要 openssl 1.1.0, 多个曲线(SSLOpenSSLConfCmd)需要 openssl 1.0.2
+    version = openssl_version()
+    if version >= (1, 1, 0):
+        curves = "X25519:prime256v1:secp384r1"
+    elif version >= (1, 0, 2):
+        curves = "prime256v1:secp384r1"
+    else:
+        curves = None
+    if curves:
+        curves_directive = "SSLOpenSSLConfCmd Curves " + curves
+    else:
+        curves_directive = "# SSLOpenSSLConfCmd is not supported by openssl {}".format(
+            ".".join(str(x) for x in version))
+    # SSLSessionTickets 需要 Apache 2.4.11 (Ubuntu 14.04 是 2.4.7, Debian 8 是 2.4.10), 更早的版本 configtest 会失败
+    #     nginx 的配置中没有这个占位符
+    if server_name != "apache":
+        session_tickets_directive = ""
+    else:
+        apache = apache_version()
+        if apache >= (2, 4, 11):
+            session_tickets_directive = "SSLSessionTickets on"
+        else:
+            session_tickets_directive = "# SSLSessionTickets is not supported by Apache {}".format(
+                ".".join(str(x) for x in apache))
+    # nginx 的 OCSP stapling 需要自己查询OCSP服务器的域名, IPv6地址需要加上方括号
+    resolvers = system_dns_resolvers() or PUBLIC_DNS_RESOLVERS
+
+    dbgprint("TLS profile: memory {}KB, {} mirror(s), session cache {}, stapling cache {}".format(
+        mem_total_kb, mirror_count, session_cache, stapling_cache))
+    return {
+        # 缓存较小(内存小)时, 会话也会更早地被挤出缓存, 没有必要保存一整天
+        "ssl_session_cache_bytes": session_cache // 1024 * 1024,
+        "ssl_session_timeout": 86400 if session_cache >= 4 * 1024 * 1024 else 3600,
+        "ssl_stapling_cache_bytes": stapling_cache,
+        "ssl_curves_directive": curves_directive,
+        "ssl_session_tickets_directive": session_tickets_directive,
+        "ssl_curves": curves or "prime256v1",
+        "ssl_protocols": "TLSv1.2 TLSv1.3" if version >= (1, 1, 1) else "TLSv1.2",
+        "resolvers": " ".join("[{}]".format(r) if ":" in r else r for r in resolvers),
+    }
+
+
+def tls_handshake_benchmark(server_name, host="127.0.0.1", port=443, seconds=5, concurrency=4,
+                            resume=False, ciphers=None):
+    """
+    在 seconds 秒内, 用 concurrency 个线程不断地与 host:port 进行TLS握手
+    :param resume: 复用第一次握手得到的会话(session id 或 ticket), 测试会话恢复的速度
+    :param ciphers: 限制客户端的cipher(同时限制为TLS1.2), 用于指定服务器使用的证书类型
+    :return: {"handshakes":, "per_second":, "p50_ms":, "p99_ms":, "resumed":, "errors":, "cipher":}
+    :rtype: dict
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if ciphers:
+        context.set_ciphers(ciphers)
+        context.options |= getattr(ssl, "OP_NO_TLSv1_3", 0)
+
+    def handshake(session=None):
+        sock = socket.create_connection((host, port), timeout=10)
+        try:
+            kwargs = {"session": session} if session is not None else {}
+            tls = context.wrap_socket(sock, server_hostname=server_name, **kwargs)
+            if resume and session is None:
+                # TLS1.3 的 ticket 在握手之后才发送, 需要先完成一次请求
+                tls.sendall("HEAD / HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n".format(
+                    server_name).encode("ascii"))
+                tls.recv(1024)
+            return tls.cipher()[0], getattr(tls, "session_reused", False), getattr(tls, "session", None)
+        finally:
+            sock.close()
+
+    cipher, _, session = handshake()
+    if resume and session is None:
+        warnprint("Session resumption is not supported by this python (requires 3.6+)")
+        return None
+
+    latencies = []
+    counters = {"resumed": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time() + seconds
+
+    def worker():
+        while time() < deadline:
+            start = time()
+            try:
+                _, reused, _ = handshake(session if resume else None)
+            except Exception as e:
+                dbgprint("TLS handshake failed:", e)
+                with lock:
+                    counters["errors"] += 1
+                continue
+            with lock:
+                latencies.append(time() - start)
+                counters["resumed"] += bool(reused)
+
+    started = time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+
+    latencies.sort()
+    return {
+        "handshakes": len(latencies),
+        "per_second": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        "resumed": counters["resumed"],
+        "errors": counters["errors"],
+        "cipher": cipher,
+    }
+
+
+# 测试项目 -> (是否复用会话, 限制的cipher)
+#     rsa/ecdsa 通过只提供对应的cipher, 让服务器使用该密钥类型的证书完成完整握手
+TLS_BENCHMARK_MODES = OrderedDict([
+    ("full", (False, None)),
+    ("resumed", (True, None)),
+    ("rsa", (False, "ECDHE-RSA-AES128-GCM-SHA256:ECDHE-RSA-AES256-GCM-SHA384")),
+    ("ecdsa", (False, "ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-GCM-SHA384")),
+])
+
+
+def run_tls_benchmark(domains=None, seconds=TLS_BENCHMARK_SECONDS, concurrency=TLS_BENCHMARK_CONCURRENCY):
+    """
+    对本机的每个zmirror https站点, 分别测试完整握手, 会话恢复, 以及每种密钥类型的证书的握手速度, 并打印结果
+        站点没有某种密钥类型的证书时, 跳过该项
+    """
+    domains = domains or zmirror_https_sites()
+    if not domains:
+        warnprint("No zmirror https site found")
+        return
+    print("{:<32} {:<8} {:>10} {:>9} {:>9} {:>8} {:>7}  {}".format(
+        "Domain", "Mode", "Handshakes", "Per sec", "p50 ms", "p99 ms", "Errors", "Cipher"))
+    for domain in domains:
+        for mode, (resume, ciphers) in TLS_BENCHMARK_MODES.items():
+            try:
+                result = tls_handshake_benchmark(domain, seconds=seconds, concurrency=concurrency,
+                                                 resume=resume, ciphers=ciphers)
+            except ssl.SSLError as e:
+                if ciphers:
+                    infoprint("{}: no {} certificate, skipping".format(domain, mode.upper()))
+                    continue
+                errprint("Unable to benchmark {}: {}".format(domain, e))
+                break
+            except Exception as e:
+                errprint("Unable to benchmark {}: {}".format(domain, e))
+                break
+            if result is None:
+                continue
+            if resume and result["resumed"] < result["handshakes"]:
+                warnprint("{}: only {}/{} handshakes were resumed".format(
+                    domain, result["resumed"], result["handshakes"]))
+            print("{:<32} {:<8} {:>10} {:>9.1f} {:>9.2f} {:>8.2f} {:>7}  {}".format(
+                domain, mode, result["handshakes"], result["per_second"], result["p50_ms"] or 0,
+                result["p99_ms"] or 0, result["errors"], result["cipher"]))
+
+
+if tls_benchmark:
+    run_tls_benchmark()
+    exit()
+
+
+# ################# WSGI进程 ####################
+# 由CPU数量, 内存, 镜像数量和每个镜像的权重, 计算每个镜像的 WSGIDaemonProcess 参数
+#     zmirror的请求主要是等待上游网站, 线程可以掩盖IO等待, 但是受GIL限制, 多核需要多个进程
+# 每个进程的内存估计(python, zmirror 以及它的内存缓存), 以及每个线程额外的内存估计
+WSGI_PROCESS_MEMORY_KB = 64 * 1024
+WSGI_THREAD_MEMORY_KB = 2 * 1024
+# 留给系统和Apache自身的内存: 256MB, 或者总内存的 15%, 取较大者
+WSGI_RESERVED_MEMORY_KB = 256 * 1024
+WSGI_RESERVED_MEMORY_RATIO = 0.15
+# 每个CPU核心最多的进程数, 以及每个CPU核心的目标并发请求数
+WSGI_PROCESSES_PER_CPU = 2
+WSGI_CONCURRENCY_PER_CPU = 16
+WSGI_MIN_THREADS = 4
+WSGI_MAX_THREADS = 32
+# gevent worker: 每个正在处理的请求(协程及其缓冲的响应)的内存估计, 每单位权重的目标并发数, 以及每个进程的并发数范围
+#     协程在等待上游网站时不占用线程, 并发数只受内存限制, CPU密集的内容改写仍然需要多个进程
+GEVENT_CONNECTION_MEMORY_KB = 256
+GEVENT_CONNECTIONS_PER_WEIGHT = 100
+GEVENT_MIN_CONNECTIONS = 32
+GEVENT_MAX_CONNECTIONS = 1000
+# PyPy 进程的内存估计 (JIT编译的代码, 以及更晚回收内存的GC), 以及回收进程的请求数倍数
+#     回收进程会丢失JIT编译的结果, 所以更少回收
+PYPY_PROCESS_MEMORY_KB = 160 * 1024
+PYPY_MAXIMUM_REQUESTS_FACTOR = 5
+# PyPy worker 在接受请求之前用多少个请求(最多多少秒)预热JIT
+PYPY_WARMUP_REQUESTS = 50
+PYPY_WARMUP_SECONDS = 15
+
+
+def wsgi_daemon_sizing(mirrors, cpu_count=None, mem_total_kb=None, models=None):
+    """
+    计算每个镜像的 WSGIDaemonProcess 参数
+        进程总数受CPU(每核 WSGI_PROCESSES_PER_CPU 个)和内存的限制, 按权重分配给各个镜像, 每个镜像至少一个
+        线程数使每个镜像的并发数达到按权重分配的目标并发数, 但不超过每个进程平均可用的内存
+        gevent 镜像没有线程数, 而是每个进程的协程并发数 (worker-connections)
+        PyPy 的进程占用更多内存, 回收得也更少
+        内存紧张时, 更频繁地回收进程, 空闲的进程也会更早地退出
+    :param mirrors: 所有镜像名, 包括已安装的镜像, 因为它们同样占用内存
+    :type mirrors: list
+    :param models: 镜像名 -> 工作模型, 默认由 --worker-model 决定
+    :type models: dict
+    :return: {"mirrors": {镜像名: {参数名: 值}}, "required_kb": 预计占用的内存, "available_kb": 可用的内存,
+              "minimum_kb": 每个镜像一个进程, 最少线程时占用的内存}
+    :rtype: dict
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    mem_total_kb = mem_total_kb or get_mem_total_kb() or 512 * 1024
+    models = models or {mirror: mirror_worker_model(mirror) for mirror in mirrors}
+    process_kb = PYPY_PROCESS_MEMORY_KB if runtime == "pypy" else WSGI_PROCESS_MEMORY_KB
+    available_kb = mem_total_kb - max(WSGI_RESERVED_MEMORY_KB, int(mem_total_kb * WSGI_RESERVED_MEMORY_RATIO))
+    weights = OrderedDict((mirror, mirrors_settings[mirror].get("weight", 1)) for mirror in mirrors)
+    total_weight = sum(weights.values()) or 1
+
+    # 进程总数, 至少每个镜像一个
+    per_process_kb = process_kb + WSGI_THREAD_MEMORY_KB * 12
+    by_memory = max(available_kb, 0) // per_process_kb
+    total_processes = max(len(mirrors), min(cpu_count * WSGI_PROCESSES_PER_CPU, by_memory))
+
+    # 按权重分配进程 (最大余数法), 每个镜像至少一个
+    shares = OrderedDict((mirror, total_processes * weight / total_weight) for mirror, weight in weights.items())
+    processes = OrderedDict((mirror, max(1, int(share))) for mirror, share in shares.items())
+    for mirror in sorted(shares, key=lambda m: shares[m] - int(shares[m]), reverse=True):
+        if sum(processes.values()) >= total_processes:
+            break
+        processes[mirror] += 1
+
+    target_concurrency = WSGI_CONCURRENCY_PER_CPU * cpu_count
+    threads_by_memory = (available_kb / total_processes - process_kb) // WSGI_THREAD_MEMORY_KB
+    connections_by_memory = (available_kb / total_processes - process_kb) // GEVENT_CONNECTION_MEMORY_KB
+    required_kb = 0
+    result = OrderedDict()
+    for mirror, weight in weights.items():
+        if models.get(mirror) == "gevent":
+            connections = int(_clamp(min(GEVENT_CONNECTIONS_PER_WEIGHT * weight, connections_by_memory),
+                                     GEVENT_MIN_CONNECTIONS, GEVENT_MAX_CONNECTIONS))
+            required_kb += processes[mirror] * (process_kb + GEVENT_CONNECTION_MEMORY_KB * connections)
+            result[mirror] = OrderedDict([
+                ("processes", processes[mirror]),
+                ("worker-connections", connections),
+                ("listen-backlog", int(_clamp(processes[mirror] * connections, 100, 2048))),
+                ("queue-timeout", 30),
+                ("request-timeout", 120 * weight),
+            ])
+            continue
+        concurrency = max(12, target_concurrency * weight / total_weight)
+        threads = int(_clamp(min(-(-concurrency // processes[mirror]), threads_by_memory),
+                             WSGI_MIN_THREADS, WSGI_MAX_THREADS))
+        required_kb += processes[mirror] * (process_kb + WSGI_THREAD_MEMORY_KB * threads)
+        result[mirror] = OrderedDict([
+            ("processes", processes[mirror]),
+            ("threads", threads),
+            # 所有线程都忙时, Apache把请求排队给daemon进程
+            ("listen-backlog", int(_clamp(processes[mirror] * threads * 4, 100, 1024))),
+            ("queue-timeout", 30),
+            # 权重高的镜像(比如视频)的响应时间更长
+            ("request-timeout", 120 * weight),
+        ])
+
+    tight = required_kb > available_kb * 0.8
+    maximum_requests = (2000 if tight else 10000) * (PYPY_MAXIMUM_REQUESTS_FACTOR if runtime == "pypy" else 1)
+    for options in result.values():
+        # 定期回收进程以限制内存泄露, 回收时等待正在处理的请求完成
+        options["maximum-requests"] = maximum_requests
+        options["graceful-timeout"] = 30
+        # 空闲的进程退出以释放内存, 有新的请求时再启动
+        options["inactivity-timeout"] = 600 if tight else 3600
+    return {
+        "mirrors": result,
+        "required_kb": required_kb,
+        "available_kb": available_kb,
+        "minimum_kb": len(mirrors) * (process_kb + WSGI_THREAD_MEMORY_KB * WSGI_MIN_THREADS),
+    }
+
+
+# 每个Apache子进程的内存估计, 以及子进程最多占用的内存比例
+APACHE_CHILD_MEMORY_KB = 24 * 1024
+APACHE_CHILD_MEMORY_RATIO = 0.1
+
+
+def mpm_event_values(sizing, cpu_count=None, mem_total_kb=None):
+    """
+    由本机资源和所有镜像的WSGI线程数计算 event MPM, keep-alive 和 HTTP/2 的参数
+        daemon 模式下, 每个正在处理的WSGI请求占用一个Apache工作线程, 再加上静态文件和排队的余量
+        子进程数同时受内存限制, ServerLimit 留出余量, 让平滑重载时旧的子进程可以处理完正在进行的请求
+    :param sizing: wsgi_daemon_sizing() 的结果
+    :rtype: dict
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    mem_total_kb = mem_total_kb or get_mem_total_kb() or 512 * 1024
+    wsgi_threads = sum(options["processes"] * options["threads"] for options in sizing["mirrors"].values())
+
+    threads_per_child = 25 if cpu_count < 8 else 64
+    workers = max(150, wsgi_threads * 2 + 64)
+    children = -(-workers // threads_per_child)
+    children = int(_clamp(children, 2, max(2, mem_total_kb * APACHE_CHILD_MEMORY_RATIO // APACHE_CHILD_MEMORY_KB)))
+    return {
+        "start_servers": min(children, max(2, cpu_count // 2)),
+        "server_limit": children + max(2, children // 2),
+        "threads_per_child": threads_per_child,
+        "min_spare_threads": threads_per_child,
+        "max_spare_threads": threads_per_child * 3,
+        "max_request_workers": children * threads_per_child,
+        "async_request_worker_factor": 4 if mem_total_kb >= 1024 * 1024 else 2,
+        "max_keep_alive_requests": 1000,
+        "keep_alive_timeout": 10 if mem_total_kb >= 1024 * 1024 else 5,
+        # 每个HTTP/2连接中同时进行的请求数不需要超过WSGI能同时处理的请求数
+        "h2_max_session_streams": int(_clamp(wsgi_threads, 32, 128)),
+        "h2_window_size": 1048576 if mem_total_kb >= 2 * 1024 * 1024 else 131072,
+    }
+
+
+# mod_wsgi 4.1 之前没有的 WSGIDaemonProcess 参数, ubuntu 14.04 的 mod_wsgi 3.4 遇到它们时 configtest 会失败
+WSGI_OPTIONS_REQUIRE_4_1 = ("listen-backlog", "queue-timeout", "request-timeout", "graceful-timeout")
+
+
+def mod_wsgi_version():
+    """
+    已安装的 mod_wsgi 的版本, 比如 (4, 6), 无法获取时返回 None
+    :rtype: tuple|None
+    """
+    try:
+        version = subprocess.check_output(["dpkg-query", "-W", "-f=${Version}", "libapache2-mod-wsgi-py3"],
+                                          stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # 形如 4.6.8-1ubuntu3 或者 3.4-4ubuntu2.1.14.04.2, 可能带有 epoch
+    match = re.match(r"(?:\d+:)?(\d+)\.(\d+)", version)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def wsgi_daemon_options(options, version=None):
+    """
+    WSGIDaemonProcess 的参数字符串, 只包含已安装的 mod_wsgi 支持的参数
+    :param version: mod_wsgi 的版本, 默认为已安装的版本, 无法获取时认为支持所有参数
+    :type version: tuple
+    :rtype: str
+    """
+    version = version or mod_wsgi_version()
+    return " ".join("{}={}".format(key, value) for key, value in options.items()
+                    if not (version and version < (4, 1) and key in WSGI_OPTIONS_REQUIRE_4_1))
+
+
+def gunicorn_options(options):
+    """
+    --server nginx 时, 与 WSGIDaemonProcess 参数等价的 gunicorn 参数
+        gunicorn 没有 queue-timeout 和 inactivity-timeout, 排队由 backlog 限制
+        有 worker-connections 时使用 gevent worker, 它在加载zmirror之前 monkey patch 标准库
+    :rtype: str
+    """
+    if "worker-connections" in options:
+        worker = "--worker-class gevent --workers {} --worker-connections {}".format(
+            options["processes"], options["worker-connections"])
+    else:
+        worker = "--worker-class gthread --workers {} --threads {}".format(options["processes"], options["threads"])
+    return ("{worker} --backlog {backlog} --timeout {timeout} --graceful-timeout {graceful} "
+            "--max-requests {max_requests} --max-requests-jitter {jitter}").format(
+        worker=worker, backlog=options["listen-backlog"],
+        timeout=options["request-timeout"], graceful=options["graceful-timeout"],
+        max_requests=options["maximum-requests"], jitter=options["maximum-requests"] // 10)
+
+
+# gevent 镜像的应用服务的环境变量
+#     DNS查询在线程池中进行, 不阻塞其他协程
+#     监视线程把阻塞事件循环超过 GEVENT_MAX_BLOCKING_TIME 秒的协程(比如改写很大的网页)的调用栈输出到日志,
+#         阻塞期间该进程的所有请求都在等待, 经常出现时应增加进程数或使用 thread 模型
+GEVENT_MAX_BLOCKING_TIME = 1
+
+
+def app_environment(options):
+    """
+    应用服务的 systemd unit 中的 Environment= 行
+    :rtype: str
+    """
+    if "worker-connections" not in options:
+        return ""
+    return "\n".join("Environment={}={}".format(key, value) for key, value in [
+        ("GEVENT_RESOLVER", "thread"),
+        ("GEVENT_MONITOR_THREAD_ENABLE", "true"),
+        ("GEVENT_MAX_BLOCKING_TIME", GEVENT_MAX_BLOCKING_TIME),
+    ])
+
+
+def app_server_command(mirror=None):
+    """
+    运行 gunicorn 的命令, 使用安装了zmirror依赖的 python3, 或者 PyPy 虚拟环境中的 python
+        PyPy 的镜像还会加载预热JIT的配置文件
+    :rtype: str
+    """
+    if runtime != "pypy":
+        return "{} -m gunicorn".format(shutil.which("python3") or "/usr/bin/python3")
+    command = "{} -m gunicorn".format(pypy_python())
+    if mirror:
+        command += " --config " + os.path.join(htdoc, mirror, "gunicorn_warmup.py")
+    return command
+
+
+def check_wsgi_sizing(sizing):
+    """
+    打印每个镜像的WSGI参数, 内存不足时警告
+        即使每个镜像只有一个进程也放不下时, 拒绝安装 (除非使用了 --skip-memory-check)
+    """
+    infoprint("WSGI daemon processes (memory available for mirrors: {}MB, estimated: {}MB):".format(
+        sizing["available_kb"] // 1024, sizing["required_kb"] // 1024))
+    for mirror, options in sizing["mirrors"].items():
+        print("    {}: {}".format(mirror, gunicorn_options(options) if server_name == "nginx"
+                                  else wsgi_daemon_options(options)))
+    if sizing["minimum_kb"] > sizing["available_kb"]:
+        errprint("Not enough memory for {} mirror(s): at least {}MB is required, only {}MB is available".format(
+            len(sizing["mirrors"]), sizing["minimum_kb"] // 1024, sizing["available_kb"] // 1024))
+        if "--skip-memory-check" not in sys.argv:
+            errprint("Aborting..., please deploy fewer mirrors on this host (or use --skip-memory-check)")
+            raise SystemExit("Not enough memory")
+    elif sizing["required_kb"] > sizing["available_kb"]:
+        warnprint("The mirrors may use more memory than available, consider deploying fewer mirrors on this host")
+
+
+# ################# 工作模型性能测试 ####################
+# 用一个很慢的本地HTTP服务器模拟上游网站, 分别用每种工作模型的一个 gunicorn 进程代理它,
+#     比较同时在等待上游的请求数: thread 模型受线程数限制, gevent 模型受 worker-connections 限制
+# 被测试的应用: 与zmirror一样, 把每个请求转发给上游网站
+WORKER_BENCHMARK_APP = """
+import os
+from urllib.request import urlopen
 
-try:
-    import requests
-except:
-    errprint('Could not install requests, program exit')
-    onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
-    raise
+UPSTREAM = os.environ["ZMIRROR_BENCHMARK_UPSTREAM"]
 
-server_configs = {
-    "apache": {
-        "config_root": "/etc/apache2/",
-        "htdoc": "/var/www/",
 
-        "common_configs": ["http_generic", "apache_boilerplate"],
-        "site_unique_configs": ["https"],
+def application(environ, start_response):
+    body = urlopen(UPSTREAM + environ.get("PATH_INFO", "/"), timeout=300).read()
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    return [body]
+"""
 
-        "pre_delete_files": [
-            "{config_root}/sites-enabled/000-default.conf",
-            "{config_root}/conf-enabled/apache2-doc.conf",
-            "{config_root}/conf-enabled/security.conf",
-        ],
 
-        "configs": {
-            "apache_boilerplate": {
-                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-boilerplate.conf"),
-                "file_path": "conf-enabled/zmirror-apache-boilerplate.conf",
-            },
+def free_port():
+    """
+    本机的一个空闲TCP端口
+    :rtype: int
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
 
-            "http_generic": {
-                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-http.conf"),
-                "file_path": "sites-enabled/zmirror-http-redirection.conf",
-            },
 
-            "https": {
-                "url": urljoin(__ONKEY_PROJECT_URL_CONTENT__, "configs/apache2-https.conf"),
-                "file_path": "sites-enabled/zmirror-{mirror_name}-https.conf",
-            },
-        }
+def slow_upstream(delay):
+    """
+    启动一个模拟上游网站的HTTP服务器, 每个请求等待 delay 秒后返回
+    :return: (server, stats), stats 中的 max_in_flight 为同时在处理的最大请求数
+    """
+    import http.server
+    import socketserver
+    stats = {"in_flight": 0, "max_in_flight": 0}
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                stats["in_flight"] += 1
+                stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            try:
+                _sleep(delay)
+                body = b"x" * 2048
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                with lock:
+                    stats["in_flight"] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", free_port()), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
 
+def worker_model_benchmark(options, upstream_url, seconds=5, concurrency=64):
+    """
+    用 options 启动一个 gunicorn, 在 seconds 秒内用 concurrency 个客户端不断地请求它
+    :param options: 每个镜像的WSGI参数, 与 wsgi_daemon_sizing() 的结果相同
+    :return: {"requests":, "per_second":, "p50_ms":, "p99_ms":, "errors":}, gunicorn 无法启动时为 None
+    :rtype: dict
+    """
+    from urllib.request import urlopen
+    app_dir = tempfile.mkdtemp(prefix="zmirror_worker_benchmark_")
+    with open(os.path.join(app_dir, "benchmark_app.py"), "w", encoding="utf-8") as fw:
+        fw.write(WORKER_BENCHMARK_APP)
+    port = free_port()
+    env = dict(os.environ, ZMIRROR_BENCHMARK_UPSTREAM=upstream_url)
+    if "worker-connections" in options:
+        env.update(re.findall(r"^Environment=([^=]+)=(.*)$", app_environment(options), re.M))
+    command = "{} {} --bind 127.0.0.1:{} --chdir {} benchmark_app:application".format(
+        app_server_command(), gunicorn_options(options), port, app_dir)
+    dbgprint("Starting:", command)
+    server = subprocess.Popen(command.split(), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time() + 15
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time() > deadline:
+                    return None
+                _sleep(0.2)
+
+        latencies = []
+        counters = {"errors": 0}
+        lock = threading.Lock()
+        deadline = time() + seconds
+
+        def client():
+            while time() < deadline:
+                start = time()
+                try:
+                    urlopen("http://127.0.0.1:{}/".format(port), timeout=300).read()
+                except Exception as e:
+                    dbgprint("Request failed:", e)
+                    with lock:
+                        counters["errors"] += 1
+                    continue
+                with lock:
+                    latencies.append(time() - start)
+
+        started = time()
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time() - started
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "per_second": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        "errors": counters["errors"],
     }
-}
 
-mirrors_settings = {
-    'google': {
-        'domain': None,
-        'cfg': [('more_configs/config_google_and_zhwikipedia.py', 'config.py'), ],
-        "certs": {
-            "private_key": None,
-            "cert": None,
-            "intermediate": None,
-        },
-        "installed_path": "",
-    },
 
-    'youtubePC': {
-        'domain': None,
-        'cfg': [('more_configs/config_youtube.py', 'config.py'),
-                ('more_configs/custom_func_youtube.py', 'custom_func.py')],
-        "certs": {},
-        "installed_path": "",
-    },
+def run_worker_benchmark(mirror="google", seconds=WORKER_BENCHMARK_SECONDS,
+                         concurrency=WORKER_BENCHMARK_CONCURRENCY, delay=WORKER_BENCHMARK_UPSTREAM_DELAY):
+    """
+    对每种工作模型, 用本机为 mirror 生成的参数(只用一个进程)测试, 并打印结果
+        缺少 gunicorn 或 gevent 时先安装, 仍然无法导入时跳过该模型
+    """
+    python = app_server_command().split()[0]
+    missing = [package for package in ("gunicorn", "gevent")
+               if subprocess.call([python, "-c", "import " + package],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0]
+    if missing:
+        infoprint("Installing", ", ".join(missing), "for the benchmark")
+        pip_install(missing, name="worker_benchmark", allow_failure=True, python=python)
+
+    upstream, stats = slow_upstream(delay)
+    infoprint("Stand-in upstream: {}s per request, {} concurrent clients, {}s per model".format(
+        delay, concurrency, seconds))
+    print("{:<8} {:<34} {:>9} {:>9} {:>10} {:>10} {:>7}  {}".format(
+        "Model", "Per process", "Requests", "Per sec", "p50 ms", "p99 ms", "Errors", "Max in-flight upstream"))
+    try:
+        for model in WORKER_MODELS:
+            options = wsgi_daemon_sizing([mirror], models={mirror: model})["mirrors"][mirror]
+            options["processes"] = 1
+            limit = "{} connections".format(options["worker-connections"]) if model == "gevent" \
+                else "{} threads".format(options["threads"])
+            stats["max_in_flight"] = 0
+            result = worker_model_benchmark(options, "http://127.0.0.1:{}".format(upstream.server_address[1]),
+                                            seconds=seconds, concurrency=concurrency)
+            if result is None:
+                errprint("Unable to start gunicorn with the {} worker, skipping".format(model))
+                continue
+            print("{:<8} {:<34} {:>9} {:>9.1f} {:>10.1f} {:>10.1f} {:>7}  {}".format(
+                model, limit, result["requests"], result["per_second"], result["p50_ms"] or 0,
+                result["p99_ms"] or 0, result["errors"], stats["max_in_flight"]))
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
 
-    'youtubeMobile': {
-        'domain': None,
-        'cfg': [('more_configs/config_youtube_mobile.py', 'config.py'),
-                ('more_configs/custom_func_youtube.py', 'custom_func.py')],
-        "certs": {},
-        "installed_path": "",
-    },
 
-    'twitterPC': {
-        'domain': None,
-        'cfg': [('more_configs/config_twitter_pc.py', 'config.py'),
-                ('more_configs/custom_func_twitter.py', 'custom_func.py'), ],
-        "certs": {},
-        "installed_path": "",
-    },
+if worker_benchmark:
+    run_worker_benchmark()
+    exit()
 
-    'twitterMobile': {
-        'domain': None,
-        'cfg': [('more_configs/config_twitter_mobile.py', 'config.py'),
-                ('more_configs/custom_func_twitter.py', 'custom_func.py'), ],
-        "certs": {},
-        "installed_path": "",
-    },
 
-    'instagram': {
-        'domain': None,
-        'cfg': [('more_configs/config_instagram.py', 'config.py'), ],
-        "certs": {},
-        "installed_path": "",
-    },
-}
+# ################# 更新证书 ##########################
+# 证书过期时间的索引: 所有 let's encrypt 证书, 以及Apache配置中实际使用的证书(包括用户自己提供的)
+#     索引缓存在文件中, 证书文件没有变化时不会重新用openssl读取
+CERT_INDEX_PATH = os.path.join(NATIVE_ACME_ROOT, "cert-index.json")
+CERTBOT_RENEWAL_DIR = "/etc/letsencrypt/renewal"
 
-infoprint('OneKey deploy script for zmirror. version', __VERSION__)
-infoprint('This script will automatically deploy mirror(s) using zmirror in your ubuntu')
-infoprint('You could cancel this script in the config stage by precessing Ctrl-C')
-infoprint('Installation will start after 1 second')
-print()
-sleep(1)
-# ################# 检测镜像是否已安装 ################
-htdoc = server_configs["apache"]['htdoc']  # type: str
-for mirror, values in list(mirrors_settings.items()):
-    this_mirror_folder = os.path.join(htdoc, mirror)
-    # 如果文件夹不存在, 则跳过
-    if os.path.exists(this_mirror_folder):
-        infoprint("Mirror:", mirror, "was already installed in", this_mirror_folder)
-        mirrors_settings[mirror]["installed_path"] = this_mirror_folder
 
-# ################# 仅升级 ##########################
-if upgrade_only:
-    infoprint("Upgrade Only")
-    htdoc = server_configs["apache"]['htdoc']  # type: str
-    success_count = 0
+class CertIndex:
+    """
+    证书过期时间的索引, 每个证书文件是一个条目:
+        {"name":, "kind": native|certbot|manual, "not_after": 时间戳, "domains": [], "fingerprint":, "mtime":, "size":}
+        kind 为 manual 的证书(用户自己提供的)无法自动更新, 只会提醒
+    """
 
-    infoprint("Upgrading dependencies")
-    cmd("python3 -m pip install -U pip", allow_failure=True)
-    cmd("python3 -m pip install flask", allow_failure=True)
-    cmd("python3 -m pip install -U cchardet", allow_failure=True)
-    cmd("python3 -m pip install -U fastcache", allow_failure=True)
-    cmd("python3 -m pip install -U lru-dict", allow_failure=True)
+    def __init__(self, path=CERT_INDEX_PATH):
+        self.path = path
+        self.entries = {}  # 证书路径 -> 条目
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as fr:
+                    self.entries = json.load(fr)["entries"]
+            except (OSError, ValueError, KeyError):
+                warnprint("Unable to load cert index {}, rebuilding".format(path))
 
-    for mirror, values in mirrors_settings.items():
-        this_mirror_folder = values["installed_path"]
+    @staticmethod
+    def read_cert(cert_file):
+        """
+        用一次openssl读取证书的过期时间, 指纹和域名
+        :rtype: dict
+        """
+        text = _openssl(["x509", "-noout", "-enddate", "-fingerprint", "-sha256", "-text", "-in", cert_file])
+        text = text.decode("utf-8", "replace")
+        not_after = datetime.strptime(re.search(r"notAfter=(.+)", text).group(1).strip(), "%b %d %H:%M:%S %Y %Z")
+        return {
+            "not_after": (not_after - datetime(1970, 1, 1)).total_seconds(),
+            "fingerprint": re.search(r"Fingerprint=([0-9A-F:]+)", text).group(1),
+            "domains": re.findall(r"DNS:([^\s,]+)", text),
+        }
 
-        # 如果文件夹不存在, 则跳过
-        if not this_mirror_folder or not os.path.exists(this_mirror_folder):
-            infoprint("Mirror:", mirror, "not found, skipping")
-            continue
+    @staticmethod
+    def sources():
+        """
+        :return: 证书路径 -> (证书名, 类型)
+        :rtype: OrderedDict
+        """
+        found = OrderedDict()
+        if os.path.isdir(LETSENCRYPT_LIVE):
+            for name in sorted(os.listdir(LETSENCRYPT_LIVE)):
+                cert_file = os.path.join(LETSENCRYPT_LIVE, name, "cert.pem")
+                if not os.path.exists(cert_file):
+                    continue
+                if os.path.exists(os.path.join(NATIVE_ACME_RENEWAL_DIR, name + ".json")):
+                    found[cert_file] = (name, "native")
+                elif os.path.exists(os.path.join(CERTBOT_RENEWAL_DIR, name + ".conf")):
+                    found[cert_file] = (name, "certbot")
+                else:
+                    found[cert_file] = (name, "manual")
+
+        # Apache配置中实际使用的证书, 以及本次安装中用户提供的证书
+        sites_folder = os.path.join(this_server['config_root'], "sites-enabled")
+        in_use = []
+        if os.path.isdir(sites_folder):
+            for filename in sorted(os.listdir(sites_folder)):
+                if not filename.startswith("zmirror-"):
+                    continue
+                with open(os.path.join(sites_folder, filename), "r", encoding="utf-8") as fr:
+                    in_use += re.findall(r"^\s*(?:SSLCertificateFile|ssl_certificate)\s+([^\s;]+)", fr.read(), re.M)
+        in_use += [values["certs"]["cert"] for values in mirrors_settings.values()
+                   if values.get("certs") and values["certs"].get("cert")]
+        for cert_file in in_use:
+            if cert_file.startswith(LETSENCRYPT_LIVE):
+                # dual 模式的配置中使用的是 fullchain.pem
+                cert_file = os.path.join(os.path.dirname(cert_file), "cert.pem")
+            else:
+                cert_file = os.path.realpath(cert_file)
+            if cert_file not in found and os.path.exists(cert_file):
+                found[cert_file] = (os.path.basename(os.path.dirname(cert_file)), "manual")
+        return found
+
+    def scan(self):
+        """刷新索引, 只重新读取有变化的证书文件"""
+        entries = {}
+        for cert_file, (name, kind) in self.sources().items():
+            stat = os.stat(cert_file)
+            entry = self.entries.get(cert_file)
+            if not entry or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+                try:
+                    entry = self.read_cert(cert_file)
+                except Exception as e:
+                    warnprint("Unable to read certificate {}: {}".format(cert_file, e))
+                    continue
+                entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            entry.update(name=name, kind=kind)
+            entries[cert_file] = entry
+        self.entries = entries
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as fw:
+            json.dump({"entries": entries, "time": str(datetime.now())}, fw, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+        return self
+
+    def due(self, days):
+        """
+        :return: days 天内将会过期的证书, (证书路径, 条目) 的列表, 按过期时间排序
+        :rtype: list
+        """
+        deadline = time() + days * 86400
+        return sorted(((cert_file, entry) for cert_file, entry in self.entries.items()
+                       if entry["not_after"] < deadline), key=lambda item: item[1]["not_after"])
+
+    def print_status(self):
+        if not self.entries:
+            infoprint("No certificate found")
+            return
+        print("{:<32} {:<8} {:<20} {:>9}  {}".format("Name", "Kind", "Expires (UTC)", "Days left", "Domains"))
+        for cert_file, entry in sorted(self.entries.items(), key=lambda item: item[1]["not_after"]):
+            print("{:<32} {:<8} {:<20} {:>9.1f}  {}".format(
+                entry["name"], entry["kind"],
+                datetime.utcfromtimestamp(entry["not_after"]).strftime("%Y-%m-%d %H:%M:%S"),
+                (entry["not_after"] - time()) / 86400, ", ".join(entry["domains"])))
+            dbgprint("    ", cert_file, entry["fingerprint"])
+
+
+def renew_cert(name, kind):
+    """更新一个证书"""
+    if kind == "native":
+        with open(os.path.join(NATIVE_ACME_RENEWAL_DIR, name + ".json"), "r", encoding="utf-8") as fr:
+            renewal = json.load(fr)
+        challenges = {
+            type_: CHALLENGE_TYPES[type_](**settings)
+            for type_, settings in renewal.get(
+                "challenges", {"http-01": {"webroot": this_server['acme_webroot']}}).items()
+        }
+        client = native_acme
+        if renewal["directory"] != native_acme.directory_url:
+            client = AcmeClient(renewal["directory"], native_acme.account_key_path,
+                                verify=native_acme.session.verify)
+        client.issue(renewal["domains"], name, challenges, key_type=renewal.get("key_type", "rsa"))
+        return
 
-        # 否则进行升级
-        infoprint("Upgrading:", mirror)
-        try:
-            cmd("git pull", cwd=this_mirror_folder, allow_failure=False)
-        except:
-            errprint("Unable to upgrade:", mirror)
-            onekey_report(
-                report_type=REPORT_ERROR,
-                traceback_str=traceback.format_exc(),
-                msg="Unable to upgrade:" + mirror
-            )
-        else:
-            success_count += 1
+    # certbot: 只更新这一个证书, 使用签发时保存的验证方式; 是否需要更新已经由本脚本决定了, 所以强制更新
+    hooks = ""
+    with open(os.path.join(CERTBOT_RENEWAL_DIR, name + ".conf"), "r", encoding="utf-8") as fr:
+        if re.search(r"^authenticator\s*=\s*standalone", fr.read(), re.M):
+            # 旧的 standalone 证书需要在更新期间停止服务器
+            hooks = '--pre-hook "{}" --post-hook "{}"'.format(this_server['stop_command'], this_server['start_command'])
+    cmd('/etc/certbot/certbot-auto renew -n --agree-tos --force-renewal --cert-name "{}" {}'.format(name, hooks),
+        cwd='/etc/certbot/', allow_failure=False)
 
-    if success_count:
-        infoprint("zmirror upgrade complete, restarting apache2 ")
+
+def renew_due_certs(days=30, max_delay=0):
+    """
+    只更新 days 天内将会过期的证书, 每次更新之前随机等待 0~max_delay 秒, 避免所有主机同时访问ACME服务器
+    :return: 是否有证书真的发生了变化
+    :rtype: bool
+    """
+    index = CertIndex().scan()
+    due = index.due(days)
+    if not due:
+        infoprint("No certificate expires within {} days".format(days))
+        return False
+    random.shuffle(due)
+
+    changed = False
+    for cert_file, entry in due:
+        days_left = (entry["not_after"] - time()) / 86400
+        if entry["kind"] == "manual":
+            warnprint("Certificate {} ({}) expires in {:.1f} days, it was provided by you, "
+                      "please renew it manually".format(entry["name"], cert_file, days_left))
+            continue
+        if max_delay:
+            seconds_to_wait = random.uniform(0, max_delay)
+            infoprint("Renewing {} in {:.0f} seconds".format(entry["name"], seconds_to_wait))
+            sleep(seconds_to_wait)
+        infoprint("Renewing: {} ({}, expires in {:.1f} days)".format(entry["name"], entry["kind"], days_left))
         try:
-            cmd("service apache2 restart", no_tee=True, allow_failure=True)
-        except:
-            errprint("Unable to restart apache2, please execute `service apache2 restart` manually")
-            onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
-        else:
-            onekey_report(report_type=REPORT_SUCCESS, msg="Success Count:{}".format(success_count))
+            renew_cert(entry["name"], entry["kind"])
+        except Exception:
+            errprint("Unable to renew:", entry["name"])
+            onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc(),
+                          msg="Unable to renew:" + entry["name"])
+            continue
+        new_entry = index.scan().entries.get(cert_file)
+        if new_entry and new_entry["fingerprint"] != entry["fingerprint"]:
+            changed = True
+    return changed
 
+
+if cert_status:
+    CertIndex().scan().print_status()
+    exit()
+
+if renew_certs:
+    profiler.phase("renew")
+    if renew_due_certs(days=renew_window, max_delay=renew_max_delay):
+        # 只有证书真的发生了变化才平滑重载Apache
+        infoprint("Certificate(s) changed, reloading", this_server['service_name'])
+        cmd(this_server['reload_command'], allow_failure=True)
     exit()
 
 # ################# 安装一些依赖包 ####################
 infoprint('Installing some necessarily packages')
+profiler.phase("prepare")
 
 try:
     # 设置本地时间为北京时间
@@ -470,76 +4292,41 @@ try:
     except:
         pass
     # 告诉apt-get要安静
-    cmd('export DEBIAN_FRONTEND=noninteractive')
     os.environ['DEBIAN_FRONTEND'] = "noninteractive"
-    # 更新apt-get
-    cmd('apt-get -y -q update')
-    # 安装必须的包
-    cmd('apt-get -y -q install git python3 python3-pip wget curl')
-    # 安装非必须的包
-    try:
-        # 更新一下openssl
-        cmd('apt-get -y -q install openssl', allow_failure=True)
-    except:
-        pass
 
-    # 如果安装了, 则可以启用http2
-    ppa_available = cmd('apt-get -y -q install software-properties-common python-software-properties', allow_failure=True)
-
-    if distro.id() == 'ubuntu' and ppa_available:
-        # 安装高版本的Apache2(支持http2), 仅限ubuntu
-        cmd("""LC_ALL=C.UTF-8 add-apt-repository -y ppa:ondrej/apache2 &&
-    apt-key update &&
-    apt-get -y -q update &&
-    apt-get -y -q install apache2""")
+    # apt 相关的步骤共用dpkg锁, 所以串成一条链; git clone 与它们互不依赖, 可以并行
+    # python包已经在 bootstrap 阶段通过 pip_install() 一次性安装完成
+    prepare = StepScheduler()
+    prepare.add("apt:server", install_server_packages,
+                inputs={"packages": this_server["apt_packages"], "ppa": this_server.get("ubuntu_ppa"),
+                        "pip": server_pip_packages(), "runtime": runtime})
+    if server_name == "apache":
+        prepare.add("server:modules", enable_apache_modules, deps=["apt:server"], inputs={})
+        # 只暂存MPM的更换, 由 server:apply 提交
+        prepare.add("server:mpm", ensure_event_mpm, deps=["server:modules"], inputs={})
+    # 包管理器(apt-get, pip)的步骤按顺序串行: apt:server -> apt:upgrade -> runtime:pypy -> certbot:bootstrap
+    package_step = prepare.add("apt:upgrade", upgrade_system_packages,
+                               deps=["server:modules"] if server_name == "apache" else ["apt:server"], inputs={})
+    if runtime == "pypy":
+        package_step = prepare.add("runtime:pypy", install_pypy_runtime, deps=[package_step],
+                                   inputs=lambda: {"requirements": PIP_REQUIREMENTS + server_pip_packages(),
+                                                   "exists": os.path.exists(pypy_python())})
+    prepare.add("zmirror:clone", clone_zmirror,
+                inputs=lambda: {"url": __ZMIRROR_GIT_URL__, "exists": os.path.isdir(zmirror_source_folder)})
+    if already_have_cert:
+        infoprint("you said you already have certs, so skip let's encrypt")
+    elif acme_client_name == "native":
+        infoprint("using the built-in ACME client, so skip installing certbot")
     else:
-        # debian 只有低版本的可以用
-        cmd("apt-get -y -q install apache2")
-
-    cmd("""a2enmod rewrite mime include headers filter expires deflate autoindex setenvif ssl""")
-
-    if not cmd("a2enmod http2", allow_failure=True):
-        warnprint("[Warning!] your server does not support http2")
-        sleep(0.5)
-
-    # (可选) 更新一下各种包
-    if not (distro.id() == 'ubuntu' and distro.version() == '14.04'):  # 系统不是ubuntu 14.04
-        # Ubuntu 14.04 执行本命令的时候会弹一个postfix的交互, 所以不执行
-        cmd('apt-get -y -q upgrade', allow_failure=True)
-
-    cmd("""apt-get -y -q install libapache2-mod-wsgi-py3&& a2enmod wsgi""")
-
-    # 安装和更新必须的python包
-    cmd('python3 -m pip install -U flask')
-    cmd('python3 -m pip install requests==2.11.0')
-
-    # 安装和更新非必须, 但是有好处的python包, 允许失败
-    cmd('python3 -m pip install -U chardet', allow_failure=True)
-    cmd("python3 -m pip install -U cchardet", allow_failure=True)
-    cmd("python3 -m pip install -U fastcache", allow_failure=True)
-    cmd("python3 -m pip install -U lru-dict", allow_failure=True)
+        prepare.add("certbot:install", install_certbot,
+                    inputs=lambda: {"exists": os.path.exists('/etc/certbot/certbot-auto')})
+        # certbot-auto 初始化时会调用apt-get
+        prepare.add("certbot:bootstrap", bootstrap_certbot, deps=["certbot:install", package_step], exclusive=True)
+    prepare.run()
 
     infoprint('Dependency packages install completed')
-    infoprint('Installing letsencrypt...')
-    sleep(1)
-    if not already_have_cert:
-        if not os.path.exists('/etc/certbot/'):
-            # certbot 不存在, 则安装
-            cmd('git clone https://github.com/certbot/certbot.git --depth=1', cwd='/etc/')
-            cmd('chmod a+x /etc/certbot/certbot-auto', cwd='/etc/certbot/')
-            cmd("service apache2 stop", no_tee=True)
-            cmd('/etc/certbot/certbot-auto renew --agree-tos -n --standalone', cwd='/etc/certbot/')
-            cmd("service apache2 start", no_tee=True, allow_failure=True)
-        else:
-            # 否则升级一下
-            cmd('git pull', cwd='/etc/certbot/')
-            infoprint("let's encrypt Installation Completed")
-        sleep(1)
-    else:
-        infoprint("you said you already have certs, so skip let's encrypt")
-
-        infoprint('\n\n\n-------------------------------\n'
-                  'Now we need some information:')
+    infoprint('\n\n\n-------------------------------\n'
+              'Now we need some information:')
 except KeyboardInterrupt:
     infoprint("Aborting...")
     onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc(), msg="KeyboardInterrupt")
@@ -548,9 +4335,11 @@ except:
     onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
     raise
 
+profiler.phase("questions")
 try:
     # 尝试读取之前中断的安装设置
-    if os.path.exists(DUMP_FILE_PATH):
+    # 无人值守安装时, 以应答文件为准
+    if os.path.exists(DUMP_FILE_PATH) and not unattended:
         with open(DUMP_FILE_PATH, "r", encoding="utf-8") as fr:
             last_cfg = json.load(fr)  # type: dict
         infoprint(
@@ -572,7 +4361,7 @@ else:
     infoprint("Load last installation's settings successfully")
 
 try:
-    _input = -1
+    _input = 0 if unattended else -1
     while _input:  # 不断循环输入, 因为用户可能想要安装多个镜像
         infoprint('----------------------')
         _input = input(
@@ -658,7 +4447,11 @@ try:
         print()  # 打印一个空行
         while True:  # 这里面会检查输入的是否是三级域名
             domain = input("Please input *your* domain for this mirror ({}): ".format(mirror_type))
-            domain = domain.strip(' /.\t').replace('https://', '').replace('http://', '')  # 修剪
+            domain = clean_domain(domain)  # 修剪
+            if wildcard and wildcard_of(domain) is None:
+                # 通配符证书是 *.父域名, example.com 的父域名是顶级域名
+                errprint("--wildcard requires a subdomain like g.example.com, got [{}]".format(domain))
+                continue
             if domain.count('.') != 2:
                 warnprint(
                     "Your domain [",
@@ -675,30 +4468,7 @@ try:
             else:  # 输入的是三级域名
                 break
 
-        # 初步检验域名是否已经被正确设置
-        try:
-            domain_ip = socket.gethostbyname(domain)
-            local_ip = socket.gethostbyname(socket.gethostname())
-        except Exception as e:  # 查询目标域名的IP失败
-            warnprint("Sorry, your domain [{domain}] is not setting correctly. {exc}".format(domain=domain, exc=str(e)))
-            continue_anyway = input("Continue anyway? (y/N): ")
-            if continue_anyway not in ('y', 'yes', 'Yes', 'YES'):
-                continue  # 重新来
-            else:
-                # 仍然继续的话, 把domain_ip当做local_ip
-                local_ip = '127.0.0.1'
-                domain_ip = local_ip
-
-        # 域名检验--目标域名的IP不等于本地机器的IP
-        if domain_ip != local_ip:
-            warnprint("""Sorry, your domain({domain})'s ip does not equals to this machine's ip.
-    domain's ip is: {domain_ip}
-    this machine's ip is: {local_ip}
-    """.format(domain=domain, domain_ip=domain_ip, local_ip=local_ip)
-                      )
-            continue_anyway = input("Continue anyway? (y/N): ")
-            if continue_anyway not in ('y', 'yes', 'Yes', 'YES'):
-                continue  # 重新来
+        # 域名的DNS设置会在所有设置完成后统一并行检查, 见 dns_preflight()
 
         # 域名检验--域名是否重复
         _dup_flag = False
@@ -780,7 +4550,7 @@ try:
         errprint("[ERROR] you didn\'t select any mirror.\nAbort installation")
         raise RuntimeError('No mirror selected')
 
-    if email:  # 从上次安装的配置中读取
+    if email and not unattended:  # 从上次安装的配置中读取
         infoprint("You had set your email as:", email)
         if input("Does this email correct (Y/n)?") in ("n", "N", "no", "NO", "No"):
             email = ""
@@ -793,7 +4563,7 @@ try:
 
     dump_settings()
 
-    if question:
+    if question and not unattended:
         infoprint("You had set a question:", question["name"],
                   "answer:", question["answer"],
                   "hint:", question["hint"] or "NONE")
@@ -802,7 +4572,7 @@ try:
         else:
             need_answer_question = True
 
-    if not question:
+    if not question and not unattended:
         # 是否需要输入正确的密码才能访问
         print()
         infoprint("zmirror can provide simple verification via password\n"
@@ -850,6 +4620,11 @@ try:
     for mirror in mirrors_to_deploy:
         print("    Mirror: {mirror} Domain: {domain}".format(mirror=mirror, domain=mirrors_settings[mirror]['domain']))
     print()
+    # 已安装的镜像同样占用内存, 所以一起计算
+    wsgi_sizing = wsgi_daemon_sizing(
+        [m for m in mirrors_settings if m in mirrors_to_deploy or mirrors_settings[m]["installed_path"]])
+    check_wsgi_sizing(wsgi_sizing)
+    print()
     if need_answer_question:
         infoprint("Protected with question-answer:")
         print("  Question:", question["name"])
@@ -857,292 +4632,65 @@ try:
         print("  Hint:", question["hint"])
 
     print()
-    if input('Are these settings correct (Y/n)? ') in ('N', 'No', 'n', 'no', 'not', 'none'):
+    # 在获取证书之前检查所有域名的DNS设置
+    if "--skip-dns-check" not in sys.argv:
+        profiler.phase("preflight")
+        dns_problems = dns_preflight([mirrors_settings[mirror]['domain'] for mirror in mirrors_to_deploy])
+        # DNS-01 验证(通配符证书)不依赖于域名的A/AAAA记录
+        if dns_problems and not already_have_cert and not wildcard:
+            warnprint("let's encrypt will NOT be able to verify your domain(s) before the DNS problems are fixed")
+            if unattended or input("Continue anyway? (y/N): ") not in ('y', 'yes', 'Yes', 'YES'):
+                errprint("Aborting..., please fix your DNS settings (or use --skip-dns-check) and retry")
+                raise SystemExit("DNS pre-flight check failed")
+        print()
+
+    if not unattended and input('Are these settings correct (Y/n)? ') in ('N', 'No', 'n', 'no', 'not', 'none'):
         infoprint('installation abort manually.')
         raise SystemExit('abort manually.')
 
     # ############### Really Install ###################
-    if not already_have_cert:
-        # 通过 letsencrypt 获取HTTPS证书
-        infoprint("Fetching HTTPS certifications")
-        cmd("service apache2 stop", no_tee=True)  # 先关掉apache
-        for mirror in mirrors_to_deploy:
-            domain = mirrors_settings[mirror]['domain']
-
-            if os.path.exists('/etc/letsencrypt/live/{domain}'.format(domain=domain)):
-                # 如果证书已存在, 则跳过
-                warnprint("Certification for {domain} already exists, skipping".format(domain=domain))
-                sleep(0.2)
-                continue
-
-            infoprint("Obtaining: {domain}".format(domain=domain))
-            i = 0
-            try_limit = 5
-            certbot_cmd = (
-                '/etc/certbot/certbot-auto certonly -n --agree-tos -t -m "{email}" --standalone -d "{domain}" '
-            ).format(email=email, domain=domain)
-            seconds_to_wait = 4
-            while True:
-                i += 1
-                seconds_to_wait += i
-                try:
-                    result = cmd(certbot_cmd, cwd='/etc/certbot/', allow_failure=True)
-
-                    # 检查是否成功获取证书(文件是否存在)
-                    if not result or not os.path.exists('/etc/letsencrypt/live/{domain}'.format(domain=domain)):
-                        warnprint("cert file for {domain} does not exist!".format(domain=domain))
-                        raise RuntimeError("cert file for {domain} does not exist!".format(domain=domain))
-
-                except:
-                    warnprint("unable to obtaining cert for {domain}".format(domain=domain))
-                    if i <= try_limit:
-                        infoprint("wait {} seconds and retry. ({}/{})".format(seconds_to_wait, i, try_limit))
-                        onekey_report(
-                            report_type=REPORT_ERROR,
-                            traceback_str=traceback.format_exc(),
-                            msg="({}/{})".format(i, try_limit),
-                        )
-                        for _ in range(seconds_to_wait - 1, 0, -1):
-                            sleep(1)
-                            infoprint(_, "...")
-                    else:
-                        errprint(
-                            "\n"
-                            "I'm really sorry that we are not able to obtain an cert now, \n"
-                            "    This problem is NOT caused by zmirror-onekey itself, but caused by your DNS setting or "
-                            "the let's encrypt server. \n"
-                            "    If you had already set your A record correctly, "
-                            "please retry and wait, because sometimes the "
-                            "let's encrypt server may takes minutes or even hours to recognize your DNS settings.\n"
-                            "    If you doesn't sure whether your DNS A record are correct, please check it using "
-                            "https://www.whatsmydns.net/\n"
-                            "    Meanwhile, you can obtain cert manually using:" + certbot_cmd
-                        )
-                        importantprint("For more information, please see http://tinyurl.com/zmcert")
-                        importantprint("For more information, please see http://tinyurl.com/zmcert")
-                        importantprint("For more information, please see http://tinyurl.com/zmcert")
-                        importantprint("For more information, please see http://tinyurl.com/zmcert")
-                        ch = input("max retries exceed, do you want to continue retry?(Y/n) ")
-                        if ch in ("N", "n", "No", "no", "NO", "none", "None"):
-                            errprint("Aborting...")
-                            raise
-                        else:
-                            try_limit += 100
-
-                else:
-                    infoprint("Succeed: {domain}".format(domain=domain))
-                    break
-
-        cmd("service apache2 start",  # 重新启动apache
-            # ubuntu14.04下, 使用tee会出现无法正常退出的bug, 所以禁用掉
-            no_tee=True, allow_failure=True,
-            )
-
-    else:  # 选择自己提供证书
-        infoprint("skipping let's encrypt, for you already provided your cert")
+    profiler.phase("install")
+    # 各个镜像的部署和配置文件的下载互不依赖, 会被并行执行
+    # 涉及Apache停止/启动的步骤是排他的, 按照添加的顺序单独执行
+    install = StepScheduler()
 
     # ####### 安装zmirror自身 #############
-    infoprint('Successfully obtain SSL cert, now installing zmirror itself...')
-    sleep(1)
-
-    this_server = server_configs['apache']
-    htdoc = this_server['htdoc']  # type: str
-    config_root = this_server['config_root']  # type: str
-
-    os.chdir(htdoc)
-    zmirror_source_folder = os.path.join(htdoc, 'zmirror')
-    if os.path.exists(zmirror_source_folder):  # 如果存在zmirror目录, 则移除掉(可能是上一次安装未完成的残留)
-        shutil.rmtree(zmirror_source_folder)
-    cmd('git clone %s zmirror  --depth=1' % __ZMIRROR_GIT_URL__, cwd=htdoc)
-
-    # 预删除文件
-    for pre_delete_file in this_server['pre_delete_files']:
-        abs_path = pre_delete_file.format(
-            config_root=config_root, htdoc=htdoc
-        )
-        infoprint("deleting: " + abs_path)
-        try:
-            os.remove(abs_path)
-        except:
-            dbgprint("Unable to remove file:" + abs_path)
-
-    # 拷贝并设置各个镜像
+    install.add("server:pre-delete", pre_delete_server_files)
     for mirror in mirrors_to_deploy:
-        domain = mirrors_settings[mirror]['domain']
-        this_mirror_folder = os.path.join(htdoc, mirror)
-
-        # 如果文件夹已存在, 则报错. 但是如果是加载上次的配置, 则不报错, 而是删除掉上一次安装的文件夹, 重新安装
-        if os.path.exists(this_mirror_folder):
-            if loaded_config:
-                warnprint("Folder {} already exists, will be removed".format(this_mirror_folder))
-                shutil.rmtree(this_mirror_folder)
-            else:
-                errprint(
-                    ("Folder {folder} already exists."
-                     "If you want to override, please delete that folder manually and run this script again"
-                     ).format(folder=this_mirror_folder)
-                )
-                raise RuntimeError("Folder {folder} for mirror [{mirror_name}] already exists.".format(
-                    folder=this_mirror_folder, mirror_name=mirror))
-
-        # 将 zmirror 文件夹复制一份
-        shutil.copytree(zmirror_source_folder, this_mirror_folder)
-        # 更改文件夹所有者为 www-data (apache的用户)
-        cmd("chown -R www-data {path} && chgrp -R www-data {path}".format(path=this_mirror_folder),
-            cwd=this_mirror_folder)
-
-        this_mirror = mirrors_settings[mirror]
-
-        for file_from, file_to in this_mirror['cfg']:
-            shutil.copy(os.path.join(this_mirror_folder, file_from),
-                        os.path.join(this_mirror_folder, file_to))
-
-        with open(os.path.join(this_mirror_folder, 'config.py'), 'r+', encoding='utf-8') as fp:
-            # noinspection PyRedeclaration
-            content = fp.read()
-
-            # 将 my_host_name 修改为对应的域名
-            content = re.sub(r"""my_host_name *= *(['"])[-.\w]+\1""",
-                             "my_host_name = '{domain}' # Modified by zmirror-onekey".format(domain=domain),
-                             content, count=1)
-            # 将 my_host_scheme 修改为 https://
-            content = re.sub(r"""my_host_scheme *= *(['"])https?://\1""",
-                             "my_host_scheme = 'https://' # Modified by zmirror-onekey",
-                             content, count=1)
-            # 在文件末尾添加 verbose_level = 2
-            content += '\n\nverbose_level = 2 # Added by zmirror-onekey\n'
-
-            # 如果需要添加验证问题
-            if need_answer_question:
-                content += '\n\n########## Verification (added by zmirror-onekey) ########\n' \
-                           '# 这里只有最基础的单一问题-答案验证, 如果需要更加丰富的验证方式, \n' \
-                           '#    请看 `config_default.py` 文件中的 `Human/IP verification` 设置区段\n' \
-                           '#    PS: 下面的设置都支持中文, 可以自行修改成中文\n'
-                content += 'human_ip_verification_enabled = True\n'
-                content += 'human_ip_verification_answers_hash_str = \'{salt}\'  # Secret key, please keep it secret\n'.format(
-                    salt="".join(random.choice(string.ascii_letters + string.digits) for _ in range(32))
-                )
-                content += 'human_ip_verification_questions = [\n' + \
-                           '    ["{question}", "{answer}", "{hint}"],\n'.format(
-                               question=question["name"], answer=question["answer"], hint=question["hint"],
-                           ) + ']\n'
-                content += 'human_ip_verification_identity_record = []\n'
-
-            fp.seek(0)  # 指针返回文件头
-            fp.write(content)  # 回写
-
-    try:
-        shutil.rmtree(zmirror_source_folder)  # 删除无用的 zmirror 文件夹
-    except:
-        pass
-
-    infoprint("zmirror program folders deploy completed")
+        install.add("mirror:deploy:" + mirror, functools.partial(deploy_mirror, mirror),
+                    inputs=functools.partial(mirror_step_inputs, mirror))
 
     # ############# 配置Apache ###############
-    infoprint("Now installing apache configs...")
-    sleep(0.5)
-
-    os.chdir(config_root)
-
-    # 下载通用配置文件
-    for conf_name in this_server['common_configs']:
-        assert isinstance(config_root, str)
-        url = this_server['configs'][conf_name]['url']
-        file_path = os.path.join(config_root, this_server['configs'][conf_name]['file_path'])
-
-        if os.path.exists(file_path):  # 若配置文件已存在则跳过
-            warnprint("Config {path} already exists, skipping".format(path=file_path))
-            sleep(0.2)
-            continue
+    common_config_steps = [
+        install.add("config:" + conf_name, functools.partial(install_common_config, conf_name),
+                    deps=["server:pre-delete"])
+        for conf_name in this_server['common_configs']
+    ]
 
-        with open(file_path, 'w', encoding='utf-8') as fp:
-            infoprint("downloading: ", conf_name)
-            fp.write(requests.get(url).text)
+    cert_steps = []
+    if not already_have_cert:
+        cert_steps.append(install.add(
+            "certs:fetch", fetch_certs,
+            # webroot 验证需要http配置中的 Alias; standalone 验证需要停止Apache, 所以是排他的
+            deps=common_config_steps if acme_challenge == "webroot" else [],
+            exclusive=acme_challenge == "standalone",
+            inputs=lambda: {"email": email, "mode": cert_mode, "challenge": acme_challenge,
+                            "domains": [mirrors_settings[m]['domain'] for m in mirrors_to_deploy],
+                            "wildcard": wildcard, "key_type": cert_key_type,
+                            "covered": [cert_covering(mirrors_settings[m]['domain'], key_type=key_type) is not None
+                                        for m in mirrors_to_deploy for key_type in cert_key_types()]}
+        ))
+    else:  # 选择自己提供证书
+        infoprint("skipping let's encrypt, for you already provided your cert")
 
-    # 下载并设置各个镜像的Apache配置文件
     for mirror in mirrors_to_deploy:
-        domain = mirrors_settings[mirror]['domain']
-        this_mirror_folder = os.path.join(htdoc, mirror)
-
-        for conf_name in this_server['site_unique_configs']:
-            url = this_server['configs'][conf_name]['url']
-            file_path = os.path.join(config_root, this_server['configs'][conf_name]['file_path'])
-            file_path = file_path.format(mirror_name=mirror, conf_name=conf_name)
-
-            if os.path.exists(file_path):
-                if loaded_config:
-                    # 若是加载上一次的配置, 则先移除掉已存在的配置文件, 再重新安装
-                    warnprint("Config {path} already exists, will be removed".format(path=file_path))
-                    sleep(0.2)
-                    os.remove(file_path)
-                else:
-                    # 若配置文件已存在则跳过
-                    warnprint("Config {path} already exists, skipping".format(path=file_path))
-                    sleep(0.2)
-                    continue
-
-            infoprint("downloading: ", mirror, conf_name)
-
-            conf = requests.get(url).text
-
-            # 因为Apache conf里面有 {Ascii字符} 这种结构, 与python的string format冲突
-            # 这边只能手动format
-            for key, value in [
-                ('domain', domain),
-                ('mirror_name', mirror),
-                ('path_to_wsgi_py', os.path.join(this_mirror_folder, 'wsgi.py')),
-                ('this_mirror_folder', this_mirror_folder),
-            ]:
-                conf = conf.replace("{{%s}}" % key, value)
-
-            # 填写 conf 中的证书路径
-            if already_have_cert:
-                # 已有证书, 则在conf中填入自己的证书
-                certs_dict = mirrors_settings[mirror]['certs']
-                conf = conf.replace("{{cert_file}}", certs_dict['cert'])
-                conf = conf.replace("{{private_key_file}}", certs_dict['private_key'])
-                conf = conf.replace("{{cert_chain_file}}", certs_dict['intermediate'])
-            else:
-                # 若使用 let's encrypt 获取到了证书
-                # 则填入 let's encrypt 的证书路径
-                conf = conf.replace(
-                    "{{cert_file}}",
-                    "/etc/letsencrypt/live/{domain}/cert.pem".format(domain=domain),
-                )
-                conf = conf.replace(
-                    "{{private_key_file}}",
-                    "/etc/letsencrypt/live/{domain}/privkey.pem".format(domain=domain),
-                )
-                conf = conf.replace(
-                    "{{cert_chain_file}}",
-                    "/etc/letsencrypt/live/{domain}/chain.pem".format(domain=domain),
-                )
-
-            with open(file_path, 'w', encoding='utf-8') as fp:
-                fp.write(conf)
-
-    # ##### Add linux cron script for letsencrypt auto renewal ######
-    if not os.path.exists("/etc/cron.weekly/zmirror-letsencrypt-renew.sh") \
-            or already_have_cert:  # 若脚本已存在, 或者选择自己提供证书, 则跳过
-        # 添加 let's encrypt 证书自动更新脚本
-        infoprint("Adding cert auto renew script to `/etc/cron.weekly/zmirror-letsencrypt-renew.sh`")
-        cron_script = """#!/bin/bash
-cd /etc/certbot
-/etc/certbot/certbot-auto renew -n --agree-tos --standalone --pre-hook "/usr/sbin/service apache2 stop" --post-hook "/usr/sbin/service apache2 start"
-exit 0
-"""
-        with open("/etc/cron.weekly/zmirror-letsencrypt-renew.sh", "w", encoding='utf-8') as fp:
-            fp.write(cron_script)
+        install.add("config:site:" + mirror, functools.partial(install_site_configs, mirror),
+                    deps=cert_steps + ["server:pre-delete"],
+                    inputs=functools.partial(site_step_inputs, mirror))
 
-        cmd('chmod +x /etc/cron.weekly/zmirror-letsencrypt-renew.sh')
-        cmd('/etc/cron.weekly/zmirror-letsencrypt-renew.sh')
-
-    # 重启一下apache
-    infoprint("Restarting apache2")
-    cmd('service apache2 restart',
-        # ubuntu14.04下, 使用tee会出现无法正常退出的bug
-        no_tee=True, allow_failure=True,
-        )
+    install.add("certs:renew-cron", install_renew_cron, deps=cert_steps, exclusive=True)
+    install.add("server:apply", apply_server_configs, deps=list(install.steps), exclusive=True)
+    install.run()
 except KeyboardInterrupt:
     errprint("KeyboardInterrupt Aborting...")
     onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc(), msg="KeyboardInterrupt")
@@ -1151,11 +4699,12 @@ except:
     onekey_report(report_type=REPORT_ERROR, traceback_str=traceback.format_exc())
     raise
 
-# 已经安装成功, 移除掉设置文件
+# 已经安装成功, 移除掉设置文件和步骤日志
 try:
     os.remove(DUMP_FILE_PATH)
 except:
     pass
+install_journal.clear()
 
 infoprint("Finishing...")
 try:
@@ -1168,7 +4717,8 @@ except:
 
 # ####### 完成 ########
 infoprint("Congratulation!")
-infoprint("If apache is not running, please execute `sudo service apache2 restart`")
+infoprint("If {} is not running, please execute `sudo {}`".format(
+    this_server['service_name'], this_server['restart_command']))
 # 最后打印一遍配置
 infoprint("------------ mirrors ------------")
 for mirror in mirrors_to_deploy:
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+测试用的最小 ACME v2 服务器
+    校验每个请求的JWS签名(使用注册时的JWK重建公钥), nonce 不能重复使用, 第一个请求总是返回 badNonce
+    http-01 从 webroot 读取验证文件, dns-01 从 txt_records 读取TXT记录
+    finalize 时检查CSR中的SAN, 然后用一个临时CA签发证书
+"""
+import base64
+import binascii
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import socketserver
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def openssl(args, input_data=None):
+    proc = subprocess.Popen(["openssl"] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(input_data)
+    if proc.returncode != 0:
+        raise RuntimeError("openssl {} error: {}".format(args[0], err.decode("utf-8", "replace")))
+    return out
+
+
+def jwk_to_pem(jwk, folder):
+    """用 asn1parse 把JWK中的 n e 组装成 RSA 公钥"""
+    conf_path = os.path.join(folder, "pubkey.cnf")
+    der_path = os.path.join(folder, "pubkey.der")
+    with open(conf_path, "w") as fw:
+        fw.write("asn1 = SEQUENCE:pubkey\n[pubkey]\nn = INTEGER:0x{}\ne = INTEGER:0x{}\n".format(
+            binascii.hexlify(b64decode(jwk["n"])).decode(), binascii.hexlify(b64decode(jwk["e"])).decode()))
+    openssl(["asn1parse", "-genconf", conf_path, "-out", der_path, "-noout"])
+    return openssl(["rsa", "-RSAPublicKey_in", "-inform", "DER", "-in", der_path, "-pubout"])
+
+
+def thumbprint(jwk):
+    return b64encode(hashlib.sha256(json.dumps(jwk, sort_keys=True, separators=(",", ":")).encode()).digest())
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class AcmeStub:
+    def __init__(self, webroot):
+        self.webroot = webroot
+        self.txt_records = {}  # 域名 -> TXT记录
+        self.folder = tempfile.mkdtemp()
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.nonces = set()
+        self.accounts = {}  # kid -> 公钥PEM文件
+        self.thumbprints = {}  # kid -> JWK thumbprint
+        self.orders = {}
+        self.authzs = {}
+        self.certs = {}  # 订单 -> 证书链
+        self.requests = []  # 收到的每个请求的 (路径, 错误类型)
+        self.bad_nonce_once = True
+
+        openssl(["req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "5", "-subj", "/CN=ACME stub CA",
+                 "-keyout", os.path.join(self.folder, "ca.key"), "-out", os.path.join(self.folder, "ca.pem")])
+        with open(os.path.join(self.folder, "ca.pem")) as fr:
+            self.ca_pem = fr.read()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle_get(self)
+
+            def do_HEAD(self):
+                stub.reply(self, 200)
+
+            def do_POST(self):
+                stub.handle_post(self)
+
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.directory_url = self.base + "/directory"
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def new_nonce(self):
+        with self.lock:
+            nonce = "nonce{}".format(next(self.counter))
+            self.nonces.add(nonce)
+        return nonce
+
+    def reply(self, handler, code, body=None, headers=None, content_type="application/json"):
+        if isinstance(body, bytes):
+            data = body
+        else:
+            data = b"" if body is None else json.dumps(body).encode("utf-8")
+        handler.send_response(code)
+        handler.send_header("Replay-Nonce", self.new_nonce())
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def error(self, handler, error_type, detail="", code=400):
+        self.requests.append((handler.path, error_type))
+        self.reply(handler, code, {"type": "urn:ietf:params:acme:error:" + error_type, "detail": detail},
+                   content_type="application/problem+json")
+
+    def handle_get(self, handler):
+        if handler.path != "/directory":
+            return self.reply(handler, 404, {})
+        self.reply(handler, 200, {"newNonce": self.base + "/new-nonce", "newAccount": self.base + "/new-account",
+                                  "newOrder": self.base + "/new-order"})
+
+    def verify(self, pubkey_pem, protected64, payload64, signature64):
+        pubkey_path = os.path.join(self.folder, "verify-{}.pem".format(next(self.counter)))
+        with open(pubkey_path, "wb") as fw:
+            fw.write(pubkey_pem)
+        with tempfile.NamedTemporaryFile() as signature:
+            signature.write(b64decode(signature64))
+            signature.flush()
+            try:
+                openssl(["dgst", "-sha256", "-verify", pubkey_path, "-signature", signature.name],
+                        "{}.{}".format(protected64, payload64).encode("ascii"))
+            except RuntimeError:
+                return False
+        return True
+
+    def handle_post(self, handler):
+        body = json.loads(handler.rfile.read(int(handler.headers["Content-Length"])).decode("utf-8"))
+        protected = json.loads(b64decode(body["protected"]).decode("utf-8"))
+        if protected["url"] != self.base + handler.path:
+            return self.error(handler, "malformed", "url mismatch")
+        with self.lock:
+            if protected["nonce"] not in self.nonces:
+                return self.error(handler, "badNonce")
+            self.nonces.remove(protected["nonce"])
+            bad_nonce, self.bad_nonce_once = self.bad_nonce_once, False
+        if bad_nonce:
+            return self.error(handler, "badNonce")
+
+        if "jwk" in protected:
+            if handler.path != "/new-account":
+                return self.error(handler, "malformed", "jwk is only allowed for new-account")
+            pubkey = jwk_to_pem(protected["jwk"], self.folder)
+            kid = self.base + "/account/" + thumbprint(protected["jwk"])
+        else:
+            kid = protected["kid"]
+            if kid not in self.accounts:
+                return self.error(handler, "accountDoesNotExist")
+            pubkey = self.accounts[kid]
+        if not self.verify(pubkey, body["protected"], body["payload"], body["signature"]):
+            return self.error(handler, "malformed", "bad signature", code=403)
+        self.requests.append((handler.path, None))
+        payload = json.loads(b64decode(body["payload"]).decode("utf-8")) if body["payload"] else None
+
+        path = handler.path
+        if path == "/new-account":
+            code = 200 if kid in self.accounts else 201
+            self.accounts[kid] = pubkey
+            self.thumbprints[kid] = thumbprint(protected["jwk"])
+            return self.reply(handler, code, {"status": "valid"}, {"Location": kid})
+        if path == "/new-order":
+            return self.new_order(handler, kid, payload)
+        if path.startswith("/authz/"):
+            return self.reply(handler, 200, self.authzs[path[len("/authz/"):]])
+        if path.startswith("/challenge/"):
+            return self.validate(handler, kid, path[len("/challenge/"):])
+        if path.startswith("/finalize/"):
+            return self.finalize(handler, path[len("/finalize/"):], payload)
+        if path.startswith("/order/"):
+            return self.reply(handler, 200, self.orders[path[len("/order/"):]])
+        if path.startswith("/cert/"):
+            return self.reply(handler, 200, self.certs[path[len("/cert/"):]].encode("ascii"),
+                              content_type="application/pem-certificate-chain")
+        self.reply(handler, 404, {})
+
+    def new_order(self, handler, kid, payload):
+        order_id = str(len(self.orders))
+        domains = [identifier["value"] for identifier in payload["identifiers"]]
+        authz_urls = []
+        for index, domain in enumerate(domains):
+            authz_id = "{}-{}".format(order_id, index)
+            wildcard = domain.startswith("*.")
+            challenges = [{"type": "dns-01", "url": self.base + "/challenge/{}/dns-01".format(authz_id),
+                           "token": "dns-token-" + authz_id, "status": "pending"}]
+            if not wildcard:
+                challenges.append({"type": "http-01", "url": self.base + "/challenge/{}/http-01".format(authz_id),
+                                   "token": "http-token-" + authz_id, "status": "pending"})
+            self.authzs[authz_id] = {"status": "pending", "wildcard": wildcard, "challenges": challenges,
+                                     "identifier": {"type": "dns", "value": domain[2:] if wildcard else domain}}
+            authz_urls.append(self.base + "/authz/" + authz_id)
+        self.orders[order_id] = {"status": "pending", "identifiers": payload["identifiers"], "kid": kid,
+                                 "authorizations": authz_urls, "finalize": self.base + "/finalize/" + order_id}
+        self.reply(handler, 201, self.orders[order_id], {"Location": self.base + "/order/" + order_id})
+
+    def validate(self, handler, kid, challenge_path):
+        authz_id, challenge_type = challenge_path.split("/")
+        authz = self.authzs[authz_id]
+        challenge = [c for c in authz["challenges"] if c["type"] == challenge_type][0]
+        domain = authz["identifier"]["value"]
+        key_authorization = "{}.{}".format(challenge["token"], self.thumbprints[kid])
+        if challenge_type == "http-01":
+            try:
+                with open(os.path.join(self.webroot, ".well-known", "acme-challenge", challenge["token"])) as fr:
+                    got = fr.read()
+            except OSError:
+                got = None
+            expected = key_authorization
+        else:
+            got = self.txt_records.get("_acme-challenge." + domain)
+            expected = b64encode(hashlib.sha256(key_authorization.encode("ascii")).digest())
+        if got == expected:
+            challenge["status"] = authz["status"] = "valid"
+        else:
+            challenge["status"] = authz["status"] = "invalid"
+            challenge["error"] = {"type": "urn:ietf:params:acme:error:unauthorized",
+                                  "detail": "Incorrect validation for " + domain}
+        for order in self.orders.values():
+            if order["status"] == "pending" and all(
+                    self.authzs[url.rsplit("/", 1)[1]]["status"] == "valid" for url in order["authorizations"]):
+                order["status"] = "ready"
+        self.reply(handler, 200, challenge)
+
+    def finalize(self, handler, order_id, payload):
+        order = self.orders[order_id]
+        if order["status"] != "ready":
+            return self.error(handler, "orderNotReady", code=403)
+        folder = tempfile.mkdtemp(dir=self.folder)
+        csr_path = os.path.join(folder, "csr.der")
+        with open(csr_path, "wb") as fw:
+            fw.write(b64decode(payload["csr"]))
+        text = openssl(["req", "-inform", "DER", "-in", csr_path, "-noout", "-text"]).decode("utf-8")
+        domains = [identifier["value"] for identifier in order["identifiers"]]
+        for domain in domains:
+            if "DNS:" + domain not in text:
+                return self.error(handler, "badCSR", "CSR does not contain " + domain)
+        with open(os.path.join(folder, "ext.cnf"), "w") as fw:
+            fw.write("subjectAltName = " + ",".join("DNS:" + domain for domain in domains) + "\n")
+        cert = openssl(["x509", "-req", "-inform", "DER", "-in", csr_path, "-days", "5",
+                        "-CA", os.path.join(self.folder, "ca.pem"), "-CAkey", os.path.join(self.folder, "ca.key"),
+                        "-set_serial", str(next(self.counter) + 1000), "-extfile", os.path.join(folder, "ext.cnf")])
+        self.certs[order_id] = cert.decode("ascii") + self.ca_pem
+        order["status"] = "valid"
+        order["certificate"] = self.base + "/cert/" + order_id
+        self.reply(handler, 200, order)
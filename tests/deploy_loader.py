@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+deploy.py 是一个导入时就会开始安装的脚本, 不能直接 import
+    这里只执行它顶层的 import 语句, 以及指定的函数/类/常量的定义,
+    它们用到的其他全局变量(比如命令行参数)由测试提供
+运行测试: python3 -m unittest discover -s tests
+"""
+import ast
+import fnmatch
+import os
+
+DEPLOY_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "deploy.py")
+
+_tree = None
+
+
+def _deploy_tree():
+    global _tree
+    if _tree is None:
+        with open(DEPLOY_PY, "r", encoding="utf-8") as fr:
+            _tree = ast.parse(fr.read(), DEPLOY_PY)
+    return _tree
+
+
+def _exec_node(node, namespace):
+    module = ast.Module([node])
+    module.type_ignores = []
+    exec(compile(module, DEPLOY_PY, "exec"), namespace)
+
+
+def _node_names(node):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return [node.name]
+    if isinstance(node, ast.Assign):
+        return [target.id for target in node.targets if isinstance(target, ast.Name)]
+    return []
+
+
+def load(names, **namespace):
+    """
+    :param names: 需要加载的顶层定义的名字, 可以使用通配符, 比如 "WSGI_*"
+    :type names: list
+    :param namespace: 预先提供的全局变量, 加载的定义中用到的其他全局变量
+    :return: 包含加载的定义的全局命名空间
+    :rtype: dict
+    """
+    g = {"__name__": "deploy", "__file__": DEPLOY_PY}
+    for node in _deploy_tree().body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            _exec_node(node, g)
+    # 测试提供的全局变量优先于 import 的同名变量, 比如用假的 time 代替 from time import time
+    for name in ("infoprint", "dbgprint", "warnprint", "errprint", "importantprint"):
+        g[name] = lambda *args, **kwargs: None
+    g.update(namespace)
+
+    found = set()
+    for node in _deploy_tree().body:
+        matched = [name for name in _node_names(node)
+                   if any(fnmatch.fnmatchcase(name, pattern) for pattern in names)]
+        if matched:
+            _exec_node(node, g)
+            found.update(matched)
+
+    missing = [name for name in names if not any(fnmatch.fnmatchcase(f, name) for f in found)]
+    if missing:
+        raise NameError("not defined in deploy.py: " + ", ".join(missing))
+    return g
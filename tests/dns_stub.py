@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+测试用的递归DNS服务器, 监听 127.0.0.1 上的一个随机UDP端口
+    像递归服务器一样, 回答中先是CNAME链, 然后是最终的记录, 所有域名都使用压缩指针
+    特殊的域名:
+        stale.*  先发送一个ID错误的响应, 再发送正确的响应
+        drop.*   不响应
+        fail.*   返回 SERVFAIL
+    不在 records 中的域名返回 NXDOMAIN
+"""
+import socket
+import struct
+import threading
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_AAAA = 28
+
+
+class DnsStub:
+    def __init__(self, records):
+        """
+        :param records: 域名 -> [(类型, 值), ...], CNAME 的值是另一个域名
+        :type records: dict
+        """
+        self.records = records
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(512)
+            except OSError:
+                return
+            for response in self.handle(data):
+                self.sock.sendto(response, address)
+
+    def handle(self, data):
+        """
+        :return: 需要发送的响应
+        :rtype: list
+        """
+        query_id, _flags, _qdcount = struct.unpack(">HHH", data[:6])
+        labels = []
+        offset = 12
+        while data[offset]:
+            labels.append(data[offset + 1:offset + 1 + data[offset]].decode("ascii"))
+            offset += data[offset] + 1
+        qtype = struct.unpack(">H", data[offset + 1:offset + 3])[0]
+        question = data[12:offset + 5]
+        domain = ".".join(labels)
+        self.queries.append((domain, qtype))
+
+        if domain.startswith("drop."):
+            return []
+        if domain.startswith("fail."):
+            return [self.header(query_id, 2, 0) + question]
+
+        compressor = _Compressor(domain)
+        answers = b""
+        count = 0
+        name = domain
+        while name in self.records:
+            cname = [value for rtype, value in self.records[name] if rtype == TYPE_CNAME]
+            if cname:
+                answers += self.record(compressor, 12 + len(question) + len(answers), name, TYPE_CNAME, cname[0])
+                count += 1
+                name = cname[0]
+                continue
+            for rtype, value in self.records[name]:
+                if rtype == qtype:
+                    answers += self.record(compressor, 12 + len(question) + len(answers), name, rtype, value)
+                    count += 1
+            break
+        rcode = 0 if domain in self.records else 3
+        response = self.header(query_id, rcode, count) + question + answers
+        if domain.startswith("stale."):
+            return [self.header((query_id + 1) & 0xFFFF, 0, 0) + question, response]
+        return [response]
+
+    @staticmethod
+    def header(query_id, rcode, ancount):
+        # QR=1, RD=1, RA=1
+        return struct.pack(">HHHHHH", query_id, 0x8180 | rcode, 1, ancount, 0, 0)
+
+    @staticmethod
+    def record(compressor, offset, name, rtype, value):
+        owner = compressor.encode(name, offset)
+        offset += len(owner) + 10
+        if rtype == TYPE_CNAME:
+            rdata = compressor.encode(value, offset)
+        elif rtype == TYPE_A:
+            rdata = socket.inet_pton(socket.AF_INET, value)
+        else:
+            rdata = socket.inet_pton(socket.AF_INET6, value)
+        return owner + struct.pack(">HHIH", rtype, 1, 60, len(rdata)) + rdata
+
+
+class _Compressor:
+    """RFC 1035 4.1.4 的域名压缩, 已经写入过的后缀用指针代替"""
+
+    def __init__(self, question):
+        self.suffixes = {}
+        self.encode(question, 12)
+
+    def encode(self, name, offset):
+        labels = name.split(".")
+        result = b""
+        for i in range(len(labels)):
+            suffix = ".".join(labels[i:])
+            if suffix in self.suffixes:
+                return result + struct.pack(">H", 0xC000 | self.suffixes[suffix])
+            self.suffixes[suffix] = offset + len(result)
+            label = labels[i].encode("ascii")
+            result += struct.pack("B", len(label)) + label
+        return result + b"\x00"
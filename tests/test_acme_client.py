@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import requests
+
+from acme_stub import AcmeStub, b64encode, openssl
+from deploy_loader import load
+
+g = load(["_b64", "_openssl", "_write_private", "AcmeError", "WebrootChallenge", "AcmeClient",
+          "LETSENCRYPT_LIVE", "NATIVE_ACME_*"],
+         requests=requests, __VERSION__="test", sleep=time.sleep)
+
+
+class FakeDnsChallenge:
+    """dns-01 验证, 直接把TXT记录写到 AcmeStub 中"""
+    type = "dns-01"
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.settings = {"hook": "/bin/true"}
+        self.cleaned = []
+
+    def deploy(self, domain, token, key_authorization):
+        self.stub.txt_records["_acme-challenge." + domain] = b64encode(
+            hashlib.sha256(key_authorization.encode("ascii")).digest())
+
+    def cleanup(self, domain, token, key_authorization):
+        self.cleaned.append(domain)
+        self.stub.txt_records.pop("_acme-challenge." + domain, None)
+
+
+class BrokenWebrootChallenge:
+    """写入错误内容的 http-01 验证"""
+    type = "http-01"
+
+    def __init__(self, webroot):
+        self.challenge = g["WebrootChallenge"](webroot)
+        self.settings = self.challenge.settings
+
+    def deploy(self, domain, token, key_authorization):
+        self.challenge.deploy(domain, token, "wrong")
+
+    def cleanup(self, domain, token, key_authorization):
+        self.challenge.cleanup(domain, token, key_authorization)
+
+
+class AcmeClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.webroot = os.path.join(cls.tmp, "www")
+        cls.stub = AcmeStub(cls.webroot)
+        g["NATIVE_ACME_RENEWAL_DIR"] = os.path.join(cls.tmp, "renewal")
+        # 所有测试共用同一个账户, 与实际安装时相同
+        cls.client = g["AcmeClient"](cls.stub.directory_url, os.path.join(cls.tmp, "account", "account.key"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.close()
+        shutil.rmtree(cls.tmp)
+
+    def issue(self, domains, challenges=None, key_type="rsa"):
+        challenges = challenges or {"http-01": g["WebrootChallenge"](self.webroot)}
+        return self.client.issue(domains, domains[0].replace("*.", ""), challenges, email="admin@example.com",
+                                 live_root=os.path.join(self.tmp, "live"), key_type=key_type)
+
+    def cert_text(self, live_dir):
+        return openssl(["x509", "-in", os.path.join(live_dir, "cert.pem"), "-noout", "-text"]).decode("utf-8")
+
+    def assert_key_matches_cert(self, live_dir):
+        cert_pubkey = openssl(["x509", "-in", os.path.join(live_dir, "cert.pem"), "-noout", "-pubkey"])
+        key_pubkey = openssl(["pkey", "-in", os.path.join(live_dir, "privkey.pem"), "-pubout"])
+        self.assertEqual(cert_pubkey, key_pubkey)
+
+    def test_issue_with_webroot(self):
+        live_dir = self.issue(["a.example.com", "b.example.com"])
+
+        self.assertEqual(sorted(os.listdir(live_dir)), ["cert.pem", "chain.pem", "fullchain.pem", "privkey.pem"])
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(live_dir, "privkey.pem")).st_mode), 0o600)
+        text = self.cert_text(live_dir)
+        self.assertIn("DNS:a.example.com", text)
+        self.assertIn("DNS:b.example.com", text)
+        self.assert_key_matches_cert(live_dir)
+        with open(os.path.join(live_dir, "chain.pem")) as fr:
+            self.assertEqual(fr.read(), self.stub.ca_pem)
+        # 验证文件已经被删除
+        self.assertEqual(os.listdir(os.path.join(self.webroot, ".well-known", "acme-challenge")), [])
+
+        with open(os.path.join(g["NATIVE_ACME_RENEWAL_DIR"], "a.example.com.json")) as fr:
+            renewal = json.load(fr)
+        self.assertEqual(renewal["domains"], ["a.example.com", "b.example.com"])
+        self.assertEqual(renewal["challenges"], {"http-01": {"webroot": self.webroot}})
+
+    def test_account_is_reused(self):
+        self.issue(["c.example.com"])
+        kid = self.client.kid
+        self.issue(["d.example.com"])
+        self.assertEqual(self.client.kid, kid)
+        self.assertEqual(len([r for r in self.stub.requests if r == ("/new-account", None)]), 1)
+
+    def test_bad_nonce_is_retried(self):
+        self.issue(["e.example.com"])
+        self.assertIn(("/new-account", "badNonce"), self.stub.requests)
+        self.assertFalse([r for r in self.stub.requests if r[1] not in (None, "badNonce")])
+
+    def test_ecdsa_and_wildcard_with_dns(self):
+        dns = FakeDnsChallenge(self.stub)
+        live_dir = self.issue(["*.f.example.com", "f.example.com"], {"dns-01": dns}, key_type="ecdsa")
+        text = self.cert_text(live_dir)
+        self.assertIn("DNS:*.f.example.com", text)
+        self.assertIn("id-ecPublicKey", text)
+        self.assert_key_matches_cert(live_dir)
+        self.assertEqual(dns.cleaned, ["f.example.com", "f.example.com"])
+        self.assertEqual(self.stub.txt_records, {})
+
+    def test_failed_challenge(self):
+        with self.assertRaises(RuntimeError) as context:
+            self.issue(["g.example.com"], {"http-01": BrokenWebrootChallenge(self.webroot)})
+        self.assertIn("unauthorized", str(context.exception))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "live", "g.example.com")))
+
+    def test_unsupported_challenge(self):
+        with self.assertRaises(RuntimeError):
+            self.issue(["*.h.example.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import types
+import unittest
+
+from deploy_loader import load
+
+APT_CACHE_POLICY = """\
+apache2:
+  Installed: (none)
+  Candidate: 2.4.29-1ubuntu4
+  Version table:
+     2.4.29-1ubuntu4 500
+        500 http://archive.ubuntu.com/ubuntu bionic/main amd64 Packages
+python-software-properties:
+  Installed: (none)
+  Candidate: (none)
+libapache2-mod-http2:
+  Installed: (none)
+  Candidate: 1.10.20-1
+"""
+
+
+class AptPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.failing = set()
+        self.g = load(["AptPlanner"], cmd=self.fake_cmd, time=lambda: 0.0)
+        self.planner = self.g["AptPlanner"]()
+        self.planner.installable = lambda packages: [p for p in packages if p != "missing"]
+
+    def fake_cmd(self, command, allow_failure=None):
+        self.commands.append(command)
+        if command in self.failing:
+            if allow_failure:
+                return False
+            raise subprocess.CalledProcessError(100, command)
+        return True
+
+    def test_packages_are_batched(self):
+        self.planner.require("python3", "git")
+        self.planner.require("git", "curl")
+        self.planner.suggest("openssl", "curl", "zip")
+        self.assertTrue(self.planner.commit())
+        self.assertEqual(self.commands, [
+            "apt-get -y -q update",
+            "apt-get -y -q install python3 git curl",
+            "apt-get -y -q install openssl zip",
+        ])
+        self.assertEqual([name for name, _, _ in self.planner.timings],
+                         ["apt:update", "apt:install", "apt:install-optional"])
+
+    def test_index_is_updated_once(self):
+        self.planner.require("git")
+        self.planner.commit()
+        self.planner.require("apache2")
+        self.planner.commit("server")
+        # 没有计划任何包时什么都不做
+        self.planner.commit("empty")
+        self.assertEqual(self.commands, ["apt-get -y -q update", "apt-get -y -q install git",
+                                         "apt-get -y -q install apache2"])
+
+    def test_ppa_expires_the_index(self):
+        self.planner.require("git")
+        self.planner.commit()
+        self.planner.add_ppa("ppa:ondrej/apache2")
+        self.planner.add_ppa("ppa:ondrej/apache2")
+        self.planner.require("apache2")
+        self.planner.commit("server")
+        self.assertEqual(self.commands[2:], [
+            "LC_ALL=C.UTF-8 add-apt-repository -y ppa:ondrej/apache2 && apt-key update",
+            "apt-get -y -q update",
+            "apt-get -y -q install apache2",
+        ])
+
+    def test_unavailable_optional_packages_are_skipped(self):
+        self.planner.suggest("zip", "missing")
+        self.assertFalse(self.planner.commit())
+        self.assertEqual(self.commands[-1], "apt-get -y -q install zip")
+
+    def test_failed_optional_transaction_falls_back_to_single_packages(self):
+        self.failing.update(["apt-get -y -q install zip unzip", "apt-get -y -q install unzip"])
+        self.planner.suggest("zip", "unzip")
+        self.assertFalse(self.planner.commit())
+        self.assertEqual(self.commands[1:], ["apt-get -y -q install zip unzip", "apt-get -y -q install zip",
+                                             "apt-get -y -q install unzip"])
+        self.assertFalse(self.planner.timings[-1][2])
+
+    def test_required_failure_raises(self):
+        self.failing.add("apt-get -y -q install git")
+        self.planner.require("git")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.planner.commit()
+
+    def test_installable(self):
+        fake_subprocess = types.SimpleNamespace(
+            check_output=lambda args, **kwargs: APT_CACHE_POLICY, DEVNULL=subprocess.DEVNULL,
+            CalledProcessError=subprocess.CalledProcessError)
+        self.g["subprocess"] = fake_subprocess
+        packages = ["apache2", "python-software-properties", "libapache2-mod-http2", "not-in-sources"]
+        self.assertEqual(self.g["AptPlanner"].installable(packages), ["apache2", "libapache2-mod-http2"])
+
+        def failing(args, **kwargs):
+            raise OSError("apt-cache not found")
+        fake_subprocess.check_output = failing
+        self.assertEqual(self.g["AptPlanner"].installable(packages), packages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from acme_stub import openssl
+from deploy_loader import load
+
+DAY = 86400
+
+
+class CertIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.live = os.path.join(self.tmp, "live")
+        self.renewed = []
+        self.failing = set()
+        self.reissued = {"a.example.com", "b.example.com"}
+        self.warnings = []
+        self.reports = []
+        self.g = load(["_openssl", "CertIndex", "renew_due_certs"],
+                      LETSENCRYPT_LIVE=self.live,
+                      NATIVE_ACME_RENEWAL_DIR=os.path.join(self.tmp, "native-renewal"),
+                      CERTBOT_RENEWAL_DIR=os.path.join(self.tmp, "certbot-renewal"),
+                      CERT_INDEX_PATH=os.path.join(self.tmp, "index", "cert-index.json"),
+                      this_server={"config_root": os.path.join(self.tmp, "apache2")}, mirrors_settings={},
+                      renew_cert=self.fake_renew, sleep=lambda seconds: None, REPORT_ERROR="error",
+                      onekey_report=lambda **kwargs: self.reports.append(kwargs["msg"]),
+                      warnprint=lambda *args: self.warnings.append(" ".join(str(arg) for arg in args)))
+
+        self.make_cert("a.example.com", 10, renewal="native")
+        self.make_cert("b.example.com", 60, renewal="certbot")
+        self.make_cert("c.example.com", 5)
+        os.makedirs(os.path.join(self.live, "no-cert"))
+        # 用户自己提供的证书, 只出现在站点配置中
+        own_cert = self.make_cert("own.example.com", 20, folder=os.path.join(self.tmp, "own"))
+        sites = os.path.join(self.tmp, "apache2", "sites-enabled")
+        os.makedirs(sites)
+        with open(os.path.join(sites, "zmirror-own_https.conf"), "w", encoding="utf-8") as fw:
+            fw.write("<VirtualHost *:443>\n    SSLCertificateFile {}\n</VirtualHost>\n".format(own_cert))
+        with open(os.path.join(sites, "000-default.conf"), "w", encoding="utf-8") as fw:
+            fw.write("SSLCertificateFile /etc/ssl/certs/ssl-cert-snakeoil.pem\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_cert(self, domain, days, renewal=None, folder=None):
+        folder = folder or os.path.join(self.live, domain)
+        os.makedirs(folder, exist_ok=True)
+        cert_file = os.path.join(folder, "cert.pem")
+        openssl(["req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+                 "-keyout", os.path.join(folder, "privkey.pem"), "-out", cert_file, "-days", str(days),
+                 "-subj", "/CN=" + domain, "-addext", "subjectAltName=DNS:{0},DNS:www.{0}".format(domain)])
+        if renewal == "native":
+            os.makedirs(self.g["NATIVE_ACME_RENEWAL_DIR"], exist_ok=True)
+            open(os.path.join(self.g["NATIVE_ACME_RENEWAL_DIR"], domain + ".json"), "w").close()
+        elif renewal == "certbot":
+            os.makedirs(self.g["CERTBOT_RENEWAL_DIR"], exist_ok=True)
+            open(os.path.join(self.g["CERTBOT_RENEWAL_DIR"], domain + ".conf"), "w").close()
+        return cert_file
+
+    def fake_renew(self, name, kind):
+        self.renewed.append((name, kind))
+        if name in self.failing:
+            raise RuntimeError("rate limited")
+        if name in self.reissued:
+            cert_file = self.make_cert(name, 90)
+            # 保证 mtime 变化, 即使文件系统的时间精度较低
+            os.utime(cert_file, (time.time() + 10, time.time() + 10))
+
+    def test_scan(self):
+        index = self.g["CertIndex"]().scan()
+        entries = {entry["name"]: entry for entry in index.entries.values()}
+        self.assertEqual(sorted(entries), ["a.example.com", "b.example.com", "c.example.com", "own"])
+        self.assertEqual({name: entry["kind"] for name, entry in entries.items()},
+                         {"a.example.com": "native", "b.example.com": "certbot", "c.example.com": "manual",
+                          "own": "manual"})
+        self.assertEqual(entries["a.example.com"]["domains"], ["a.example.com", "www.a.example.com"])
+        self.assertAlmostEqual(entries["a.example.com"]["not_after"], time.time() + 10 * DAY, delta=120)
+        self.assertAlmostEqual(entries["own"]["not_after"], time.time() + 20 * DAY, delta=120)
+        self.assertRegex(entries["c.example.com"]["fingerprint"], r"^([0-9A-F]{2}:){31}[0-9A-F]{2}$")
+
+        # 索引保存在磁盘上, 下一次运行时读取
+        self.assertEqual(self.g["CertIndex"]().entries, index.entries)
+
+    def test_unchanged_certs_are_not_read_again(self):
+        self.g["CertIndex"]().scan()
+        index = self.g["CertIndex"]()
+        read = []
+        real_read_cert = index.read_cert
+        index.read_cert = lambda cert_file: read.append(cert_file) or real_read_cert(cert_file)
+        index.scan()
+        self.assertEqual(read, [])
+
+        cert_file = self.make_cert("c.example.com", 90)
+        os.utime(cert_file, (time.time() + 10, time.time() + 10))
+        index.scan()
+        self.assertEqual(read, [cert_file])
+        self.assertAlmostEqual(index.entries[cert_file]["not_after"], time.time() + 90 * DAY, delta=120)
+
+    def test_broken_index_is_rebuilt(self):
+        os.makedirs(os.path.dirname(self.g["CERT_INDEX_PATH"]))
+        with open(self.g["CERT_INDEX_PATH"], "w", encoding="utf-8") as fw:
+            fw.write("{broken")
+        index = self.g["CertIndex"]()
+        self.assertEqual(index.entries, {})
+        self.assertEqual(len(index.scan().entries), 4)
+
+    def test_due(self):
+        index = self.g["CertIndex"]().scan()
+        self.assertEqual([entry["name"] for _, entry in index.due(15)], ["c.example.com", "a.example.com"])
+        self.assertEqual(len(index.due(90)), 4)
+        self.assertEqual(index.due(1), [])
+
+    def test_renew_due_certs(self):
+        self.assertTrue(self.g["renew_due_certs"](days=30))
+        # b 还有60天才过期; c 和 own 是用户自己提供的, 只提醒
+        self.assertEqual(self.renewed, [("a.example.com", "native")])
+        self.assertEqual(len([warning for warning in self.warnings if "please renew it manually" in warning]), 2)
+
+    def test_failed_renewal(self):
+        self.failing.add("a.example.com")
+        # 一个证书更新失败, 其他的证书继续更新, b 的变化仍然需要重载
+        self.assertTrue(self.g["renew_due_certs"](days=70))
+        self.assertEqual(sorted(self.renewed), [("a.example.com", "native"), ("b.example.com", "certbot")])
+        self.assertEqual(self.reports, ["Unable to renew:a.example.com"])
+
+    def test_unchanged_renewal(self):
+        # 更新命令成功了, 但是证书没有变化 (比如 certbot 认为还不需要更新), 不需要重载
+        self.reissued = set()
+        self.assertFalse(self.g["renew_due_certs"](days=30))
+        self.assertEqual(self.renewed, [("a.example.com", "native")])
+        self.renewed = []
+        self.assertFalse(self.g["renew_due_certs"](days=1))
+        self.assertEqual(self.renewed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
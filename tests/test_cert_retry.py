@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime, timedelta
+
+from deploy_loader import load
+
+
+class CertRetrySchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = [0.0]
+        self.issued = set()
+        self.reports = []
+        self.answers = []
+
+        def fake_sleep(seconds):
+            self.clock[0] += seconds
+
+        self.g = load(["CERT_FAILURE_CLASSES", "CertRetryScheduler"],
+                      unattended=True, REPORT_ERROR="error",
+                      onekey_report=lambda **kwargs: self.reports.append(kwargs["msg"]),
+                      letsencrypt_live_certs=lambda key_type="rsa": set(self.issued),
+                      cert_covering=lambda domain, covered: domain in covered,
+                      time=lambda: self.clock[0], sleep=fake_sleep,
+                      input=lambda prompt: self.answers.pop(0))
+        self.scheduler = self.g["CertRetryScheduler"]()
+        self.calls = {}
+
+    def attempt(self, domain, results):
+        """依次返回 results 中的结果, "ok" 表示成功, 其他的是错误信息"""
+        def func():
+            self.calls.setdefault(domain, []).append(self.clock[0])
+            result = results.pop(0)
+            if result == "ok":
+                self.issued.add(domain)
+            else:
+                raise RuntimeError(result)
+        return func
+
+    def test_classify(self):
+        cases = [
+            ("Type:   dns\nDetail: DNS problem: NXDOMAIN looking up A for x.example.com", "dns"),
+            ("urn:ietf:params:acme:error:dns :: No TXT record found at _acme-challenge.x", "dns"),
+            ("urn:ietf:params:acme:error:caa CAA record for x.example.com prevents issuance", "caa"),
+            ("Error creating new order :: too many certificates already issued for exact set of domains",
+             "rate_limited_long"),
+            ("urn:ietf:params:acme:error:rateLimited too many failed authorizations recently", "rate_limited"),
+            ("urn:ietf:params:acme:error:malformed invalid domain", "rejected"),
+            ("Fetching http://x.example.com/.well-known/acme-challenge/abc: Connection refused", "connection"),
+            ("Invalid response from http://x.example.com/.well-known/acme-challenge/abc: 404", "unauthorized"),
+            ("urn:ietf:params:acme:error:serverInternal", "server"),
+            ("something unexpected", "unknown"),
+        ]
+        for text, category in cases:
+            self.assertEqual(self.scheduler.classify(text), category, text)
+
+    def test_backoff_grows_up_to_the_cap(self):
+        _, base, cap, max_tries = self.g["CERT_FAILURE_CLASSES"]["dns"]
+        for tries in range(1, max_tries):
+            delay = min(cap, base * 2 ** (tries - 1))
+            for _ in range(20):
+                self.assertTrue(delay / 2 <= self.scheduler.backoff("dns", tries) <= delay)
+        self.assertIsNone(self.scheduler.backoff("dns", max_tries))
+
+    def test_permanent_failures_are_not_retried(self):
+        for category in ("caa", "rejected", "rate_limited_long"):
+            self.assertIsNone(self.scheduler.backoff(category, 1))
+
+    def test_backoff_honors_retry_after(self):
+        _, base, cap, _ = self.g["CERT_FAILURE_CLASSES"]["rate_limited"]
+        soon = (datetime.utcnow() + timedelta(seconds=1800)).strftime("%Y-%m-%d %H:%M:%S")
+        delay = self.scheduler.backoff("rate_limited", 1, "rateLimited: retry after {} UTC".format(soon))
+        self.assertTrue(1790 <= delay <= 1800 + base)
+        # 已经过去的时间, 至少等待 base 秒
+        delay = self.scheduler.backoff("rate_limited", 1, "rateLimited: retry after 2000-01-01 00:00:00 UTC")
+        self.assertTrue(base <= delay <= base * 2)
+        # 超过上限时不再重试
+        self.assertIsNone(self.scheduler.backoff("rate_limited", 1, "retry after 2999-01-01T00:00:00Z"))
+
+    def test_other_orders_run_while_one_waits(self):
+        self.scheduler.add(["a.example.com"], self.attempt("a.example.com", ["DNS problem"] * 2 + ["ok"]), "hint a")
+        self.scheduler.add(["b.example.com"], self.attempt("b.example.com", ["ok"]), "hint b")
+        self.scheduler.run()
+
+        self.assertEqual(len(self.calls["a.example.com"]), 3)
+        # b 在 a 第一次失败之后立刻运行, 不需要等待 a 的重试
+        self.assertEqual(self.calls["b.example.com"], [0.0])
+        first, second, third = self.calls["a.example.com"]
+        self.assertTrue(15 <= second - first <= 30)
+        self.assertTrue(30 <= third - second <= 60)
+        self.assertEqual(self.reports, [])
+
+    def test_failed_orders_are_reported(self):
+        self.scheduler.add(["a.example.com"], self.attempt("a.example.com", ["CAA record for a.example.com"]), "hint")
+        self.scheduler.add(["b.example.com"], self.attempt("b.example.com", ["ok"]), "hint b")
+        with self.assertRaises(RuntimeError) as context:
+            self.scheduler.run()
+        self.assertIn("a.example.com (caa)", str(context.exception))
+        self.assertEqual(len(self.calls["a.example.com"]), 1)
+        self.assertEqual(self.reports, ["caa (1 tries)"])
+
+    def test_attempt_without_cert_is_a_failure(self):
+        # attempt 没有抛出异常, 但是没有获取到证书
+        self.scheduler.add(["a.example.com"], lambda: None, "hint")
+        with self.assertRaises(RuntimeError):
+            self.scheduler.run()
+        self.assertEqual(self.reports, ["unknown (5 tries)"])
+
+    def test_continue_retrying_by_default(self):
+        self.g["unattended"] = False
+        self.answers = ["", "n"]
+        _, _, _, max_tries = self.g["CERT_FAILURE_CLASSES"]["unauthorized"]
+        self.scheduler.add(["a.example.com"], self.attempt("a.example.com", ["Invalid response from"] * 10), "hint")
+        with self.assertRaises(RuntimeError):
+            self.scheduler.run()
+        # 第一次询问时直接回车, 继续重试; 第二次回答 n
+        self.assertEqual(len(self.calls["a.example.com"]), max_tries * 2)
+        self.assertEqual(self.answers, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
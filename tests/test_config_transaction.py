@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from deploy_loader import load
+
+SERVER = {
+    "service_name": "apache2",
+    "configtest_command": "configtest",
+    "reload_command": "reload",
+    "restart_command": "restart",
+    "start_command": "start",
+}
+
+
+class ConfigTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "etc")
+        os.makedirs(self.root)
+        self.commands = []
+        self.failing = set()
+        self.problems = []
+        self.g = load(["ConfigTransaction", "ApacheConfigTransaction", "mpm_limits", "MPM_LIMITS_STATE_PATH"],
+                      CONFIG_STAGE_DIR=None, CONFIG_BACKUP_DIR=None,
+                      cmd=self.fake_cmd, last_cmd_output=lambda max_bytes: "syntax error",
+                      sync_app_units=lambda units_dir, changed: None,
+                      server_health_check=lambda sites: list(self.problems), zmirror_https_sites=lambda: [])
+        self.txn = self.make_transaction()
+
+    def make_transaction(self):
+        return self.g["ConfigTransaction"](dict(SERVER), stage_dir=os.path.join(self.tmp, "staged"),
+                                           backup_dir=os.path.join(self.tmp, "backup"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def fake_cmd(self, command, allow_failure=None):
+        self.commands.append(command)
+        if command in self.failing:
+            if allow_failure:
+                return False
+            raise subprocess.CalledProcessError(1, command)
+        return True
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, content):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        with open(self.path(name), "w", encoding="utf-8") as fw:
+            fw.write(content)
+
+    def read(self, name):
+        with open(self.path(name), "r", encoding="utf-8") as fr:
+            return fr.read()
+
+    def stage_changes(self):
+        self.write("a.conf", "old a")
+        self.write("c.conf", "old c")
+        self.txn.write(self.path("a.conf"), "new a")
+        self.txn.write(self.path("sites/b.conf"), "new b")
+        self.txn.remove(self.path("c.conf"))
+
+    def assert_unchanged(self):
+        self.assertEqual(self.read("a.conf"), "old a")
+        self.assertEqual(self.read("c.conf"), "old c")
+        self.assertFalse(os.path.exists(self.path("sites/b.conf")))
+
+    def test_commit(self):
+        self.stage_changes()
+        self.assertEqual(sorted(self.txn.staged()),
+                         [self.path("a.conf"), self.path("c.conf"), self.path("sites/b.conf")])
+        self.assertIsNone(self.txn.staged()[self.path("c.conf")])
+        # 暂存不会修改目标文件
+        self.assert_unchanged()
+
+        self.txn.commit()
+        self.assertEqual(self.read("a.conf"), "new a")
+        self.assertEqual(self.read("sites/b.conf"), "new b")
+        self.assertFalse(os.path.exists(self.path("c.conf")))
+        self.assertEqual(self.commands, ["configtest", "reload"])
+        self.assertEqual(self.txn.staged(), {})
+        self.assertFalse([name for name in os.listdir(self.root) if name.endswith(self.txn.TEMP_SUFFIX)])
+
+    def test_restage(self):
+        self.write("a.conf", "old a")
+        self.txn.write(self.path("a.conf"), "new a")
+        self.txn.remove(self.path("a.conf"))
+        self.assertEqual(self.txn.staged(), {self.path("a.conf"): None})
+        self.txn.write(self.path("a.conf"), "newer a")
+        self.txn.commit()
+        self.assertEqual(self.read("a.conf"), "newer a")
+
+    def test_configtest_failure_rolls_back(self):
+        self.stage_changes()
+        self.failing.add("configtest")
+        with self.assertRaises(RuntimeError) as context:
+            self.txn.commit()
+        self.assertIn("syntax error", str(context.exception))
+        self.assert_unchanged()
+        self.assertEqual(self.commands, ["configtest", "reload"])
+        # 暂存的修改保留下来, 重新运行时再次提交
+        self.assertEqual(len(self.txn.staged()), 3)
+
+    def test_health_check_failure_rolls_back(self):
+        self.stage_changes()
+        self.problems = ["https://g.example.com/ returned 502"]
+        with self.assertRaises(RuntimeError) as context:
+            self.txn.commit()
+        self.assertIn("returned 502", str(context.exception))
+        self.assert_unchanged()
+        self.assertEqual(self.commands, ["configtest", "reload", "reload"])
+
+    def test_partial_switch_is_restored(self):
+        self.stage_changes()
+        # d 是一个文件, 无法在其中创建 d/e.conf, 替换在 a.conf 和 c.conf 之后失败
+        self.write("d", "not a folder")
+        self.txn.write(self.path("d/e.conf"), "new e")
+        with self.assertRaises(OSError):
+            self.txn.commit()
+        self.assert_unchanged()
+        self.assertEqual(self.read("d"), "not a folder")
+        self.assertEqual(self.commands, ["reload"])
+        self.assertEqual(len(self.txn.staged()), 4)
+
+    def test_reload_falls_back_to_start(self):
+        self.txn.write(self.path("a.conf"), "new a")
+        self.failing.add("reload")
+        self.txn.commit()
+        self.assertEqual(self.commands, ["configtest", "reload", "start"])
+
+    def test_link(self):
+        self.write("mods-available/x.load", "LoadModule x")
+        os.makedirs(self.path("mods-enabled"))
+        os.symlink("../mods-available/old.load", self.path("mods-enabled/old.load"))
+        self.txn.link(self.path("mods-enabled/x.load"), "../mods-available/x.load")
+        self.txn.remove(self.path("mods-enabled/old.load"))
+        self.txn.commit()
+        self.assertEqual(os.readlink(self.path("mods-enabled/x.load")), "../mods-available/x.load")
+        self.assertEqual(self.read("mods-enabled/x.load"), "LoadModule x")
+        self.assertFalse(os.path.lexists(self.path("mods-enabled/old.load")))
+
+    def test_link_rollback_restores_symlinks(self):
+        os.makedirs(self.path("mods-enabled"))
+        os.symlink("../mods-available/old.load", self.path("mods-enabled/old.load"))
+        self.txn.remove(self.path("mods-enabled/old.load"))
+        self.txn.link(self.path("mods-enabled/x.load"), "../mods-available/x.load")
+        self.failing.add("configtest")
+        with self.assertRaises(RuntimeError):
+            self.txn.commit()
+        # 备份的是链接本身, 恢复后仍然是同一个(悬空的)链接
+        self.assertEqual(os.readlink(self.path("mods-enabled/old.load")), "../mods-available/old.load")
+        self.assertFalse(os.path.lexists(self.path("mods-enabled/x.load")))
+
+
+MPM_CONF = "conf-enabled/zmirror-mpm-event.conf"
+
+
+class ApacheConfigTransactionTest(ConfigTransactionTest):
+    def make_transaction(self):
+        server = dict(SERVER, config_root=self.root + "/", configs={"mpm_event": {"file_path": MPM_CONF}})
+        self.state_path = os.path.join(self.tmp, "state", "mpm-limits.json")
+        return self.g["ApacheConfigTransaction"](server, state_path=self.state_path,
+                                                 stage_dir=os.path.join(self.tmp, "staged"),
+                                                 backup_dir=os.path.join(self.tmp, "backup"))
+
+    def mpm_conf(self, server_limit, thread_limit=64):
+        return "<IfModule mpm_event_module>\n    ServerLimit {}\n    ThreadLimit {}\n</IfModule>\n".format(
+            server_limit, thread_limit)
+
+    def test_first_commit_restarts_once(self):
+        self.txn.write(self.path(MPM_CONF), self.mpm_conf(16))
+        self.txn.commit()
+        self.assertEqual(self.commands, ["configtest", "restart"])
+        self.assertEqual(self.txn.loaded_mpm_limits(), ["16", "64"])
+
+        # 之后的提交只需要平滑重载
+        self.commands = []
+        self.txn.write(self.path("a.conf"), "new a")
+        self.txn.commit()
+        self.assertEqual(self.commands, ["configtest", "reload"])
+
+    def test_changed_limits_restart(self):
+        self.txn.write(self.path(MPM_CONF), self.mpm_conf(16))
+        self.txn.commit()
+        self.commands = []
+        # 只有 MaxRequestWorkers 等可以平滑重载的参数变化时, 不需要重启
+        self.txn.write(self.path(MPM_CONF), self.mpm_conf(16) + "MaxRequestWorkers 400\n")
+        self.txn.commit()
+        self.txn.write(self.path(MPM_CONF), self.mpm_conf(32))
+        self.txn.commit()
+        self.assertEqual(self.commands, ["configtest", "reload", "configtest", "restart"])
+        self.assertEqual(self.txn.loaded_mpm_limits(), ["32", "64"])
+
+    def test_mpm_switch_restarts(self):
+        self.write("mods-available/mpm_event.load", "LoadModule mpm_event_module")
+        self.write("mods-available/mpm_prefork.load", "LoadModule mpm_prefork_module")
+        os.makedirs(self.path("mods-enabled"))
+        os.symlink("../mods-available/mpm_prefork.load", self.path("mods-enabled/mpm_prefork.load"))
+        self.txn.remove(self.path("mods-enabled/mpm_prefork.load"))
+        self.txn.link(self.path("mods-enabled/mpm_event.load"), "../mods-available/mpm_event.load")
+        self.txn.write(self.path(MPM_CONF), self.mpm_conf(16))
+        self.txn.commit()
+        # MPM 和 ServerLimit 同时变化, 也只重启一次
+        self.assertEqual(self.commands, ["configtest", "restart"])
+        self.assertEqual(os.listdir(self.path("mods-enabled")), ["mpm_event.load"])
+
+    def test_rollback_after_restart(self):
+        self.write(MPM_CONF, self.mpm_conf(16))
+        self.txn.write(self.path(MPM_CONF), self.mpm_conf(32))
+        self.problems = ["https://g.example.com/ returned 502"]
+        with self.assertRaises(RuntimeError):
+            self.txn.commit()
+        # 回滚后再次重启, 记录的是恢复了的配置
+        self.assertEqual(self.commands, ["configtest", "restart", "restart"])
+        self.assertEqual(self.read(MPM_CONF), self.mpm_conf(16))
+        self.assertEqual(self.txn.loaded_mpm_limits(), ["16", "64"])
+
+
+if __name__ == "__main__":
+    unittest.main()
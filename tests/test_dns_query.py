@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import functools
+import socket
+import unittest
+
+from dns_stub import DnsStub, TYPE_A, TYPE_AAAA, TYPE_CNAME
+from deploy_loader import load
+
+THIS_HOST = "192.0.2.10"
+
+RECORDS = {
+    "good.example.com": [(TYPE_A, THIS_HOST)],
+    "www.example.com": [(TYPE_CNAME, "edge.example.net")],
+    "edge.example.net": [(TYPE_CNAME, "good.example.com")],
+    "multi.example.com": [(TYPE_A, "192.0.2.11"), (TYPE_A, "192.0.2.12"), (TYPE_AAAA, "2001:db8::12")],
+    "bad6.example.com": [(TYPE_A, THIS_HOST), (TYPE_AAAA, "2001:db8::1")],
+    "other.example.com": [(TYPE_A, "198.51.100.1")],
+    "nodata.example.com": [(TYPE_AAAA, "2001:db8::12")],
+    "stale.example.com": [(TYPE_A, THIS_HOST)],
+}
+
+
+class DnsQueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = DnsStub(RECORDS)
+        cls.g = load(["DNS_*", "PUBLIC_DNS_RESOLVERS", "_dns_skip_name", "dns_query", "dns_preflight"],
+                     PUBLIC_IP_URLS=[], local_addresses=lambda: {THIS_HOST})
+        cls.real_dns_query = cls.g["dns_query"]
+        # dns_preflight 中的查询也发送到测试服务器的端口
+        cls.g["dns_query"] = functools.partial(cls.real_dns_query, port=cls.stub.port, timeout=0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.close()
+
+    def query(self, domain, qtype=TYPE_A, **kwargs):
+        return self.g["dns_query"](domain, qtype, "127.0.0.1", **kwargs)
+
+    def test_a_and_aaaa(self):
+        self.assertEqual(self.query("good.example.com"), [THIS_HOST])
+        self.assertEqual(sorted(self.query("multi.example.com")), ["192.0.2.11", "192.0.2.12"])
+        self.assertEqual(self.query("multi.example.com", TYPE_AAAA), ["2001:db8::12"])
+
+    def test_cname_chain_with_compression(self):
+        self.assertEqual(self.query("www.example.com"), [THIS_HOST])
+        self.assertEqual(self.query("www.example.com", TYPE_AAAA), [])
+
+    def test_no_data_and_nxdomain(self):
+        self.assertEqual(self.query("nodata.example.com"), [])
+        self.assertEqual(self.query("missing.example.com"), [])
+        self.assertEqual(self.query("missing.example.com", TYPE_AAAA), [])
+
+    def test_response_with_other_id_is_ignored(self):
+        self.assertEqual(self.query("stale.example.com"), [THIS_HOST])
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            self.query("fail.example.com")
+        with self.assertRaises(socket.timeout):
+            self.query("drop.example.com", timeout=0.1, tries=2)
+        self.assertEqual(self.stub.queries.count(("drop.example.com", TYPE_A)), 2)
+
+    def test_skip_name(self):
+        skip = self.g["_dns_skip_name"]
+        data = b"\x03www\x07example\x03com\x00" + b"\x03www\xc0\x00"
+        self.assertEqual(skip(data, 0), 17)
+        self.assertEqual(skip(data, 17), 23)
+        self.assertEqual(skip(b"\xc0\x0c", 0), 2)
+
+    def test_preflight(self):
+        resolvers = ["127.0.0.1"]
+        self.assertEqual(self.g["dns_preflight"](["good.example.com", "www.example.com"], resolvers), [])
+
+        problems = self.g["dns_preflight"](["bad6.example.com"], resolvers)
+        self.assertEqual(problems, ["bad6.example.com AAAA record points to 2001:db8::1, which is not this machine"])
+
+        problems = self.g["dns_preflight"](["other.example.com"], resolvers)
+        self.assertEqual(problems, ["other.example.com A record points to 198.51.100.1, which is not this machine"])
+
+        problems = self.g["dns_preflight"](["missing.example.com"], resolvers)
+        self.assertEqual(problems, ["missing.example.com has no A or AAAA record"])
+
+    def test_preflight_with_failing_resolver(self):
+        # 查询失败的DNS服务器只打印警告, 不影响其他服务器的结果
+        problems = self.g["dns_preflight"](["drop.example.com", "good.example.com"], ["127.0.0.1"])
+        self.assertEqual(problems, ["drop.example.com has no A or AAAA record"])
+
+
+if __name__ == "__main__":
+    unittest.main()
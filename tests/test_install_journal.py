@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from deploy_loader import load
+
+
+class InstallJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "journal.json")
+        self.g = load(["InstallJournal", "incomplete_install_mirrors"],
+                      JOURNAL_FILE_PATH=self.path,
+                      DUMP_FILE_PATH=os.path.join(self.tmp, "dump.json"))
+        self.InstallJournal = self.g["InstallJournal"]
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def func(self):
+        self.calls.append(1)
+
+    def test_fingerprint(self):
+        fp = self.InstallJournal.fingerprint
+        self.assertEqual(fp({"a": 1, "b": [1, 2]}), fp({"b": [1, 2], "a": 1}))
+        self.assertNotEqual(fp({"a": 1}), fp({"a": 2}))
+        # 输入可以是函数, 求值后再计算指纹
+        self.assertEqual(fp(lambda: {"a": 1}), fp({"a": 1}))
+
+    def test_completed_step_is_skipped_after_restart(self):
+        journal = self.InstallJournal()
+        self.assertTrue(journal.run("a", self.func, {"x": 1}))
+        self.assertTrue(os.path.exists(self.path))
+
+        journal = self.InstallJournal()
+        self.assertTrue(journal.is_done("a", {"x": 1}))
+        self.assertFalse(journal.run("a", self.func, {"x": 1}))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_changed_inputs_rerun_the_step(self):
+        journal = self.InstallJournal()
+        journal.run("a", self.func, {"x": 1})
+        self.assertTrue(journal.run("a", self.func, {"x": 2}))
+        self.assertEqual(len(self.calls), 2)
+        self.assertTrue(self.InstallJournal().is_done("a", {"x": 2}))
+
+    def test_inputs_are_recorded_after_the_step(self):
+        # 输入中可以包含步骤本身产生的结果
+        state = {"created": False}
+
+        def create():
+            state["created"] = True
+
+        journal = self.InstallJournal()
+        journal.run("a", create, lambda: dict(state))
+        self.assertTrue(self.InstallJournal().is_done("a", lambda: dict(state)))
+
+    def test_failed_step_is_not_recorded(self):
+        journal = self.InstallJournal()
+        with self.assertRaises(ZeroDivisionError):
+            journal.run("a", lambda: 1 / 0, {})
+        self.assertFalse(self.InstallJournal().is_done("a", {}))
+
+    def test_force(self):
+        journal = self.InstallJournal()
+        journal.run("a", self.func, {})
+        journal.run("b", self.func, {})
+
+        journal = self.InstallJournal(forced=["a"])
+        self.assertFalse(journal.is_done("a", {}))
+        self.assertTrue(journal.is_done("b", {}))
+
+        journal = self.InstallJournal(forced=["all"])
+        self.assertFalse(journal.is_done("a", {}))
+        self.assertFalse(journal.is_done("b", {}))
+
+    def test_clear_and_broken_file(self):
+        journal = self.InstallJournal()
+        journal.run("a", self.func, {})
+        journal.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.InstallJournal().steps, {})
+        journal.clear()
+
+        with open(self.path, "w") as fw:
+            fw.write("{broken")
+        self.assertEqual(self.InstallJournal().steps, {})
+
+    def test_incomplete_install_mirrors(self):
+        journal = self.InstallJournal()
+        journal.run("mirror:deploy:google", self.func, {})
+        journal.run("bootstrap:system", self.func, {})
+        self.g["install_journal"] = journal
+        self.assertEqual(self.g["incomplete_install_mirrors"](), {"google"})
+
+        with open(self.g["DUMP_FILE_PATH"], "w") as fw:
+            json.dump({"mirrors_to_deploy": ["youtube"]}, fw)
+        self.assertEqual(self.g["incomplete_install_mirrors"](), {"google", "youtube"})
+
+
+if __name__ == "__main__":
+    unittest.main()
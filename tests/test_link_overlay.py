@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from deploy_loader import load
+
+g = load(["OVERLAY_*", "_link_or_copy", "link_overlay", "is_overlay"])
+# 不存在的用户, 不会 chown
+OWNER = "zmirror-onekey-test-nobody"
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w", encoding="utf-8") as fw:
+        fw.write(content)
+
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as fr:
+        return fr.read()
+
+
+class LinkOverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.shared = os.path.join(self.tmp, "zmirror")
+        self.mirror = os.path.join(self.tmp, "google")
+        write(os.path.join(self.shared, "zmirror", "zmirror.py"), "v1")
+        write(os.path.join(self.shared, "zmirror", "cache_system.py"), "v1")
+        write(os.path.join(self.shared, "config.py"), "default config")
+        write(os.path.join(self.shared, "custom_func.py"), "default func")
+        write(os.path.join(self.shared, "wsgi.py"), "wsgi v1")
+        write(os.path.join(self.shared, "more_configs", "config_google.py"), "sample")
+        write(os.path.join(self.shared, ".git", "HEAD"), "ref")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def overlay(self, preserved=()):
+        g["link_overlay"](self.shared, self.mirror, preserved=preserved, owner=OWNER)
+
+    def shared_path(self, *parts):
+        return os.path.join(self.shared, *parts)
+
+    def mirror_path(self, *parts):
+        return os.path.join(self.mirror, *parts)
+
+    def test_code_files_are_hard_links(self):
+        self.overlay()
+        self.assertTrue(g["is_overlay"](self.mirror))
+        self.assertTrue(os.path.samefile(self.shared_path("zmirror", "zmirror.py"),
+                                         self.mirror_path("zmirror", "zmirror.py")))
+        self.assertFalse(os.path.exists(self.mirror_path(".git")))
+        # 每个镜像自己的真实文件
+        for name in ("config.py", "custom_func.py", "wsgi.py"):
+            self.assertTrue(os.path.exists(self.mirror_path(name)))
+            self.assertFalse(os.path.samefile(self.shared_path(name), self.mirror_path(name)))
+
+    def test_preserved_files_are_not_overwritten(self):
+        self.overlay(preserved=["more_configs/config_google.py"])
+        write(self.mirror_path("config.py"), "mirror config")
+        write(self.mirror_path("more_configs", "config_google.py"), "mirror sample")
+
+        write(self.shared_path("config.py"), "new default config")
+        write(self.shared_path("more_configs", "config_google.py"), "new sample")
+        self.overlay(preserved=["more_configs/config_google.py"])
+        self.assertEqual(read(self.mirror_path("config.py")), "mirror config")
+        self.assertEqual(read(self.mirror_path("more_configs", "config_google.py")), "mirror sample")
+
+    def test_relink_after_upgrade(self):
+        self.overlay()
+        write(self.mirror_path("zmirror", "cached_file"), "cache")
+
+        # 升级: 文件被替换(新的inode), 删除和新增文件, wsgi.py 更新
+        os.remove(self.shared_path("zmirror", "zmirror.py"))
+        write(self.shared_path("zmirror", "zmirror.py"), "v2")
+        os.remove(self.shared_path("zmirror", "cache_system.py"))
+        write(self.shared_path("zmirror", "utils.py"), "v2")
+        write(self.shared_path("wsgi.py"), "wsgi v2")
+        self.overlay()
+
+        self.assertEqual(read(self.mirror_path("zmirror", "zmirror.py")), "v2")
+        self.assertTrue(os.path.samefile(self.shared_path("zmirror", "zmirror.py"),
+                                         self.mirror_path("zmirror", "zmirror.py")))
+        self.assertTrue(os.path.samefile(self.shared_path("zmirror", "utils.py"),
+                                         self.mirror_path("zmirror", "utils.py")))
+        self.assertFalse(os.path.exists(self.mirror_path("zmirror", "cache_system.py")))
+        self.assertEqual(read(self.mirror_path("wsgi.py")), "wsgi v2")
+        # 镜像自己产生的文件不会被删除
+        self.assertEqual(read(self.mirror_path("zmirror", "cached_file")), "cache")
+
+    def test_symlinks_are_recreated(self):
+        os.symlink("zmirror.py", self.shared_path("zmirror", "alias.py"))
+        self.overlay()
+        self.assertEqual(os.readlink(self.mirror_path("zmirror", "alias.py")), "zmirror.py")
+        self.overlay()
+        self.assertEqual(os.readlink(self.mirror_path("zmirror", "alias.py")), "zmirror.py")
+
+    def test_link_or_copy_is_idempotent(self):
+        src = self.shared_path("zmirror", "zmirror.py")
+        dst = self.mirror_path("zmirror.py")
+        os.makedirs(self.mirror)
+        g["_link_or_copy"](src, dst)
+        g["_link_or_copy"](src, dst)
+        self.assertTrue(os.path.samefile(src, dst))
+        self.assertFalse(os.path.exists(dst + ".zmirror-onekey-tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
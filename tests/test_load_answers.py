@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from deploy_loader import load
+
+
+class FakeJournal:
+    def __init__(self, steps=()):
+        self.steps = dict.fromkeys(steps, {})
+
+
+def fake_exit(code):
+    raise SystemExit(code)
+
+
+class LoadAnswersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.htdoc = os.path.join(self.tmp, "www")
+        os.makedirs(self.htdoc)
+        self.errors = []
+        self.g = load(["clean_domain", "wildcard_of", "incomplete_install_mirrors", "load_answers"],
+                      wildcard=False, already_have_cert=False,
+                      mirrors_settings={"google": {}, "youtube": {}, "twitter": {}},
+                      this_server={"htdoc": self.htdoc}, install_journal=FakeJournal(),
+                      DUMP_FILE_PATH=os.path.join(self.tmp, "last_install.dump.json"), exit=fake_exit,
+                      errprint=lambda *args: self.errors.append(" ".join(str(arg) for arg in args)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def answers_file(self, answers, name="answers.json"):
+        path = os.path.join(self.tmp, name)
+        with open(path, "w", encoding="utf-8") as fw:
+            fw.write(answers if isinstance(answers, str) else json.dumps(answers))
+        return path
+
+    def assert_invalid(self, answers, *messages, name="answers.json"):
+        self.errors = []
+        with self.assertRaises(SystemExit) as context:
+            self.g["load_answers"](self.answers_file(answers, name))
+        self.assertEqual(context.exception.code, 4)
+        for message in messages:
+            self.assertTrue([error for error in self.errors if message in error], (message, self.errors))
+
+    def test_valid_answers(self):
+        answers = self.g["load_answers"](self.answers_file({
+            "mirrors": {"google": {"domain": " https://g.example.com/ "}, "youtube": {"domain": "y.example.com"}},
+            "email": "admin@example.com",
+            "question": {"name": "who", "answer": "me"},
+        }))
+        self.assertEqual(answers["mirrors"]["google"]["domain"], "g.example.com")
+        self.assertEqual(answers["mirrors"]["youtube"]["domain"], "y.example.com")
+        self.assertEqual(self.errors, [])
+
+    def test_yaml_answers(self):
+        answers = self.g["load_answers"](self.answers_file(
+            "mirrors:\n  google:\n    domain: g.example.com\nemail: admin@example.com\n", name="answers.yaml"))
+        self.assertEqual(answers["mirrors"], {"google": {"domain": "g.example.com"}})
+
+    def test_all_errors_are_listed(self):
+        self.assert_invalid({
+            "mirrors": {"google": {"domain": "example.com"}, "youtube": {"domain": "example.com"},
+                        "twitter": {}, "unknown": {"domain": "u.example.com"}},
+            "email": "admin",
+            "question": {"name": "who"},
+        }, "is not an third-level domain", "unknown mirror `unknown`", "mirror `twitter` requires a `domain`",
+            "a valid `email` is required", "`question` should contain")
+
+    def test_duplicated_domain(self):
+        self.assert_invalid({
+            "mirrors": {"google": {"domain": "g.example.com"}, "youtube": {"domain": "g.example.com/"}},
+            "email": "admin@example.com",
+        }, "Duplicated domain [g.example.com]")
+
+    def test_allow_non_third_level_domain(self):
+        answers = self.g["load_answers"](self.answers_file({
+            "mirrors": {"google": {"domain": "example.com"}}, "email": "admin@example.com",
+            "allow_non_third_level_domain": True,
+        }))
+        self.assertEqual(answers["mirrors"]["google"]["domain"], "example.com")
+
+    def test_unreadable_files(self):
+        self.assert_invalid("{not json", "Unable to read answers file")
+        self.assert_invalid(["google"], "should contain a mapping")
+        self.assert_invalid({"mirrors": {}, "email": "admin@example.com"}, "`mirrors` should be a non-empty mapping")
+
+    def test_certs_are_required_with_own_certs(self):
+        self.g["already_have_cert"] = True
+        key = self.answers_file("key", name="privkey.pem")
+        self.assert_invalid({"mirrors": {"google": {"domain": "g.example.com", "certs": {
+            "private_key": key, "cert": os.path.join(self.tmp, "missing.pem")}}}},
+            "certs.cert: file", "certs.intermediate: file")
+
+    def test_installed_mirror_is_rejected(self):
+        os.makedirs(os.path.join(self.htdoc, "google"))
+        self.assert_invalid({"mirrors": {"google": {"domain": "g.example.com"}}, "email": "admin@example.com"},
+                            "please use --upgrade-only")
+
+    def test_resume_incomplete_install(self):
+        os.makedirs(os.path.join(self.htdoc, "google"))
+        os.makedirs(os.path.join(self.htdoc, "youtube"))
+        # google 的部署记录在安装日志中, youtube 在上一次保存的设置中
+        self.g["install_journal"] = FakeJournal(["apt:server", "mirror:deploy:google"])
+        with open(self.g["DUMP_FILE_PATH"], "w", encoding="utf-8") as fw:
+            json.dump({"mirrors_to_deploy": ["youtube"]}, fw)
+        self.assertEqual(self.g["incomplete_install_mirrors"](), {"google", "youtube"})
+
+        answers = self.g["load_answers"](self.answers_file({
+            "mirrors": {"google": {"domain": "g.example.com"}, "youtube": {"domain": "y.example.com"}},
+            "email": "admin@example.com",
+        }))
+        self.assertEqual(sorted(answers["mirrors"]), ["google", "youtube"])
+        self.assertEqual(self.errors, [])
+
+    def test_broken_dump_file_is_ignored(self):
+        with open(self.g["DUMP_FILE_PATH"], "w", encoding="utf-8") as fw:
+            fw.write("{broken")
+        self.assertEqual(self.g["incomplete_install_mirrors"](), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from deploy_loader import DEPLOY_PY, load
+
+MB = 1024
+MPM_TEMPLATE = os.path.join(os.path.dirname(DEPLOY_PY), "configs", "apache2-mpm-event.conf")
+
+g = load(["mirrors_settings", "WSGI_*", "GEVENT_*", "PYPY_*", "APACHE_CHILD_*", "_clamp", "wsgi_daemon_sizing",
+          "mpm_event_values", "mpm_limits"],
+         runtime="cpython", mirror_worker_model=lambda mirror: "thread")
+
+
+def wsgi_threads(sizing):
+    return sum(options["processes"] * options["threads"] for options in sizing["mirrors"].values())
+
+
+class MpmEventValuesTest(unittest.TestCase):
+    def values(self, mirrors, cpu_count, mem_mb):
+        sizing = g["wsgi_daemon_sizing"](mirrors, cpu_count, mem_mb * MB)
+        return sizing, g["mpm_event_values"](sizing, cpu_count, mem_mb * MB)
+
+    def assert_valid(self, sizing, values):
+        self.assertEqual(values["max_request_workers"] % values["threads_per_child"], 0)
+        children = values["max_request_workers"] // values["threads_per_child"]
+        self.assertGreaterEqual(children, 2)
+        # 平滑重载时旧的子进程需要余量
+        self.assertGreater(values["server_limit"], children)
+        self.assertLessEqual(values["start_servers"], children)
+        self.assertTrue(32 <= values["h2_max_session_streams"] <= 128)
+
+    def test_small_host(self):
+        sizing, values = self.values(["google"], 1, 512)
+        self.assert_valid(sizing, values)
+        self.assertEqual(values["threads_per_child"], 25)
+        # 内存只允许 2 个子进程
+        self.assertEqual(values["max_request_workers"], 50)
+        self.assertEqual(values["start_servers"], 2)
+        self.assertEqual(values["keep_alive_timeout"], 5)
+        self.assertEqual(values["async_request_worker_factor"], 2)
+        self.assertEqual(values["h2_window_size"], 131072)
+
+    def test_medium_host(self):
+        sizing, values = self.values(["google", "youtubeMobile"], 2, 2048)
+        self.assert_valid(sizing, values)
+        self.assertEqual(values["threads_per_child"], 25)
+        self.assertGreaterEqual(values["max_request_workers"], 150)
+        self.assertEqual(values["keep_alive_timeout"], 10)
+        self.assertEqual(values["h2_window_size"], 1048576)
+
+    def test_large_host(self):
+        mirrors = sorted(g["mirrors_settings"])
+        sizing, values = self.values(mirrors, 16, 32 * 1024)
+        self.assert_valid(sizing, values)
+        self.assertEqual(values["threads_per_child"], 64)
+        # 每个WSGI线程至少有两个Apache工作线程
+        self.assertGreaterEqual(values["max_request_workers"], wsgi_threads(sizing) * 2 + 64)
+        self.assertEqual(values["start_servers"], 8)
+        self.assertEqual(values["async_request_worker_factor"], 4)
+        self.assertEqual(values["h2_max_session_streams"], 128)
+
+    def test_rendered_config(self):
+        sizing, values = self.values(["google"], 4, 4096)
+        with open(MPM_TEMPLATE, "r", encoding="utf-8") as fr:
+            text = fr.read()
+        for key, value in values.items():
+            text = text.replace("{{%s}}" % key, str(value))
+        self.assertNotIn("{{", text)
+
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "zmirror-mpm-event.conf")
+            with open(path, "w", encoding="utf-8") as fw:
+                fw.write(text)
+            self.assertEqual(g["mpm_limits"](path), [str(values["server_limit"]), str(values["threads_per_child"])])
+            self.assertIsNone(g["mpm_limits"](os.path.join(tmp, "missing.conf")))
+        finally:
+            shutil.rmtree(tmp)
+        self.assertTrue(re.search(r"^\s*MaxRequestWorkers\s+{}$".format(values["max_request_workers"]), text, re.M))
+
+
+if __name__ == "__main__":
+    unittest.main()
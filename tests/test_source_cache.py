@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from deploy_loader import load
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME="test", GIT_AUTHOR_EMAIL="test@example.com",
+               GIT_COMMITTER_NAME="test", GIT_COMMITTER_EMAIL="test@example.com")
+
+
+def git(args, cwd):
+    return subprocess.check_output(["git"] + args, cwd=cwd, env=GIT_ENV, stderr=subprocess.STDOUT).decode("utf-8")
+
+
+class SourceCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmp, "upstream")
+        os.makedirs(self.upstream)
+        git(["init", "-q"], self.upstream)
+        git(["symbolic-ref", "HEAD", "refs/heads/master"], self.upstream)
+        self.commit("zmirror.py", "version 1")
+
+        self.commands = []
+        self.g = load(["SourceCache"], SOURCE_CACHE_DIR=None, SOURCE_REPOS=None, offline=False, cmd=self.fake_cmd)
+        self.repos = {
+            "zmirror": {"url": "file://" + self.upstream, "branch": "master", "depth": None},
+            "certbot": {"url": "file://" + self.upstream, "branch": "master", "depth": 1},
+        }
+        self.cache = self.new_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def new_cache(self):
+        """新的一次运行"""
+        return self.g["SourceCache"](os.path.join(self.tmp, "cache"), self.repos)
+
+    def fake_cmd(self, command, cwd=None, allow_failure=None):
+        self.commands.append(command)
+        subprocess.check_call(command, shell=True, cwd=cwd, env=GIT_ENV,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+
+    def commit(self, filename, content):
+        with open(os.path.join(self.upstream, filename), "w", encoding="utf-8") as fw:
+            fw.write(content)
+        git(["add", filename], self.upstream)
+        git(["commit", "-q", "-m", content], self.upstream)
+        return git(["rev-parse", "HEAD"], self.upstream).strip()
+
+    def head(self, repo, ref="master"):
+        return git(["rev-parse", ref], repo).strip()
+
+    def read(self, *path):
+        with open(os.path.join(*path), "r", encoding="utf-8") as fr:
+            return fr.read()
+
+    def test_fetch_once_per_run(self):
+        bare = self.cache.ensure("zmirror")
+        self.assertEqual(self.head(bare), self.head(self.upstream))
+        self.assertFalse(os.path.exists(bare + ".tmp"))
+
+        # 同一次运行中不再访问上游
+        self.commit("zmirror.py", "version 2")
+        self.assertEqual(self.cache.ensure("zmirror"), bare)
+        self.assertEqual(len(self.commands), 1)
+        self.assertNotEqual(self.head(bare), self.head(self.upstream))
+
+        self.new_cache().ensure("zmirror")
+        self.assertEqual(self.head(bare), self.head(self.upstream))
+        self.assertTrue(self.commands[-1].startswith("git fetch origin"))
+
+    def test_shallow_repo(self):
+        self.commit("zmirror.py", "version 2")
+        bare = self.cache.ensure("certbot")
+        self.assertEqual(git(["rev-list", "--count", "master"], bare).strip(), "1")
+
+    def test_offline(self):
+        self.g["offline"] = True
+        with self.assertRaises(RuntimeError):
+            self.cache.ensure("zmirror")
+        self.assertEqual(self.commands, [])
+
+        self.g["offline"] = False
+        self.cache.ensure("zmirror")
+        self.g["offline"] = True
+        self.new_cache().ensure("zmirror")
+        self.assertEqual(len(self.commands), 1)
+
+    def test_checkout(self):
+        dest = os.path.join(self.tmp, "www", "zmirror")
+        self.cache.checkout("zmirror", dest)
+        self.assertEqual(self.read(dest, "zmirror.py"), "version 1")
+        # origin 仍然指向上游
+        self.assertEqual(git(["remote", "get-url", "origin"], dest).strip(), "file://" + self.upstream)
+
+        self.commit("zmirror.py", "version 2")
+        self.new_cache().checkout("zmirror", dest)
+        self.assertEqual(self.read(dest, "zmirror.py"), "version 2")
+        self.assertEqual(self.head(dest, "HEAD"), self.head(self.upstream))
+
+    def test_checkout_discard_local(self):
+        dest = os.path.join(self.tmp, "certbot")
+        self.cache.checkout("certbot", dest)
+        with open(os.path.join(dest, "zmirror.py"), "w", encoding="utf-8") as fw:
+            fw.write("local change")
+        self.commit("zmirror.py", "version 2")
+        self.new_cache().checkout("certbot", dest, discard_local=True)
+        self.assertEqual(self.read(dest, "zmirror.py"), "version 2")
+
+    def test_incomplete_checkout_is_replaced(self):
+        dest = os.path.join(self.tmp, "www", "zmirror")
+        os.makedirs(dest)
+        with open(os.path.join(dest, "leftover"), "w") as fw:
+            fw.write("from an interrupted install")
+        self.cache.checkout("zmirror", dest)
+        self.assertEqual(sorted(os.listdir(dest)), [".git", "zmirror.py"])
+
+    def make_seed(self):
+        """用另一个缓存生成 tar 包, 并加入一个试图写到缓存之外的成员"""
+        other = self.g["SourceCache"](os.path.join(self.tmp, "other"), self.repos)
+        other.ensure("zmirror")
+        tarball = os.path.join(self.tmp, "sources.tar.gz")
+        with tarfile.open(tarball, "w:gz") as tar:
+            tar.add(other.bare_path("zmirror"), arcname="zmirror.git")
+            info = tarfile.TarInfo("../escaped")
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b"evil"))
+        return tarball
+
+    def test_seed_empty_cache(self):
+        tarball = self.make_seed()
+        self.g["offline"] = True
+        self.cache.seed(tarball)
+        self.assertEqual(sorted(os.listdir(self.cache.root)), ["zmirror.git"])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "escaped")))
+        # 离线时可以直接使用填充的缓存
+        dest = os.path.join(self.tmp, "www", "zmirror")
+        self.cache.checkout("zmirror", dest)
+        self.assertEqual(self.read(dest, "zmirror.py"), "version 1")
+
+    def test_seed_updates_existing_cache(self):
+        bare = self.cache.ensure("zmirror")
+        self.commit("zmirror.py", "version 2")
+        tarball = self.make_seed()
+        self.new_cache().seed(tarball)
+        # 已有的缓存从 tar 包中的仓库 fetch, 而不是被替换
+        self.assertEqual(self.head(bare), self.head(self.upstream))
+        self.assertTrue(self.commands[-1].startswith("git fetch"))
+
+
+if __name__ == "__main__":
+    unittest.main()
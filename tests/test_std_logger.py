@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from deploy_loader import load
+
+g = load(["StdLogger", "_StepSink"])
+StdLogger = g["StdLogger"]
+
+
+class StdLoggerTest(unittest.TestCase):
+    def test_small_output_is_kept(self):
+        logger = StdLogger(max_bytes=100)
+        logger.write("hello\n")
+        logger.write("world\n")
+        self.assertEqual(logger.tail(), "hello\nworld\n")
+        self.assertEqual(logger.get_value(), "hello\nworld\n")
+
+    def test_compaction_keeps_the_last_max_bytes(self):
+        logger = StdLogger(max_bytes=100)
+        for i in range(1000):
+            logger.write("line %04d\n" % i)  # 每行 10 字节
+        # 文件大小不会超过 max_bytes 的两倍
+        self.assertLessEqual(logger._size, 200)
+        self.assertEqual(logger._dropped + logger._size, 10000)
+        self.assertTrue(logger.tail().endswith("line 0999\n"))
+        self.assertLessEqual(len(logger.tail()), 100)
+
+    def test_tail_limits(self):
+        logger = StdLogger(max_bytes=1000)
+        for i in range(10):
+            logger.write("line %d\n" % i)
+        self.assertEqual(logger.tail(max_lines=2), "line 8\nline 9\n")
+        self.assertEqual(logger.tail(max_bytes=7), "line 9\n")
+        self.assertEqual(logger.tail(max_bytes=10 ** 6), logger.tail())
+
+    def test_steps(self):
+        logger = StdLogger(max_bytes=1000)
+        a = g["_StepSink"](logger, "a")
+        a.write("a1 ")
+        logger.write("b1 ", step="b")
+        a.write("a2 ")
+        a.write("a3 ")
+        logger.write("none ")
+        self.assertEqual(logger.get_step("a"), "a1 a2 a3 ")
+        self.assertEqual(logger.get_step("b"), "b1 ")
+        self.assertEqual(logger.get_step("unknown"), "")
+        # 相连的两段会合并
+        self.assertEqual(len(logger._steps["a"]), 2)
+
+    def test_step_output_after_compaction(self):
+        logger = StdLogger(max_bytes=100)
+        logger.write("x" * 50, step="old")
+        logger.write("y" * 150, step="new")
+        logger.write("z" * 60, step="last")
+        # old 已经被完全丢弃, new 只剩下最后的部分
+        self.assertEqual(logger.get_step("old"), "")
+        self.assertEqual(logger.get_step("new"), "y" * 40)
+        self.assertEqual(logger.get_step("last"), "z" * 60)
+
+    def test_max_steps(self):
+        logger = StdLogger(max_steps=3)
+        for i in range(5):
+            logger.write("%d" % i, step="s%d" % i)
+        self.assertEqual(list(logger._steps), ["s2", "s3", "s4"])
+        self.assertEqual(logger.get_step("s0"), "")
+        self.assertEqual(logger.get_step("s4"), "4")
+
+    def test_non_ascii(self):
+        logger = StdLogger(max_bytes=1000)
+        logger.write("安装完成\n", step="a")
+        self.assertEqual(logger.get_step("a"), "安装完成\n")
+        self.assertEqual(logger.tail(), "安装完成\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from deploy_loader import load
+
+
+class _Profiler:
+    def add(self, *args, **kwargs):
+        pass
+
+
+class _Journal:
+    """只记录调用, 已完成的步骤由 done 指定"""
+
+    def __init__(self, done=()):
+        self.done = set(done)
+        self.recorded = []
+
+    def run(self, name, func, inputs):
+        if name in self.done:
+            return False
+        func()
+        self.recorded.append(name)
+        return True
+
+
+class StepSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.journal = _Journal()
+        self.g = load(["StepScheduler"], install_journal=self.journal, profiler=_Profiler())
+        self.lock = threading.Lock()
+        self.events = []
+        self.active = 0
+        self.max_active = {}
+
+    def step(self, name, duration=0.05):
+        """记录开始和结束的顺序, 以及运行时同时在运行的步骤数"""
+        def func():
+            with self.lock:
+                self.active += 1
+                self.events.append(("start", name))
+            time.sleep(duration)
+            with self.lock:
+                self.max_active[name] = self.active
+                self.active -= 1
+                self.events.append(("end", name))
+        return func
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+    def test_dependencies_run_in_order(self):
+        scheduler = self.g["StepScheduler"]()
+        scheduler.add("a", self.step("a"))
+        scheduler.add("b", self.step("b"), deps=["a"])
+        scheduler.add("c", self.step("c"), deps=["b"])
+        scheduler.run()
+        self.assertLess(self.index("end", "a"), self.index("start", "b"))
+        self.assertLess(self.index("end", "b"), self.index("start", "c"))
+
+    def test_independent_steps_run_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+        scheduler = self.g["StepScheduler"](max_workers=4)
+        for name in ("a", "b", "c"):
+            # 三个步骤必须同时在运行, 否则 barrier 会超时
+            scheduler.add(name, barrier.wait)
+        scheduler.run()
+
+    def test_exclusive_step_is_a_barrier(self):
+        scheduler = self.g["StepScheduler"](max_workers=8)
+        scheduler.add("a", self.step("a"))
+        scheduler.add("b", self.step("b"))
+        scheduler.add("x", self.step("x"), exclusive=True)
+        for i in range(4):
+            scheduler.add("m%d" % i, self.step("m%d" % i), deps=["x"])
+        scheduler.add("y", self.step("y"), deps=["m%d" % i for i in range(4)], exclusive=True)
+        scheduler.run()
+
+        self.assertEqual(self.max_active["x"], 1)
+        self.assertEqual(self.max_active["y"], 1)
+        self.assertLess(self.index("end", "a"), self.index("start", "x"))
+        self.assertLess(self.index("end", "b"), self.index("start", "x"))
+        # x 之后的步骤是并行的
+        self.assertGreater(max(self.max_active["m%d" % i] for i in range(4)), 1)
+
+    def test_exclusive_steps_keep_their_order(self):
+        scheduler = self.g["StepScheduler"]()
+        scheduler.add("x", self.step("x", 0.1), exclusive=True)
+        scheduler.add("y", self.step("y"), exclusive=True)
+        self.assertEqual(scheduler.steps["y"]["deps"], ["x"])
+        scheduler.run()
+        self.assertLess(self.index("end", "x"), self.index("start", "y"))
+
+    def test_failure_stops_dependents_and_raises(self):
+        scheduler = self.g["StepScheduler"]()
+        scheduler.add("a", lambda: 1 / 0)
+        scheduler.add("b", self.step("b"), deps=["a"])
+        scheduler.add("c", self.step("c"))
+        with self.assertRaises(ZeroDivisionError):
+            scheduler.run()
+        self.assertNotIn(("start", "b"), self.events)
+        self.assertIn(("end", "c"), self.events)
+
+    def test_invalid_graph(self):
+        scheduler = self.g["StepScheduler"]()
+        scheduler.add("a", self.step("a"))
+        with self.assertRaises(ValueError):
+            scheduler.add("a", self.step("a"))
+        with self.assertRaises(ValueError):
+            scheduler.add("b", self.step("b"), deps=["unknown"])
+
+    def test_steps_with_inputs_go_through_the_journal(self):
+        self.journal.done.add("a")
+        scheduler = self.g["StepScheduler"]()
+        scheduler.add("a", self.step("a"), inputs={})
+        scheduler.add("b", self.step("b"), deps=["a"], inputs={})
+        scheduler.add("c", self.step("c"))
+        scheduler.run()
+        self.assertNotIn(("start", "a"), self.events)
+        self.assertEqual(self.journal.recorded, ["b"])
+        self.assertIn(("end", "c"), self.events)
+
+
+if __name__ == "__main__":
+    unittest.main()
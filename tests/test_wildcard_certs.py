@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from deploy_loader import load
+
+
+def fake_exit(code):
+    raise SystemExit(code)
+
+
+class WildcardCertTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.errors = []
+        self.g = load(["wildcard_of", "cert_covering", "clean_domain", "load_answers"],
+                      wildcard=True, already_have_cert=False,
+                      mirrors_settings={"google": {}, "youtube": {}},
+                      this_server={"htdoc": os.path.join(self.tmp, "www")},
+                      incomplete_install_mirrors=set, exit=fake_exit,
+                      errprint=lambda *args: self.errors.append(" ".join(str(arg) for arg in args)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def load_answers(self, mirrors):
+        path = os.path.join(self.tmp, "answers.json")
+        with open(path, "w", encoding="utf-8") as fw:
+            json.dump({"mirrors": mirrors, "email": "admin@example.com", "allow_non_third_level_domain": True}, fw)
+        return self.g["load_answers"](path)
+
+    def test_wildcard_of(self):
+        wildcard_of = self.g["wildcard_of"]
+        self.assertEqual(wildcard_of("g.example.com"), "*.example.com")
+        self.assertEqual(wildcard_of("a.b.example.com"), "*.b.example.com")
+        # 父域名是顶级域名, 或者没有父域名
+        self.assertIsNone(wildcard_of("example.com"))
+        self.assertIsNone(wildcard_of("localhost"))
+
+    def test_cert_covering(self):
+        covered = {"*.example.com": "/live/wildcard.example.com", "example.org": "/live/example.org"}
+        cert_covering = self.g["cert_covering"]
+        self.assertEqual(cert_covering("g.example.com", covered), "/live/wildcard.example.com")
+        self.assertEqual(cert_covering("example.org", covered), "/live/example.org")
+        self.assertIsNone(cert_covering("a.g.example.com", covered))
+        self.assertIsNone(cert_covering("example.com", covered))
+        self.assertIsNone(cert_covering("localhost", covered))
+
+    def test_load_answers_rejects_apex_with_wildcard(self):
+        with self.assertRaises(SystemExit):
+            self.load_answers({"google": {"domain": "example.com"}, "youtube": {"domain": "y.example.com"}})
+        self.assertEqual(len([error for error in self.errors if "--wildcard" in error]), 1)
+        self.assertIn("[example.com]", self.errors[-1])
+
+        self.errors = []
+        with self.assertRaises(SystemExit):
+            self.load_answers({"google": {"domain": "localhost"}})
+        self.assertIn("[localhost]", self.errors[-1])
+
+    def test_load_answers_accepts_subdomains_with_wildcard(self):
+        answers = self.load_answers({"google": {"domain": "https://g.example.com/"}})
+        self.assertEqual(answers["mirrors"]["google"]["domain"], "g.example.com")
+        self.assertEqual(self.errors, [])
+
+        # 不使用 --wildcard 时, 允许非三级域名
+        self.g["wildcard"] = False
+        answers = self.load_answers({"google": {"domain": "example.com"}})
+        self.assertEqual(answers["mirrors"]["google"]["domain"], "example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
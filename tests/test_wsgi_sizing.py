@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from deploy_loader import load
+
+MB = 1024
+
+
+def load_sizing(runtime="cpython"):
+    return load(["mirrors_settings", "WSGI_*", "GEVENT_*", "PYPY_*", "_clamp", "wsgi_daemon_sizing",
+                 "wsgi_daemon_options"],
+                runtime=runtime, mirror_worker_model=lambda mirror: "thread")
+
+
+class WsgiDaemonSizingTest(unittest.TestCase):
+    def setUp(self):
+        self.g = load_sizing()
+        self.all_mirrors = sorted(self.g["mirrors_settings"])
+
+    def sizing(self, mirrors, cpu_count, mem_mb, models=None):
+        return self.g["wsgi_daemon_sizing"](mirrors, cpu_count, mem_mb * MB, models)
+
+    def assert_valid(self, sizing, cpu_count):
+        mirrors = sizing["mirrors"]
+        total_processes = sum(options["processes"] for options in mirrors.values())
+        self.assertLessEqual(total_processes, max(len(mirrors), cpu_count * self.g["WSGI_PROCESSES_PER_CPU"]))
+        for options in mirrors.values():
+            self.assertGreaterEqual(options["processes"], 1)
+            if "threads" in options:
+                self.assertTrue(self.g["WSGI_MIN_THREADS"] <= options["threads"] <= self.g["WSGI_MAX_THREADS"])
+            self.assertTrue(100 <= options["listen-backlog"] <= 2048)
+
+    def test_small_host_single_mirror(self):
+        sizing = self.sizing(["google"], 1, 512)
+        self.assert_valid(sizing, 1)
+        options = sizing["mirrors"]["google"]
+        self.assertEqual(options["processes"], 2)
+        self.assertEqual(options["threads"], 8)
+        self.assertEqual(options["request-timeout"], 240)
+        self.assertLessEqual(sizing["required_kb"], sizing["available_kb"])
+        # 512MB 时留出 256MB
+        self.assertEqual(sizing["available_kb"], 256 * MB)
+
+    def test_small_host_all_mirrors(self):
+        sizing = self.sizing(self.all_mirrors, 1, 512)
+        self.assert_valid(sizing, 1)
+        # 内存不够时, 每个镜像仍然有一个进程, 但更频繁地回收
+        for options in sizing["mirrors"].values():
+            self.assertEqual(options["processes"], 1)
+            self.assertEqual(options["threads"], self.g["WSGI_MIN_THREADS"])
+            self.assertEqual(options["maximum-requests"], 2000)
+            self.assertEqual(options["inactivity-timeout"], 600)
+        self.assertGreater(sizing["minimum_kb"], sizing["available_kb"])
+
+    def test_large_host_all_mirrors(self):
+        sizing = self.sizing(self.all_mirrors, 16, 32 * 1024)
+        self.assert_valid(sizing, 16)
+        mirrors = sizing["mirrors"]
+        self.assertEqual(sum(options["processes"] for options in mirrors.values()), 32)
+        # 按权重分配
+        self.assertGreater(mirrors["youtubePC"]["processes"], mirrors["twitterPC"]["processes"])
+        self.assertGreaterEqual(mirrors["google"]["processes"], mirrors["instagram"]["processes"])
+        self.assertEqual(mirrors["youtubePC"]["request-timeout"], 360)
+        for options in mirrors.values():
+            self.assertEqual(options["maximum-requests"], 10000)
+            self.assertEqual(options["inactivity-timeout"], 3600)
+        self.assertLess(sizing["required_kb"], sizing["available_kb"] * 0.8)
+        self.assertEqual(sizing["available_kb"], 32 * 1024 * MB - int(32 * 1024 * MB * 0.15))
+
+    def test_more_cpus_more_concurrency(self):
+        small = self.sizing(["google", "youtubePC"], 2, 4096)["mirrors"]
+        large = self.sizing(["google", "youtubePC"], 8, 4096)["mirrors"]
+        for mirror in ("google", "youtubePC"):
+            self.assertGreater(large[mirror]["processes"] * large[mirror]["threads"],
+                               small[mirror]["processes"] * small[mirror]["threads"])
+
+    def test_gevent(self):
+        models = {"google": "gevent", "youtubePC": "thread"}
+        small = self.sizing(["google", "youtubePC"], 1, 512, models)
+        large = self.sizing(["google", "youtubePC"], 16, 32 * 1024, models)
+        self.assert_valid(small, 1)
+        self.assert_valid(large, 16)
+        for sizing in (small, large):
+            google = sizing["mirrors"]["google"]
+            self.assertNotIn("threads", google)
+            self.assertTrue(self.g["GEVENT_MIN_CONNECTIONS"] <= google["worker-connections"]
+                            <= self.g["GEVENT_MAX_CONNECTIONS"])
+            self.assertIn("threads", sizing["mirrors"]["youtubePC"])
+        # 内存足够时, 并发数为 每单位权重 100
+        self.assertEqual(large["mirrors"]["google"]["worker-connections"], 200)
+
+    def test_gevent_without_memory(self):
+        models = dict((mirror, "gevent") for mirror in self.all_mirrors)
+        sizing = self.sizing(self.all_mirrors, 1, 512, models)
+        for options in sizing["mirrors"].values():
+            self.assertEqual(options["worker-connections"], self.g["GEVENT_MIN_CONNECTIONS"])
+
+    def test_pypy(self):
+        pypy = load_sizing("pypy")["wsgi_daemon_sizing"](["google"], 4, 8 * 1024 * MB)
+        cpython = self.sizing(["google"], 4, 8 * 1024)
+        self.assertEqual(pypy["mirrors"]["google"]["maximum-requests"],
+                         cpython["mirrors"]["google"]["maximum-requests"] * self.g["PYPY_MAXIMUM_REQUESTS_FACTOR"])
+        self.assertGreater(pypy["required_kb"], cpython["required_kb"])
+
+
+class WsgiDaemonOptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.g = load_sizing()
+        self.options = self.g["wsgi_daemon_sizing"](["google"], 2, 2048 * MB)["mirrors"]["google"]
+
+    def test_mod_wsgi_4(self):
+        text = self.g["wsgi_daemon_options"](self.options, (4, 6))
+        for key in self.options:
+            self.assertIn(key + "=", text)
+
+    def test_mod_wsgi_3_4(self):
+        text = self.g["wsgi_daemon_options"](self.options, (3, 4))
+        for key in self.g["WSGI_OPTIONS_REQUIRE_4_1"]:
+            self.assertNotIn(key + "=", text)
+        for key in ("processes", "threads", "maximum-requests", "inactivity-timeout"):
+            self.assertIn("{}={}".format(key, self.options[key]), text)
+
+
+if __name__ == "__main__":
+    unittest.main()